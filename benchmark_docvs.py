@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ============================================================
+# 🏁 BENCHMARK DO DISPARO DE PENDÊNCIAS (teste_docvs.py)
+# ============================================================
+#
+# Mede o pipeline sem credenciais de produção:
+#   - Cubo_Documentos sintético (mesmas colunas de SQL_COMPETENCIA /
+#     SQL_CARDS / SQL_PENDENCIAS_HIST), com nº de contratos, documentos por
+#     contrato e profundidade de histórico configuráveis;
+#   - td.ClienteCuboLocal no lugar do BigQuery (devolve Arrow e passa pelo
+#     query_bq real);
+#   - servidor SMTP local (aiosmtpd) que só conta mensagens e bytes.
+# Roda o caminho real do main(): carregar_dados (com cache), preparar_tarefas
+# (KPIs em lote, historico_5_meses, anexos) e executar_pipeline (_renderizar_grupo
+# nos workers: montar_email + mensagem_bytes; entrega pelo PoolSMTP), e reporta
+# vazão, pico de RSS e tempos por etapa.
+# Com --envio, mede só a entrega (PoolSMTP + threads vs. EnvioAssincrono) por
+# nº de sessões, contra o servidor local com latência artificial por mensagem.
+# Com --montagem, mede só a montagem + serialização das mensagens (msgs/s),
+# montador atual vs. a árvore email.mime de referência.
+# Com --graficos N, mede só o render dos gráficos (gráficos/s), RenderizadorGrafico
+# vs. o gerar_grafico original em pyplot.
+# Com --tabela, mede só a tabela HTML de documentos, dataframe_to_html vs. o
+# iterrows original.
+#
+# Uso:
+#   python benchmark_docvs.py --contratos 100 1000 10000 --saida bench.json
+#   python benchmark_docvs.py --envio --sessoes 1 2 4 8 --atraso-ms 20
+#   python benchmark_docvs.py --montagem --mensagens 2000
+#   python benchmark_docvs.py --graficos 300
+#   python benchmark_docvs.py --tabela
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import tempfile
+import socket
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import teste_docvs as td
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+LOGO_BENCHMARK = os.path.join(RAIZ, "public", "images", "logo.png")
+
+COLUNAS_CUBO = [
+    "PROJETO", "COMPETENCIA", "Competencia_Data", "DOCUMENTO", "PRESTADOR",
+    "CNPJ_PRESTADOR", "CONTRATO", "STATUS_GERAL_Regra", "CRITICO", "RELEVANCIA",
+    "DOCUMENTO_APROV_OBS2", "DOCUMENTO_APROV_REGULARIZA2", "Chave_Composta", "email_envio",
+]
+PROJETOS = [
+    "Vallourec", "Projeto Sucuriú", "BRACELL BAHIA FLORESTAL",
+    "Reparação Bacia do Rio Doce", "Cliente Padrão",
+]
+STATUS = ["Conforme", "Em Análise", "Não Conforme", "Não Enviado"]
+PESOS_STATUS = [0.70, 0.10, 0.15, 0.05]
+COMPETENCIA_BENCHMARK = "2025-09"
+OBSERVACOES = [
+    "", "Documento ilegível", "Assinatura ausente & data divergente",
+    "Valor < mínimo exigido", "Enviar versão atualizada do certificado",
+]
+
+
+# ------------------------------------------------------------
+# 1️⃣ Gerador sintético do Cubo_Documentos
+# ------------------------------------------------------------
+def gerar_cubo(n_contratos, docs_por_contrato=12, meses=12,
+               competencia_alvo=COMPETENCIA_BENCHMARK, contratos_por_prestador=3, seed=0):
+    """
+    Uma linha por (contrato, competência, documento), nas `meses` competências
+    até `competencia_alvo`. Prestadores têm `contratos_por_prestador` contratos
+    (mesmo e-mail), como acontece com os grandes prestadores reais.
+    """
+    rng = np.random.default_rng(seed)
+    comps = np.array([str(pd.Period(competencia_alvo, freq="M") - i) for i in range(meses - 1, -1, -1)])
+    por_contrato = docs_por_contrato * meses
+    n = n_contratos * por_contrato
+
+    i_contrato = np.repeat(np.arange(n_contratos), por_contrato)
+    i_comp = np.tile(np.repeat(np.arange(meses), docs_por_contrato), n_contratos)
+    i_doc = np.tile(np.arange(docs_por_contrato), n_contratos * meses)
+    i_prestador = np.arange(n_contratos) // contratos_por_prestador
+
+    projetos = np.array(PROJETOS, dtype=object)[np.arange(n_contratos) % len(PROJETOS)]
+    prestadores = np.array([f"Prestador {p:05d}" for p in i_prestador], dtype=object)
+    contratos = np.array([f"CT-{c:06d}" for c in range(n_contratos)], dtype=object)
+    cnpjs = np.array([f"{p:014d}" for p in i_prestador], dtype=object)
+    emails = np.array([f"contato{p:05d}@prestador.com.br; gestor{p:05d}@prestador.com.br"
+                       for p in i_prestador], dtype=object)
+    documentos = np.array([f"Documento {d:02d}" for d in range(docs_por_contrato)], dtype=object)
+
+    status = rng.choice(np.array(STATUS, dtype=object), size=n, p=PESOS_STATUS)
+    df = pd.DataFrame({
+        "PROJETO": projetos[i_contrato],
+        "COMPETENCIA": comps[i_comp],
+        "Competencia_Data": pd.to_datetime(pd.Series(comps[i_comp]) + "-01").dt.date,
+        "DOCUMENTO": documentos[i_doc],
+        "PRESTADOR": prestadores[i_contrato],
+        "CNPJ_PRESTADOR": cnpjs[i_contrato],
+        "CONTRATO": contratos[i_contrato],
+        "STATUS_GERAL_Regra": status,
+        "CRITICO": rng.choice(np.array(["0", "1"], dtype=object), size=n, p=[0.8, 0.2]),
+        "RELEVANCIA": f"{1 / docs_por_contrato:.6f}",
+        "DOCUMENTO_APROV_OBS2": rng.choice(np.array(OBSERVACOES, dtype=object), size=n),
+        "DOCUMENTO_APROV_REGULARIZA2": np.where(status == "Não Conforme", "Regularizar até o dia 10", ""),
+        "email_envio": emails[i_contrato],
+    })
+    df["Chave_Composta"] = df["CONTRATO"] + "|" + df["COMPETENCIA"] + "|" + df["DOCUMENTO"]
+    return df[COLUNAS_CUBO]
+
+
+# ------------------------------------------------------------
+# 2️⃣ Servidor SMTP local (só conta)
+# ------------------------------------------------------------
+class _ContadorSMTP:
+    def __init__(self, atraso_s=0.0):
+        self.mensagens = 0
+        self.bytes = 0
+        self.atraso_s = atraso_s
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.atraso_s:
+            # simula o tempo de aceitação de um servidor real (por mensagem, por sessão)
+            await asyncio.sleep(self.atraso_s)
+        self.mensagens += 1
+        self.bytes += len(envelope.content)
+        return "250 OK"
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def iniciar_smtp_local(atraso_s=0.0):
+    """Sobe um aiosmtpd em thread própria; devolve (controller, contador, porta)."""
+    from aiosmtpd.controller import Controller
+    contador = _ContadorSMTP(atraso_s)
+    porta = _porta_livre()
+    controller = Controller(contador, hostname="127.0.0.1", port=porta)
+    controller.start()
+    return controller, contador, porta
+
+
+# ------------------------------------------------------------
+# 3️⃣ Execução de um cenário
+# ------------------------------------------------------------
+def executar_cenario(n_contratos, porta_smtp, docs_por_contrato=12, meses=12, workers_render=None):
+    """
+    Um cenário completo (carga → render → envio) pelo caminho real do
+    teste_docvs: carregar_dados, preparar_tarefas e executar_pipeline (render
+    em processos, entrega pelo PoolSMTP), com o td.ClienteCuboLocal no lugar do
+    BigQuery e um cache vazio em diretório temporário.
+    """
+    t_geracao = time.perf_counter()
+    cubo = gerar_cubo(n_contratos, docs_por_contrato, meses)
+    cliente = td.ClienteCuboLocal(cubo)
+    t_geracao = time.perf_counter() - t_geracao
+
+    td.bq_client = cliente   # toda consulta do teste_docvs vai ao cliente falso
+    td.METRICAS.ativo = True
+    td.METRICAS.drenar()
+    td.ATIVOS.registrar("logo_metax", LOGO_BENCHMARK, "png", "logo_metax.png")
+    td.configurar_smtp({"smtp_server": "127.0.0.1", "smtp_port": porta_smtp,
+                        "smtp_from": "benchmark@localhost"})
+    competencia = COMPETENCIA_BENCHMARK
+
+    inicio = time.perf_counter()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = td.CacheCompetencias(cache_dir)
+        df_base, df_cards, df_hist = td.carregar_dados(competencia, cache, verbose=False)
+        tarefas, _ = td.preparar_tarefas(df_base, df_cards, df_hist, competencia)
+    with td.PoolSMTP("127.0.0.1", porta_smtp, usar_tls=False, tamanho=td.SMTP_POOL_TAMANHO,
+                     max_msgs_por_sessao=td.SMTP_MSGS_POR_SESSAO) as pool:
+        relatorio = td.executar_pipeline(tarefas, pool, workers_render=workers_render,
+                                         workers_envio=td.SMTP_POOL_TAMANHO)
+    duracao = time.perf_counter() - inicio
+    enviados = sum(item["status"] == "enviado" for item in relatorio)
+
+    resumo = td.METRICAS.resumo()
+    return {
+        "contratos": n_contratos,
+        "linhas_cubo": len(cubo),
+        "mensagens": enviados,
+        "falhas": len(relatorio) - enviados,
+        "consultas_bq": cliente.consultas,
+        "geracao_s": round(t_geracao, 3),
+        "duracao_s": round(duracao, 3),
+        "contratos_por_s": round(enviados / duracao, 2) if duracao else None,
+        "pico_rss_mb": round(td.pico_rss_mb(), 1),
+        "pico_rss_worker_mb": round(td.pico_rss_mb(filhos=True), 1),
+        "bytes_enviados": int(resumo["contadores"].get("bytes_enviados_total", 0)),
+        "etapas_ms": resumo["etapas_ms"],
+    }
+
+
+# ------------------------------------------------------------
+# 4️⃣ Entrega: backend síncrono vs. assíncrono por nº de sessões
+# ------------------------------------------------------------
+def _percentil_ms(valores, q):
+    return round(float(np.percentile(valores, q)) * 1000, 2) if valores else None
+
+
+def benchmark_envio(porta_smtp, n_mensagens=400, sessoes=(1, 2, 4, 8)):
+    """
+    Vazão (msgs/s) e latência por mensagem entregando `n_mensagens` iguais com
+    o PoolSMTP + threads e com o EnvioAssincrono, para cada nº de sessões.
+    Com latência no servidor, a vazão deve crescer ~linearmente com as sessões.
+    """
+    td.ATIVOS.registrar("logo_metax", LOGO_BENCHMARK, "png", "logo_metax.png")
+    td.configurar_smtp({"smtp_server": "127.0.0.1", "smtp_port": porta_smtp,
+                        "smtp_from": "benchmark@localhost"})
+
+    def _mensagens():
+        return [td.mensagem_bytes(["destino@localhost"], f"[Benchmark] envio {i}", "<p>ok</p>", texto="ok")
+                for i in range(n_mensagens)]
+
+    resultados = []
+    for n in sessoes:
+        # síncrono: uma thread por sessão, cada envio bloqueia a sua thread
+        msgs = _mensagens()
+        with td.PoolSMTP("127.0.0.1", porta_smtp, usar_tls=False, tamanho=n) as pool, \
+             ThreadPoolExecutor(max_workers=n) as tp:
+            def _enviar(msg):
+                t0 = time.perf_counter()
+                pool.enviar(msg)
+                return time.perf_counter() - t0
+            t0 = time.perf_counter()
+            latencias = list(tp.map(_enviar, msgs))
+            duracao = time.perf_counter() - t0
+        resultados.append({"backend": "sync", "sessoes": n, "msgs_por_s": round(n_mensagens / duracao, 1),
+                           "latencia_p50_ms": _percentil_ms(latencias, 50),
+                           "latencia_p95_ms": _percentil_ms(latencias, 95)})
+
+        # assíncrono: N sessões num event loop, alimentadas pela fila limitada
+        msgs = _mensagens()
+        with td.EnvioAssincrono("127.0.0.1", porta_smtp, sessoes=n, fila_max=4 * n, usar_tls=False) as envio:
+            t0 = time.perf_counter()
+            futuros = [envio.submeter(msg) for msg in msgs]
+            latencias = [f.result()["latencia_s"] for f in futuros]
+            duracao = time.perf_counter() - t0
+        resultados.append({"backend": "async", "sessoes": n, "msgs_por_s": round(n_mensagens / duracao, 1),
+                           "latencia_p50_ms": _percentil_ms(latencias, 50),
+                           "latencia_p95_ms": _percentil_ms(latencias, 95)})
+        for r in resultados[-2:]:
+            print(f"📮 {r['backend']:<5} {n:>3} sessões: {r['msgs_por_s']:8.1f} msgs/s | "
+                  f"p50 {r['latencia_p50_ms']:8.2f} ms | p95 {r['latencia_p95_ms']:8.2f} ms")
+    return resultados
+
+
+# ------------------------------------------------------------
+# 5️⃣ Montagem das mensagens: MontadorMensagem vs. email.mime
+# ------------------------------------------------------------
+def _montar_referencia(to_list, subject, html, grafico_bytes, texto, anexo, logo):
+    """Árvore email.mime (related → alternative) como era montada antes, serializada como no envio."""
+    from email.generator import BytesGenerator
+    from email.mime.application import MIMEApplication
+    from email.mime.image import MIMEImage
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart("related")
+    msg["From"], msg["To"], msg["Subject"] = td.SMTP_FROM, ", ".join(to_list), subject
+    msg_alt = MIMEMultipart("alternative")
+    msg.attach(msg_alt)
+    msg_alt.attach(MIMEText(texto, "plain", "utf-8"))
+    msg_alt.attach(MIMEText(html, "html", "utf-8"))
+    img = MIMEImage(grafico_bytes, "png")
+    img.add_header("Content-ID", "<grafico_pendencias>")
+    img.add_header("Content-Disposition", "inline", filename="grafico_pendencias.png")
+    msg.attach(img)
+    msg.attach(logo)
+    dados, filename, subtipo = anexo
+    part = MIMEApplication(dados, _subtype=subtipo)
+    part.add_header("Content-Disposition", "attachment", filename=filename)
+    msg.attach(part)
+    # antes: serializada uma vez para a métrica de tamanho (as_bytes) e de novo no
+    # send_message, que achata a árvore com um BytesGenerator em CRLF
+    len(msg.as_bytes())
+    buf = io.BytesIO()
+    BytesGenerator(buf).flatten(msg, linesep="\r\n")
+    return buf.getvalue()
+
+
+def benchmark_montagem(n_mensagens=2000, seed=0):
+    """
+    Mensagens/s da montagem + serialização (o que o worker de render faz por
+    mensagem), com HTML, texto, gráfico, logo e anexo de tamanho realista.
+    """
+    from email.mime.image import MIMEImage
+
+    td.ATIVOS.registrar("logo_metax", LOGO_BENCHMARK, "png", "logo_metax.png")
+    td.configurar_smtp({"smtp_server": "127.0.0.1", "smtp_port": 25, "smtp_from": "benchmark@localhost"})
+    rng = np.random.default_rng(seed)
+    html = "<tr><td>Documento</td><td>Não Conforme</td></tr>" * 300
+    texto = "Documento | Não Conforme\n" * 300
+    grafico = rng.integers(0, 256, 25_000, dtype=np.uint8).tobytes()
+    anexo = ("DOCUMENTO;STATUS\nContrato social;Pendente\n".encode() * 500, "pendencias.csv", "csv")
+    with open(LOGO_BENCHMARK, "rb") as f:
+        logo = MIMEImage(f.read(), "png")
+
+    resultados = []
+    for nome, montar in (
+        ("email.mime", lambda i: _montar_referencia(["destino@localhost"], f"[Pendências Docs] {i}", html,
+                                                   grafico, texto, anexo, logo)),
+        ("MontadorMensagem", lambda i: td.mensagem_bytes(["destino@localhost"], f"[Pendências Docs] {i}", html,
+                                                       grafico, texto=texto, anexo=anexo).dados),
+    ):
+        t0 = time.perf_counter()
+        tamanho = sum(len(montar(i)) for i in range(n_mensagens))
+        duracao = time.perf_counter() - t0
+        resultados.append({"montador": nome, "msgs_por_s": round(n_mensagens / duracao, 1),
+                           "bytes_medio": tamanho // n_mensagens})
+        print(f"✉️ {nome:<17} {resultados[-1]['msgs_por_s']:8.1f} msgs/s | "
+              f"{resultados[-1]['bytes_medio'] / 1e3:8.1f} kB/mensagem")
+    return resultados
+
+
+# ------------------------------------------------------------
+# 6️⃣ Gráficos: RenderizadorGrafico vs. o pyplot original
+# ------------------------------------------------------------
+def _grafico_pyplot(df_cards_hist5, formato="png"):
+    """O gerar_grafico original (pyplot, figura nova e plt.close por gráfico), como referência."""
+    import matplotlib
+    matplotlib.use("Agg")   # backend global do pyplot: só neste script, o td desenha com FigureCanvasAgg
+    import matplotlib.pyplot as plt
+    from scipy.interpolate import make_interp_spline
+    if df_cards_hist5.empty:
+        return None
+    sub = df_cards_hist5.sort_values("COMPETENCIA")
+    x = np.arange(len(sub))
+    y = sub["total_pendencias"].astype(float).values
+    competencias = sub["COMPETENCIA"].astype(str).values
+    plt.figure(figsize=(5.2, 2.2), dpi=160)
+    ax = plt.gca()
+    if len(x) >= 3 and len(np.unique(y)) > 1:
+        x_smooth = np.linspace(x.min(), x.max(), 150)
+        try:
+            y_smooth = make_interp_spline(x, y, k=2)(x_smooth)
+            plt.plot(x_smooth, y_smooth, color=td.COR_LINHA_FORTE, linewidth=1.8)
+            plt.fill_between(x_smooth, y_smooth, color=td.COR_LINHA_SUAVE, alpha=0.2)
+        except Exception:
+            plt.plot(x, y, color=td.COR_LINHA_FORTE, linewidth=1.8)
+    else:
+        plt.plot(x, y, color=td.COR_LINHA_FORTE, linewidth=1.8)
+    plt.scatter(x, y, color=td.COR_PRINCIPAL, s=26)
+    for xi, yi in zip(x, y):
+        plt.text(xi, yi + 0.1, f"{int(yi)}", ha="center", va="bottom", fontsize=7.5, color=td.COR_PRINCIPAL)
+    plt.xticks(x, competencias, fontsize=8.5, color="#374151")
+    plt.yticks([])
+    for side in ["top", "right", "left"]:
+        ax.spines[side].set_visible(False)
+    ax.spines["bottom"].set_color("#D1D5DB")
+    plt.grid(axis="y", linestyle="--", alpha=0.25)
+    plt.title("Pendências nas últimas competências", fontsize=9.5, color=td.COR_PRINCIPAL)
+    plt.tight_layout()
+    buf = io.BytesIO()
+    plt.savefig(buf, format=formato, bbox_inches="tight", transparent=True)
+    plt.close()
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def benchmark_graficos(n=300, formato="png", seed=0, competencia=COMPETENCIA_BENCHMARK):
+    """
+    Mede gráficos/s a partir do mesmo df_cards_hist5 do envio: o pyplot
+    original (_grafico_pyplot), figura nova por chamada sem pyplot, figura
+    reaproveitada, e figura reaproveitada + memo. Metade das séries é toda
+    zero, o resto são históricos aleatórios de 0–5 pendências.
+    """
+    rng = np.random.default_rng(seed)
+    comps = td._lista_ultimos_5_meses(competencia)
+    historicos = [
+        pd.DataFrame({"COMPETENCIA": comps[::-1],
+                      "total_pendencias": [0] * 5 if i % 2 == 0 else rng.integers(0, 6, 5).tolist()})
+        for i in range(n)
+    ]
+
+    def _renderizador(r):
+        # o mesmo caminho de _partes_contrato: ordena a série e chama o renderizador
+        def _grafico(df):
+            sub = df.sort_values("COMPETENCIA")
+            return r.renderizar(sub["COMPETENCIA"].astype(str).tolist(),
+                                sub["total_pendencias"].astype(float).tolist(), formato)
+        return _grafico
+
+    variantes = {
+        "pyplot (original)": lambda df: _grafico_pyplot(df, formato),
+        "figura nova por gráfico": _renderizador(td.RenderizadorGrafico(cache_max=0, reutilizar_figura=False)),
+        "figura reaproveitada": _renderizador(td.RenderizadorGrafico(cache_max=0)),
+        "figura reaproveitada + memo": _renderizador(td.RenderizadorGrafico()),
+    }
+    resultado = {}
+    for nome, grafico in variantes.items():
+        t0 = time.perf_counter()
+        for df in historicos:
+            grafico(df)
+        dt = time.perf_counter() - t0
+        resultado[nome] = n / dt
+        print(f"📊 {nome:<30} {n / dt:8.1f} gráficos/s")
+    return resultado
+
+
+# ------------------------------------------------------------
+# 7️⃣ Tabela de documentos: dataframe_to_html vs. o iterrows original
+# ------------------------------------------------------------
+def _dataframe_to_html_original(df):
+    """O dataframe_to_html original (cópia, rename, iterrows + `html +=`, sem escape), como referência."""
+    if df.empty:
+        return "<p style='font-size:13px;color:#6b7280;'>Nenhum documento encontrado.</p>"
+    colunas = ["DOCUMENTO", "DOCUMENTO_APROV_OBS2", "DOCUMENTO_APROV_REGULARIZA2", "STATUS_GERAL_Regra"]
+    df_exibir = df[[c for c in colunas if c in df.columns]].copy()
+    df_exibir.rename(columns=td._COLUNAS_DOC, inplace=True)
+    df_exibir["Observação"] = df_exibir["Observação"].astype(str).str.slice(0, 200)
+    df_exibir["Regularização"] = df_exibir["Regularização"].astype(str).str.slice(0, 200)
+    html = "<table style='width:100%;border-collapse:collapse;font-family:Arial,sans-serif;font-size:12px;'>"
+    html += "<thead><tr style='background:#001847;color:white;'>"
+    for col in df_exibir.columns:
+        html += f"<th style='padding:6px 8px;text-align:left;'>{col}</th>"
+    html += "</tr></thead><tbody>"
+    for _, row in df_exibir.iterrows():
+        html += "<tr style='border-bottom:1px solid #E5E7EB;'>"
+        for col in df_exibir.columns:
+            valor = row[col] if pd.notna(row[col]) else ""
+            html += f"<td style='padding:6px 8px;'>{valor}</td>"
+        html += "</tr>"
+    html += "</tbody></table>"
+    return html
+
+
+def benchmark_tabela_html(tamanhos=(10, 100, 1000), repeticoes=20):
+    """
+    Micro-benchmark do dataframe_to_html contra o original
+    (_dataframe_to_html_original), para 10/100/1000 documentos, sobre um
+    df_mes_atual com todas as colunas do SQL_COMPETENCIA.
+    """
+    resultado = {}
+    for n in tamanhos:
+        df = pd.DataFrame({
+            "PROJETO": ["Vallourec"] * n,
+            "COMPETENCIA": [COMPETENCIA_BENCHMARK] * n,
+            "Competencia_Data": [pd.Timestamp("2025-09-01").date()] * n,
+            "DOCUMENTO": [f"Documento {i}" for i in range(n)],
+            "PRESTADOR": ["Prestador"] * n,
+            "CNPJ_PRESTADOR": ["00000000000100"] * n,
+            "CONTRATO": ["CT-1"] * n,
+            "STATUS_GERAL_Regra": ["Não Conforme"] * n,
+            "CRITICO": ["1"] * n,
+            "RELEVANCIA": [f"{1 / max(n, 1):.6f}"] * n,
+            "DOCUMENTO_APROV_OBS2": ["Obs <pendente> & revisar " * 5] * n,
+            "DOCUMENTO_APROV_REGULARIZA2": ["Enviar nova versão"] * n,
+            "Chave_Composta": [f"CT-1|2025-09|Documento {i}" for i in range(n)],
+            "email_envio": ["a@x; b@x"] * n,
+        })
+        tempos = {}
+        for nome, fn in (("original", _dataframe_to_html_original), ("colunar", td.dataframe_to_html)):
+            t0 = time.perf_counter()
+            for _ in range(repeticoes):
+                fn(df)
+            tempos[nome] = (time.perf_counter() - t0) / repeticoes * 1000
+        resultado[n] = tempos
+        print(f"🧮 {n:>5} linhas: original {tempos['original']:8.2f} ms | "
+              f"colunar {tempos['colunar']:8.2f} ms | {tempos['original'] / tempos['colunar']:5.1f}x")
+    return resultado
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do disparo de pendências (dados sintéticos)")
+    parser.add_argument("--contratos", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--docs-por-contrato", type=int, default=12)
+    parser.add_argument("--meses", type=int, default=12, help="profundidade do histórico")
+    parser.add_argument("--saida", help="grava o resultado em JSON")
+    parser.add_argument("--envio", action="store_true",
+                        help="mede só a entrega (sync vs. async) em vez dos cenários completos")
+    parser.add_argument("--sessoes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--mensagens", type=int, default=400)
+    parser.add_argument("--atraso-ms", type=float, default=20.0,
+                        help="latência artificial do servidor local por mensagem (com --envio)")
+    parser.add_argument("--montagem", action="store_true",
+                        help="mede só a montagem + serialização das mensagens (msgs/s)")
+    parser.add_argument("--graficos", type=int, metavar="N",
+                        help="mede só o render de N gráficos (RenderizadorGrafico vs. pyplot)")
+    parser.add_argument("--tabela", action="store_true",
+                        help="mede só a tabela HTML de documentos (10/100/1000 linhas)")
+    args = parser.parse_args(argv)
+
+    if args.tabela:
+        resultados = benchmark_tabela_html()
+        if args.saida:
+            with open(args.saida, "w") as f:
+                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        return resultados
+
+    if args.graficos:
+        resultados = benchmark_graficos(args.graficos)
+        if args.saida:
+            with open(args.saida, "w") as f:
+                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        return resultados
+
+    if args.montagem:
+        resultados = benchmark_montagem(args.mensagens)
+        if args.saida:
+            with open(args.saida, "w") as f:
+                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        return resultados
+
+    if args.envio:
+        controller, contador, porta = iniciar_smtp_local(args.atraso_ms / 1000)
+        try:
+            resultados = benchmark_envio(porta, args.mensagens, args.sessoes)
+        finally:
+            controller.stop()
+        if args.saida:
+            with open(args.saida, "w") as f:
+                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        return resultados
+
+    controller, contador, porta = iniciar_smtp_local()
+    resultados = []
+    try:
+        # cada cenário num processo novo: pico de RSS isolado por tamanho; 'spawn'
+        # para não herdar a thread do servidor SMTP local (o cenário faz os seus forks)
+        ctx = multiprocessing.get_context("spawn")
+        for n in args.contratos:
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pp:
+                r = pp.submit(executar_cenario, n, porta, args.docs_por_contrato, args.meses).result()
+            resultados.append(r)
+            print(f"🏁 {n:>6} contratos: {r['duracao_s']:8.2f} s | {r['contratos_por_s']:8.1f} contratos/s | "
+                  f"pico RSS {r['pico_rss_mb']:8.1f} MB | {r['bytes_enviados'] / 1e6:8.1f} MB enviados")
+            for etapa, d in sorted(r["etapas_ms"].items(), key=lambda kv: -kv[1]["total"]):
+                print(f"     ⏱️ {etapa:<30} p50={d['p50']:8.2f} ms  p95={d['p95']:8.2f} ms  "
+                      f"total={d['total'] / 1000:8.2f} s")
+    finally:
+        controller.stop()
+
+    print(f"📬 Servidor local recebeu {contador.mensagens} mensagens ({contador.bytes / 1e6:.1f} MB)")
+    if args.saida:
+        with open(args.saida, "w") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+    return resultados
+
+
+if __name__ == "__main__":
+    main()
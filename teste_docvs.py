@@ -6,21 +6,35 @@
 
 # --- BLOCO 1: Conexão BigQuery ---
 
-from google.cloud import bigquery
 import os
 
-# Caminho para o arquivo de credenciais do BigQuery
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/home/metax/Documentos/Credencial/datalake_metax.json"
+# Caminho para o arquivo de credenciais do BigQuery (o ambiente tem precedência)
+BQ_CRED_PATH = "/home/metax/Documentos/Credencial/datalake_metax.json"
+
+# Criar cliente BigQuery (sob demanda: importar o módulo não conecta, não lê
+# credenciais nem importa google.cloud). Atribuir um cliente fake aqui (mesma
+# interface .query(...).result().to_arrow...) faz todas as consultas usarem ele.
+bq_client = None
+
+
+def _cliente_bq():
+    global bq_client
+    if bq_client is None:
+        from google.cloud import bigquery
+        os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", BQ_CRED_PATH)
+        bq_client = bigquery.Client()
+    return bq_client
 
-# Criar cliente BigQuery
-bq_client = bigquery.Client()
 
 # Testar conexão
-try:
-    bq_client.query("SELECT 1").result()
-    print("✅ Conexão BigQuery estabelecida com sucesso!")
-except Exception as e:
-    print(f"❌ Erro na conexão BigQuery: {e}")
+def testar_conexao_bq():
+    try:
+        _cliente_bq().query("SELECT 1").result()
+        print("✅ Conexão BigQuery estabelecida com sucesso!")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na conexão BigQuery: {e}")
+        return False
 
 
 # In[16]:
@@ -30,14 +44,20 @@ except Exception as e:
 # --- BLOCO 2 (atualizado): Consulta das pendências e cards ---
 # ============================================================
 
-import pandas as pd
-from google.cloud import bigquery
+import bisect
+import json
+import statistics
+import sys
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from types import SimpleNamespace
 
-# 🔹 Cliente BigQuery
-bq_client = bigquery.Client()
+import numpy as np
+import pandas as pd
 
-# 🔹 Parâmetro da competência alvo
-COMPETENCIA_ALVO = "2025-09"
 
 # 🔹 Nome da tabela no BigQuery
 TABELA = "datalake-metax.zz_Disparo_Docs.Cubo_Documentos"
@@ -149,39 +169,552 @@ FROM `{TABELA}`
 WHERE STATUS_GERAL_Regra IN ('Não Conforme', 'Não Enviado')
 """
 
+# ------------------------------------------------------------
+# 2️⃣c Variantes por lista de competências (para o cache local)
+# ------------------------------------------------------------
+# mesma agregação do SQL_CARDS, trocando a janela relativa por uma lista explícita
+SQL_CARDS_MESES = """
+WITH ultimas_5 AS (
+  SELECT COMPETENCIA FROM UNNEST(@competencias) AS COMPETENCIA
+),
+""" + SQL_CARDS[SQL_CARDS.index("base AS ("):]
+
+SQL_COMPETENCIA_MESES = SQL_COMPETENCIA.replace(
+    "WHERE COMPETENCIA = @competencia", "WHERE COMPETENCIA IN UNNEST(@competencias)"
+)
+
+SQL_PENDENCIAS_HIST_MESES = SQL_PENDENCIAS_HIST.rstrip() + """
+  AND COMPETENCIA IN UNNEST(@competencias)
+"""
+
+# ------------------------------------------------------------
+# 2️⃣d Histórico de pendências só dos contratos do envio, ordenado por contrato
+# ------------------------------------------------------------
+# ordenado pela mesma chave de texto "PROJETO|PRESTADOR|CONTRATO" dos lotes do
+# --streaming (ver chave_contrato_texto), para ser lido uma vez só junto com eles
+SQL_CHAVE_CONTRATO = "CONCAT(PROJETO, '|', PRESTADOR, '|', CAST(CONTRATO AS STRING))"
+SQL_PENDENCIAS_HIST_CONTRATOS = SQL_PENDENCIAS_HIST.rstrip() + f"""
+  AND {SQL_CHAVE_CONTRATO} IN UNNEST(@contratos)
+ORDER BY {SQL_CHAVE_CONTRATO}
+"""
+
+SQL_COMPETENCIAS_PENDENCIAS = f"""
+SELECT DISTINCT COMPETENCIA
+FROM `{TABELA}`
+WHERE STATUS_GERAL_Regra IN ('Não Conforme', 'Não Enviado')
+ORDER BY COMPETENCIA
+"""
+
+
+# ------------------------------------------------------------
+# ⏱️ Instrumentação por etapa (tempo, tamanhos, bytes enviados)
+# ------------------------------------------------------------
+class Metricas:
+    """
+    Coletor leve de métricas da execução:
+    - `etapa(nome)` (context manager) e `cronometrar(nome)` (decorator) medem tempo;
+    - `observar(nome, valor)` guarda tamanhos (ex.: bytes por mensagem);
+    - `contar(nome, valor)` acumula contadores (ex.: bytes enviados).
+    Desativado, `etapa` devolve um contexto nulo compartilhado e o decorator só
+    repassa a chamada (custo de um `if`).
+    Em processos filhos (fork), as amostras herdadas do pai são descartadas; o
+    filho devolve as suas com `drenar()` e o pai junta com `mesclar()`.
+    """
+
+    def __init__(self, ativo=True):
+        self.ativo = ativo
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._zerar()
+
+    def _zerar(self):
+        self._tempos = defaultdict(list)
+        self._valores = defaultdict(list)
+        self._contadores = defaultdict(float)
+
+    def _checar_processo(self):
+        if os.getpid() != self._pid:
+            self.apos_fork()
+
+    def apos_fork(self):
+        """No processo filho: lock novo e sem as amostras herdadas do pai."""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._zerar()
+
+    def registrar(self, nome, segundos):
+        with self._lock:
+            self._checar_processo()
+            self._tempos[nome].append(segundos)
+
+    def observar(self, nome, valor):
+        if not self.ativo:
+            return
+        with self._lock:
+            self._checar_processo()
+            self._valores[nome].append(valor)
+
+    def contar(self, nome, valor=1):
+        if not self.ativo:
+            return
+        with self._lock:
+            self._checar_processo()
+            self._contadores[nome] += valor
+
+    @contextmanager
+    def _cronometro(self, nome):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nome, time.perf_counter() - t0)
+
+    def etapa(self, nome):
+        return self._cronometro(nome) if self.ativo else _CONTEXTO_NULO
+
+    def cronometrar(self, nome=None):
+        def decorador(fn):
+            rotulo = nome or fn.__name__
+
+            @wraps(fn)
+            def medido(*args, **kwargs):
+                if not self.ativo:
+                    return fn(*args, **kwargs)
+                t0 = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.registrar(rotulo, time.perf_counter() - t0)
+            return medido
+        return decorador
+
+    def drenar(self):
+        """Entrega e zera as amostras deste processo (para enviar ao processo pai)."""
+        with self._lock:
+            self._checar_processo()
+            dados = (dict(self._tempos), dict(self._valores), dict(self._contadores))
+            self._zerar()
+        return dados
+
+    def mesclar(self, dados):
+        tempos, valores, contadores = dados
+        with self._lock:
+            for nome, lista in tempos.items():
+                self._tempos[nome].extend(lista)
+            for nome, lista in valores.items():
+                self._valores[nome].extend(lista)
+            for nome, valor in contadores.items():
+                self._contadores[nome] += valor
+
+    # limites (bytes) do histograma de tamanhos no Prometheus: 1 KiB a 64 MiB, ×4
+    BALDES_BYTES = tuple(2 ** k for k in range(10, 27, 2))
+
+    @staticmethod
+    def _distribuicao(lista, escala=1.0):
+        # percentis interpolados (mesmo método do numpy.percentile padrão)
+        if len(lista) > 1:
+            q = statistics.quantiles(lista, n=100, method="inclusive")
+            p50, p95 = q[49], q[94]
+        else:
+            p50 = p95 = lista[0]
+        return {
+            "n": len(lista), "total": sum(lista) * escala,
+            "p50": p50 * escala, "p95": p95 * escala, "max": max(lista) * escala,
+        }
+
+    def resumo(self):
+        with self._lock:
+            return {
+                # tempos em milissegundos
+                "etapas_ms": {n: self._distribuicao(l, 1000) for n, l in self._tempos.items() if l},
+                "tamanhos": {n: self._distribuicao(l) for n, l in self._valores.items() if l},
+                "contadores": dict(self._contadores),
+            }
+
+    def salvar_json(self, caminho, extra=None):
+        resumo = self.resumo()
+        resumo.update(extra or {})
+        os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+        with open(caminho, "w") as f:
+            json.dump(resumo, f, indent=2, ensure_ascii=False, default=str)
+        return resumo
+
+    def salvar_prometheus(self, caminho, prefixo="docvs"):
+        """
+        Formato textfile do node_exporter (escrita atômica via arquivo temporário):
+        etapas como summary (p50/p95/max), tamanhos como histograma em BALDES_BYTES
+        e contadores.
+        """
+        resumo = self.resumo()
+        linhas = [f"# TYPE {prefixo}_etapa_segundos summary"]
+        for nome, d in resumo["etapas_ms"].items():
+            for q, k in ((0.5, "p50"), (0.95, "p95"), (1.0, "max")):
+                linhas.append(f'{prefixo}_etapa_segundos{{etapa="{nome}",quantile="{q}"}} {d[k] / 1000:.6f}')
+            linhas.append(f'{prefixo}_etapa_segundos_sum{{etapa="{nome}"}} {d["total"] / 1000:.6f}')
+            linhas.append(f'{prefixo}_etapa_segundos_count{{etapa="{nome}"}} {d["n"]}')
+        # tamanhos (bytes por mensagem, por anexo): histograma, agregável entre execuções
+        with self._lock:
+            tamanhos = {n: sorted(l) for n, l in self._valores.items() if l}
+        if tamanhos:
+            linhas.append(f"# TYPE {prefixo}_tamanho_bytes histogram")
+        for nome, ordenados in tamanhos.items():
+            for limite in self.BALDES_BYTES:
+                linhas.append(f'{prefixo}_tamanho_bytes_bucket{{medida="{nome}",le="{limite}"}} '
+                              f"{bisect.bisect_right(ordenados, limite)}")
+            linhas.append(f'{prefixo}_tamanho_bytes_bucket{{medida="{nome}",le="+Inf"}} {len(ordenados)}')
+            linhas.append(f'{prefixo}_tamanho_bytes_sum{{medida="{nome}"}} {sum(ordenados):.15g}')
+            linhas.append(f'{prefixo}_tamanho_bytes_count{{medida="{nome}"}} {len(ordenados)}')
+        for nome, valor in resumo["contadores"].items():
+            linhas.append(f"# TYPE {prefixo}_{nome} counter")
+            linhas.append(f"{prefixo}_{nome} {valor:.15g}")   # :g cortaria a 6 dígitos (bytes)
+        with open(caminho + ".tmp", "w") as f:
+            f.write("\n".join(linhas) + "\n")
+        os.replace(caminho + ".tmp", caminho)
+
+    def imprimir(self):
+        for nome, d in self.resumo()["etapas_ms"].items():
+            print(f"⏱️ {nome:<26} n={d['n']:<6} p50={d['p50']:8.1f} ms  p95={d['p95']:8.1f} ms  "
+                  f"max={d['max']:8.1f} ms  total={d['total'] / 1000:7.1f} s")
+
+
+_CONTEXTO_NULO = nullcontext()
+METRICAS = Metricas(ativo=os.environ.get("DOCVS_METRICAS", "1") != "0")
+METRICAS_PROM_TEXTFILE = os.environ.get("DOCVS_PROM_TEXTFILE")   # opcional
 
 # ------------------------------------------------------------
 # 3️⃣ Função auxiliar para executar consultas parametrizadas
 # ------------------------------------------------------------
-def query_bq(sql, params):
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter(k, v["type"], v["value"])
-            for k, v in params.items()
-        ]
-    )
-    job = bq_client.query(sql, job_config=job_config)
-    return job.result().to_dataframe()
+# Leitura via BigQuery Storage Read API (Arrow), em vez da paginação REST do
+# tabledata.list + colunas object do to_dataframe(). O google-cloud-bigquery-storage
+# é opcional: sem ele, o to_arrow baixa pela API REST (mesmo resultado, mais lento).
+_BQSTORAGE_CLIENT = None   # None = ainda não tentou; False = pacote ausente
+
+
+def _bqstorage_client():
+    global _BQSTORAGE_CLIENT
+    if _BQSTORAGE_CLIENT is None:
+        try:
+            from google.cloud import bigquery_storage
+        except ImportError:
+            print("⚠️ google-cloud-bigquery-storage não instalado: leitura do BigQuery pela API REST")
+            _BQSTORAGE_CLIENT = False
+        else:
+            _BQSTORAGE_CLIENT = bigquery_storage.BigQueryReadClient()
+    return _BQSTORAGE_CLIENT or None
+
+
+def _tipo_pandas(tipo_arrow):
+    import pyarrow as pa
+    # dicionários viram `category` (padrão do to_pandas); o resto fica em dtypes pyarrow
+    if pa.types.is_dictionary(tipo_arrow):
+        return None
+    return pd.ArrowDtype(tipo_arrow)
+
+
+def _cliente_real(client):
+    """bigquery.Client de verdade? (só existe se quem o criou já importou o módulo)"""
+    bigquery = sys.modules.get("google.cloud.bigquery")
+    return bigquery is not None and isinstance(client, bigquery.Client)
+
+
+def _resultado_bq(sql, params, client):
+    client = client or _cliente_bq()
+    if _cliente_real(client):
+        # só o caminho do cliente real importa google.cloud.bigquery
+        from google.cloud import bigquery
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter(k, v["type"], list(v["value"]))
+                if isinstance(v["value"], (list, tuple))
+                else bigquery.ScalarQueryParameter(k, v["type"], v["value"])
+                for k, v in (params or {}).items()
+            ]
+        )
+        return client.query(sql, job_config=job_config).result()
+    # cliente injetado (fake): parâmetros com os mesmos atributos dos do
+    # google-cloud-bigquery (.name, .type_ e .values / .value), sem importá-lo
+    job_config = SimpleNamespace(query_parameters=[
+        SimpleNamespace(name=k, type_=v["type"], values=list(v["value"]))
+        if isinstance(v["value"], (list, tuple))
+        else SimpleNamespace(name=k, type_=v["type"], value=v["value"])
+        for k, v in (params or {}).items()
+    ])
+    return client.query(sql, job_config=job_config).result()
+
+
+@METRICAS.cronometrar()
+def query_bq(sql, params=None, client=None, bqstorage_client=None):
+    """
+    Executa a consulta e devolve um DataFrame com dtypes pyarrow.
+    `client`/`bqstorage_client` permitem injetar um cliente fake (que só precisa
+    de .query(...).result().to_arrow(...)/to_arrow_iterable(...)); com ele,
+    google.cloud não é importado. Sem `client`, vale o de _cliente_bq (o
+    `bq_client` global, que também pode ser um fake).
+    """
+    client = client or _cliente_bq()
+    if bqstorage_client is None and _cliente_real(client):
+        bqstorage_client = _bqstorage_client()
+    tabela = _resultado_bq(sql, params, client).to_arrow(bqstorage_client=bqstorage_client)
+    return tabela.to_pandas(types_mapper=_tipo_pandas)
+
+
+def query_bq_lotes(sql, params=None, client=None, bqstorage_client=None, arrow=False):
+    """
+    Modo iterador: um DataFrame por record batch do Storage Read API, para
+    processar resultados grandes (ex.: histórico de pendências) sem tê-los
+    inteiros em memória. Com `arrow`, os record batches vêm sem conversão.
+    """
+    client = client or _cliente_bq()
+    if bqstorage_client is None and _cliente_real(client):
+        bqstorage_client = _bqstorage_client()
+    for lote in _resultado_bq(sql, params, client).to_arrow_iterable(bqstorage_client=bqstorage_client):
+        yield lote if arrow else lote.to_pandas(types_mapper=_tipo_pandas)
+
 
 # ------------------------------------------------------------
-# 4️⃣ Executar consultas
+# 3️⃣a Colunas categóricas compartilhadas
 # ------------------------------------------------------------
-df_base = query_bq(SQL_COMPETENCIA, {"competencia": {"type": "STRING", "value": COMPETENCIA_ALVO}})
-df_cards = query_bq(SQL_CARDS, {"competencia": {"type": "STRING", "value": COMPETENCIA_ALVO}})
-df_pendencias_hist = bq_client.query(SQL_PENDENCIAS_HIST).result().to_dataframe()
+# Textos de baixa cardinalidade repetidos em todas as linhas: viram códigos
+# inteiros + um dicionário por coluna (o MESMO nos três frames)
+COLUNAS_CATEGORICAS = ["PROJETO", "PRESTADOR", "CONTRATO", "STATUS_GERAL_Regra", "COMPETENCIA", "email_envio"]
+
+
+def _unicos(serie):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return pd.Index(serie.cat.categories, dtype=object)
+    return pd.Index(serie.dropna().unique(), dtype=object)
+
+
+def categorizar_compartilhado(*dfs, colunas=COLUNAS_CATEGORICAS):
+    """
+    Converte `colunas` em pd.Categorical com as mesmas categorias (união dos
+    valores, ordenada) em todos os frames passados (None é ignorado/devolvido).
+    Filtros (==, isin) e groupby passam a comparar códigos inteiros, e chaves
+    iguais têm o mesmo código em df_base, df_cards e df_pendencias_hist.
+    Use groupby(..., observed=True) sobre essas colunas.
+    """
+    tipos = {}
+    for col in colunas:
+        unicos = [_unicos(df[col]) for df in dfs if df is not None and col in df.columns]
+        if unicos:
+            tipos[col] = pd.CategoricalDtype(unicos[0].append(unicos[1:]).unique().sort_values())
+    return tuple(
+        None if df is None else df.astype({c: t for c, t in tipos.items() if c in df.columns})
+        for df in dfs
+    )
+
+
+def _competencia_ym(serie):
+    """COMPETENCIA como 'YYYY-MM' (em categóricas, só o dicionário é convertido)."""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        categorias = serie.cat.categories.astype(str).str[:7]
+        if categorias.is_unique:
+            return serie.cat.rename_categories(categorias)
+    return serie.astype(str).str[:7]
+
+
+def _sem_categorias(df):
+    """Fatia pequena com as categóricas de volta a valores (não leva o dicionário inteiro no pickle)."""
+    cats = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    return df.astype({c: object for c in cats}) if cats else df
 
 # ------------------------------------------------------------
-# 5️⃣ Exibir prévias para verificação
+# 3️⃣b Cache local (Parquet) por competência
 # ------------------------------------------------------------
-print(f"📊 Registros encontrados para {COMPETENCIA_ALVO}: {len(df_base)}")
-print(f"📈 Registros no histórico (últimos 5 meses): {len(df_cards)}\n")
-print(f"📚 Pendências históricas carregadas: {len(df_pendencias_hist)} registros\n")
+class CacheCompetencias:
+    """
+    Snapshots locais do Cubo_Documentos em Parquet, uma partição por COMPETENCIA:
+        <raiz>/<nome>/COMPETENCIA=YYYY-MM.parquet  +  <raiz>/manifest.json
+    Competências fechadas são servidas do disco indefinidamente; as abertas
+    (mês alvo em diante) só valem por `ttl_horas` e depois são buscadas de novo.
+    """
+
+    def __init__(self, raiz, ttl_horas=12):
+        self.raiz = raiz
+        self.ttl_horas = ttl_horas
+        self._manifest_path = os.path.join(raiz, "manifest.json")
+        os.makedirs(raiz, exist_ok=True)
+        self.manifest = self._ler_manifest()
+
+    def _ler_manifest(self):
+        if not os.path.exists(self._manifest_path):
+            return {}
+        try:
+            with open(self._manifest_path, "r") as f:
+                manifest = json.load(f)
+        except ValueError:
+            return {}   # manifest corrompido: tudo volta ao BigQuery e é regravado
+        return manifest if isinstance(manifest, dict) else {}
+
+    def _salvar_manifest(self):
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, self._manifest_path)
+
+    def _arquivo(self, nome, competencia):
+        return os.path.join(self.raiz, nome, f"COMPETENCIA={competencia}.parquet")
+
+    def _valida(self, nome, competencia):
+        info = self.manifest.get(nome, {}).get(competencia)
+        if not isinstance(info, dict) or not os.path.exists(self._arquivo(nome, competencia)):
+            return False
+        if info.get("fechada") is True:
+            return True
+        try:
+            idade_h = (time.time() - info["gravado_em"]) / 3600
+        except (KeyError, TypeError):
+            return False   # entrada incompleta: rebusca
+        return idade_h < self.ttl_horas
+
+    def _gravar(self, nome, competencia, df, fechada):
+        arq = self._arquivo(nome, competencia)
+        os.makedirs(os.path.dirname(arq), exist_ok=True)
+        df.to_parquet(arq + ".tmp", index=False)
+        os.replace(arq + ".tmp", arq)
+        self.manifest.setdefault(nome, {})[competencia] = {
+            "linhas": int(len(df)), "gravado_em": time.time(), "fechada": bool(fechada),
+        }
+
+    def carregar(self, nome, competencias, buscar, abertas=(), forcar=False):
+        """
+        DataFrame com as `competencias` pedidas. Só as ausentes/expiradas (ou todas,
+        com `forcar`) são buscadas, numa única chamada `buscar(lista_competencias)`.
+        """
+        competencias = list(competencias)
+        abertas = set(abertas)
+        faltando = [c for c in competencias if forcar or not self._valida(nome, c)]
+        if faltando:
+            novo = buscar(faltando)
+            comp = novo["COMPETENCIA"].astype(str)
+            for c in faltando:
+                self._gravar(nome, c, novo[comp == c], fechada=c not in abertas)
+            self._salvar_manifest()
+            print(f"🗄️ Cache '{nome}': {len(faltando)} competência(s) buscada(s) no BigQuery, "
+                  f"{len(competencias) - len(faltando)} servida(s) do disco")
+
+        partes = [pd.read_parquet(self._arquivo(nome, c), dtype_backend="pyarrow") for c in competencias]
+        return pd.concat(partes, ignore_index=True)
+
+    def invalidar(self, nome=None, competencias=None):
+        """Remove partições (todas, de um `nome`, ou só as `competencias` indicadas)."""
+        for n in ([nome] if nome else list(self.manifest)):
+            for c in list(self.manifest.get(n, {})):
+                if competencias is None or c in competencias:
+                    if os.path.exists(self._arquivo(n, c)):
+                        os.remove(self._arquivo(n, c))
+                    del self.manifest[n][c]
+        self._salvar_manifest()
+
+    def podar(self, antes_de):
+        """Apaga partições com COMPETENCIA < `antes_de` ('YYYY-MM')."""
+        for n, comps in self.manifest.items():
+            self.invalidar(n, [c for c in comps if c < antes_de])
+
+    def inspecionar(self):
+        """Uma linha por partição: nome, competência, linhas, tamanho, idade, fechada."""
+        linhas = []
+        for n, comps in self.manifest.items():
+            for c, info in sorted(comps.items()):
+                arq = self._arquivo(n, c)
+                linhas.append({
+                    "nome": n, "COMPETENCIA": c, "linhas": info["linhas"],
+                    "bytes": os.path.getsize(arq) if os.path.exists(arq) else 0,
+                    "idade_h": round((time.time() - info["gravado_em"]) / 3600, 1),
+                    "fechada": info["fechada"],
+                })
+        return pd.DataFrame(linhas)
+
+
+CACHE_DIR = os.environ.get("DOCVS_CACHE_DIR", os.path.expanduser("~/.cache/docvs"))
+CACHE_TTL_HORAS = 12
+INVALIDAR_CACHE = False   # True = ignora o disco e rebusca tudo
+# (com HIST_FILTRADO_POR_CONTRATO o histórico completo não é carregado: é lido em
+#  streaming só para os contratos do envio)
+HIST_FILTRADO_POR_CONTRATO = True
+
+def _memoria_frames(*dfs):
+    return sum(int(df.memory_usage(deep=True).sum()) for df in dfs if df is not None)
+
+
+def intervalo_competencias(inicio, fim=None):
+    """['YYYY-MM', ...] de `inicio` a `fim` (inclusive); sem `fim`, só `inicio`."""
+    return [str(p) for p in pd.period_range(inicio, fim or inicio, freq="M")]
+
+
+def carregar_dados(competencia, cache=None, forcar=INVALIDAR_CACHE, verbose=True):
+    """
+    Consulta a(s) competência(s) de envio, os cards das 5 competências até cada
+    uma e (sem HIST_FILTRADO_POR_CONTRATO) o histórico de pendências, passando
+    pelo cache. `competencia` pode ser uma lista (backfill): tudo é carregado
+    UMA vez sobre a janela que cobre todos os meses (mês mais antigo - 4 até o
+    mais recente) e cada mês deriva o seu histórico dessa mesma tabela.
+    Retorna (df_base, df_cards, df_pendencias_hist); df_pendencias_hist é None
+    no modo filtrado.
+    """
+    if cache is None:
+        cache = CacheCompetencias(CACHE_DIR, ttl_horas=CACHE_TTL_HORAS)
+    competencias = [competencia] if isinstance(competencia, str) else sorted(competencia)
+    competencia = competencias[0]   # a partir dela as competências são tratadas como abertas
+
+    # ------------------------------------------------------------
+    # 4️⃣ Executar consultas
+    # ------------------------------------------------------------
+    if len(competencias) == 1:
+        df_base = query_bq(SQL_COMPETENCIA, {"competencia": {"type": "STRING", "value": competencia}})
+    else:
+        df_base = query_bq(SQL_COMPETENCIA_MESES, {"competencias": {"type": "STRING", "value": competencias}})
+
+    # 🔹 cards: 5 competências até a alvo (no backfill, a união das janelas);
+    #    só a(s) aberta(s) voltam ao BigQuery
+    competencias_cards = intervalo_competencias(str(pd.Period(competencia, freq="M") - 4), competencias[-1])
+    df_cards = cache.carregar(
+        "cards", competencias_cards,
+        lambda meses: query_bq(SQL_CARDS_MESES, {"competencias": {"type": "STRING", "value": meses}}),
+        abertas=[c for c in competencias_cards if c >= competencia],
+        forcar=forcar,
+    )
 
-print("🔹 Prévia df_base (competência atual):")
-print(df_base.head(10))
-print("\n---\n")
-print("🔹 Prévia df_cards (últimos 5 meses):")
-print(df_cards.head(10))
+    # 🔹 histórico de pendências: todas as competências, idem
+    # (com HIST_FILTRADO_POR_CONTRATO, o histórico não é carregado aqui: é lido em
+    #  streaming só para os contratos do envio, separado por contrato para os anexos)
+    df_pendencias_hist = None
+    if not HIST_FILTRADO_POR_CONTRATO:
+        competencias_hist = [
+            str(c) for c in query_bq(SQL_COMPETENCIAS_PENDENCIAS)["COMPETENCIA"].dropna()
+        ]
+        df_pendencias_hist = cache.carregar(
+            "pendencias_hist", competencias_hist,
+            lambda meses: query_bq(SQL_PENDENCIAS_HIST_MESES, {"competencias": {"type": "STRING", "value": meses}}),
+            abertas=[c for c in competencias_hist if c >= competencia],
+            forcar=forcar,
+        )
+
+    # 🔹 textos repetidos → categorias compartilhadas entre os três frames
+    memoria_antes = _memoria_frames(df_base, df_cards, df_pendencias_hist) if verbose else 0
+    with METRICAS.etapa("categorizar"):
+        df_base["COMPETENCIA"] = _competencia_ym(df_base["COMPETENCIA"])
+        df_base, df_cards, df_pendencias_hist = categorizar_compartilhado(df_base, df_cards, df_pendencias_hist)
+
+    # ------------------------------------------------------------
+    # 5️⃣ Exibir prévias para verificação
+    # ------------------------------------------------------------
+    if verbose:
+        memoria_depois = _memoria_frames(df_base, df_cards, df_pendencias_hist)
+        print(f"🗜️ Memória dos frames: {memoria_antes / 2**20:.1f} MB → {memoria_depois / 2**20:.1f} MB "
+              f"(colunas categóricas)")
+        print(f"📊 Registros encontrados para {', '.join(competencias)}: {len(df_base)}")
+        print(f"📈 Registros no histórico ({len(competencias_cards)} meses): {len(df_cards)}\n")
+        if df_pendencias_hist is not None:
+            print(f"📚 Pendências históricas carregadas: {len(df_pendencias_hist)} registros\n")
+
+        print("🔹 Prévia df_base (competência atual):")
+        print(df_base.head(10))
+        print("\n---\n")
+        print("🔹 Prévia df_cards (últimos 5 meses):")
+        print(df_cards.head(10))
+
+    return df_base, df_cards, df_pendencias_hist
 
 
 # In[17]:
@@ -191,20 +724,28 @@ print(df_cards.head(10))
 # 🧠 BLOCO 1: IMPORTAÇÕES E CONFIGURAÇÕES INICIAIS
 # ============================================================
 
-import base64
-import matplotlib.pyplot as plt
+import asyncio
 import io
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
+import queue
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from email import policy
+from email.generator import BytesGenerator
+from email.message import EmailMessage, MIMEPart
 from datetime import datetime
 from dateutil import tz
-import pandas as pd
-import numpy as np
-from scipy.interpolate import make_interp_spline
-import json
 import re
+import hashlib
+import operator
+import tempfile
+import sqlite3
+import gzip
+import zipfile
+import random
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from html import escape
 
 # 🎨 Paleta Meta.X
 COR_PRINCIPAL = "#001847"
@@ -214,26 +755,151 @@ COR_LINHA_SUAVE = "#93C5FD"
 COR_LINHA_FORTE = "#1E3A8A"
 TZ_BRA = tz.gettz("America/Sao_Paulo")
 
+# 🎨 Cores por legenda
+CORES_LEGENDA = {
+    "Atende": "#16A34A", "Atende Parcial": "#FACC15",
+    "Não Atende": "#DC2626", "Crítico": "#7F1D1D",
+    "Baixa Performance": "#F97316", "Sem dados": "#6B7280",
+}
+
 # Caminhos e credenciais
 EMAIL_CRED_PATH = "/home/metax/Documentos/Credencial/emailcredential.json"
-LOGO_PATH = "/home/metax/Documentos/Credencial/logo.png"
+LOGO_PATH = os.environ.get("DOCVS_LOGO", "/home/metax/Documentos/Credencial/logo.png")
+
+SMTP_SERVER = SMTP_PORT = SMTP_USER = SMTP_PASS = SMTP_FROM = None
+SMTP_POOL_TAMANHO, SMTP_MSGS_POR_SESSAO, SMTP_TAXA_MAX = 2, 100, None
+SMTP_FILA_MAX = 64
+# "sync" (PoolSMTP: smtplib, uma thread por mensagem em voo) ou
+# "async" (EnvioAssincrono: aiosmtplib, N sessões num event loop + fila limitada)
+BACKEND_ENVIO = os.environ.get("DOCVS_BACKEND_ENVIO", "sync")
+RENDER_WORKERS = os.cpu_count()
+# serialização das mensagens: como policy.SMTP (CRLF, cabeçalhos ASCII/RFC 2047, aceita
+# por qualquer servidor); com DOCVS_SMTPUTF8=1, como policy.SMTPUTF8 (cabeçalhos em
+# UTF-8 puro, exige a extensão SMTPUTF8 no servidor)
+USAR_SMTPUTF8 = os.environ.get("DOCVS_SMTPUTF8") == "1"
+
+
+def configurar_smtp(cred):
+    """Aplica as credenciais/limites de SMTP (do arquivo JSON, ou de um servidor local no benchmark)."""
+    global SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASS, SMTP_FROM
+    global SMTP_POOL_TAMANHO, SMTP_MSGS_POR_SESSAO, SMTP_TAXA_MAX, SMTP_FILA_MAX
+    SMTP_SERVER, SMTP_PORT = cred["smtp_server"], cred["smtp_port"]
+    SMTP_USER, SMTP_PASS = cred.get("smtp_user"), cred.get("smtp_password")
+    SMTP_FROM = cred.get("smtp_from", SMTP_USER)
+    SMTP_POOL_TAMANHO = int(cred.get("smtp_pool_tamanho", 2))
+    SMTP_MSGS_POR_SESSAO = int(cred.get("smtp_msgs_por_sessao", 100))
+    SMTP_TAXA_MAX = cred.get("smtp_taxa_max")   # msgs/s por servidor (None = sem limite até o 1º 4xx)
+    SMTP_FILA_MAX = int(cred.get("smtp_fila_max", 64))   # mensagens prontas aguardando (backend async)
+
+
+def carregar_credenciais_smtp(caminho=EMAIL_CRED_PATH):
+    """Lê o JSON de credenciais e aplica via configurar_smtp (só quando vai enviar)."""
+    with open(caminho, "r") as f:
+        configurar_smtp(json.load(f))
+
+
+# ============================================================
+# 🖼️ BLOCO 1.1: ATIVOS ESTÁTICOS (logo e imagens fixas, uma vez por execução)
+# ============================================================
+
+_CABECALHOS_FIXOS = frozenset({"from", "mime-version", "content-type", "content-transfer-encoding",
+                               "content-disposition", "content-id"})
+
+
+@lru_cache(maxsize=4096)
+def _cabecalho_interpretado(politica, nome, valor):
+    return policy.EmailPolicy.header_store_parse(politica, nome, valor)
+
+
+@lru_cache(maxsize=4096)
+def _cabecalho_dobrado(politica, nome, valor):
+    return policy.EmailPolicy.fold_binary(politica, nome, valor)
+
+
+class PoliticaEmail(policy.EmailPolicy):
+    """
+    EmailPolicy que interpreta (header_store_parse) e dobra (fold_binary) UMA
+    vez cada cabeçalho estrutural repetido entre mensagens: as partes só mudam
+    no corpo, e o registro de cabeçalhos do pacote email é a maior parte do
+    custo de montar/serializar. To/Subject seguem o caminho normal.
+    Os caches são lru_cache por (política, nome, valor), limitados.
+    """
 
-with open(EMAIL_CRED_PATH, "r") as f:
-    cred = json.load(f)
-SMTP_SERVER, SMTP_PORT = cred["smtp_server"], cred["smtp_port"]
-SMTP_USER, SMTP_PASS = cred["smtp_user"], cred["smtp_password"]
-SMTP_FROM = cred.get("smtp_from", SMTP_USER)
+    def header_store_parse(self, name, value):
+        if isinstance(value, str) and not hasattr(value, "name") and name.lower() in _CABECALHOS_FIXOS:
+            return _cabecalho_interpretado(self, name, value)
+        return super().header_store_parse(name, value)
 
-with open(LOGO_PATH, "rb") as f:
-    LOGO_B64 = base64.b64encode(f.read()).decode("utf-8")
+    def fold_binary(self, name, value):
+        if name.lower() in _CABECALHOS_FIXOS:
+            return _cabecalho_dobrado(self, name, value)
+        return super().fold_binary(name, value)
+
+
+POLITICA_EMAIL = PoliticaEmail(linesep="\r\n", utf8=USAR_SMTPUTF8)
+
+
+class RegistroAtivos:
+    """
+    Partes inline estáticas (logo, imagens fixas) lidas do disco e codificadas
+    em base64 UMA vez (em precarregar(), antes do fork dos workers, ou na
+    primeira vez em que são pedidas). Cada mensagem anexa
+    a mesma parte pronta por referência, sem reler o arquivo nem recodificar.
+    """
+
+    def __init__(self):
+        self._fontes = {}
+        self._partes = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, cid, caminho, subtipo="png", nome_arquivo=None):
+        self._fontes[cid] = (caminho, subtipo, nome_arquivo or os.path.basename(caminho))
+        self._partes.pop(cid, None)
+
+    def precarregar(self):
+        """
+        Lê e codifica todas as partes registradas agora, no processo principal:
+        chamado antes do fork dos workers de render, que herdam as partes prontas
+        (sem cada worker reler o arquivo). Um arquivo ausente só gera um aviso
+        aqui; o erro aparece na mensagem que precisar da parte.
+        """
+        for cid in list(self._fontes):
+            try:
+                self.parte(cid)
+            except OSError as e:
+                print(f"⚠️ Ativo '{cid}' indisponível: {e}")
+
+    def apos_fork(self):
+        """No worker recém-criado: lock novo (o herdado pode ter vindo travado por outra thread)."""
+        self._lock = threading.Lock()
+
+    def parte(self, cid):
+        parte = self._partes.get(cid)
+        if parte is None:
+            with self._lock:
+                parte = self._partes.get(cid)
+                if parte is None:
+                    caminho, subtipo, nome_arquivo = self._fontes[cid]
+                    with open(caminho, "rb") as f:
+                        parte = MIMEPart(policy=POLITICA_EMAIL)
+                        parte.set_content(f.read(), "image", subtipo, cid=f"<{cid}>",
+                                          disposition="inline", filename=nome_arquivo)
+                    self._partes[cid] = parte
+        return parte
+
+
+ATIVOS = RegistroAtivos()
+ATIVOS.registrar("logo_metax", LOGO_PATH, "png", "logo_metax.png")
 
 
 # ============================================================
 # 📊 BLOCO 2: (MANTER O SEU BLOCO DE CONSULTAS NO BQ)
 # ============================================================
 
-COMPETENCIA_REF_STR = "2025-09"   # 'YYYY-MM'
-COMPETENCIA_REF_DT  = pd.to_datetime(COMPETENCIA_REF_STR + "-01")
+def competencia_padrao(agora=None):
+    """Competência de envio padrão: o mês anterior ao atual (horário de Brasília), 'YYYY-MM'."""
+    agora = agora or datetime.now(TZ_BRA)
+    return str(pd.Period(agora.strftime("%Y-%m"), freq="M") - 1)
 
 # ============================================================
 # 🔧 BLOCO 2.1: Helpers de HISTÓRICO (preenche 5 meses com zero)
@@ -243,30 +909,63 @@ def _lista_ultimos_5_meses(competencia_ref_str: str):
     end = pd.Period(competencia_ref_str, freq="M")
     return [str((end - i).strftime("%Y-%m")) for i in range(4, -1, -1)]
 
-ULTIMOS_5 = _lista_ultimos_5_meses(COMPETENCIA_REF_STR)
+CHAVE_CONTRATO = ["PROJETO", "PRESTADOR", "CONTRATO"]
 
-def historico_5_meses(df_cards_bq, projeto, prestador, contrato):
-    # base com as 5 competências alvo no formato YYYY-MM
-    base = pd.DataFrame({"COMPETENCIA": ULTIMOS_5})
 
-    # 🔹 pega do df_cards as colunas que precisamos
-    sub = df_cards_bq[
-        (df_cards_bq["PROJETO"] == projeto)
-        & (df_cards_bq["PRESTADOR"] == prestador)
-        & (df_cards_bq["CONTRATO"] == contrato)
-    ][["COMPETENCIA", "total_pendencias", "total_criticos", "perc_atingido"]].copy()
+class IndiceContratos:
+    """
+    Índice montado UMA vez sobre um DataFrame, por (PROJETO, PRESTADOR, CONTRATO).
+    Usa `groupby(...).indices` (posições de cada chave), então a fatia de um
+    contrato sai por lookup em dicionário em vez de varrer o frame inteiro com
+    máscaras booleanas a cada grupo. Com chaves categóricas o agrupamento é
+    feito sobre os códigos (observed=True: só as combinações presentes).
+    """
+
+    def __init__(self, df, chaves=CHAVE_CONTRATO):
+        self.df = df
+        self.chaves = list(chaves)
+        self._posicoes = df.groupby(self.chaves, sort=False, dropna=False, observed=True).indices
+
+    def __len__(self):
+        return len(self._posicoes)
+
+    def __contains__(self, chave):
+        return tuple(chave) in self._posicoes
+
+    def fatia(self, *chave):
+        """Linhas do contrato (vazio, com as mesmas colunas, se não existir)."""
+        pos = self._posicoes.get(tuple(chave))
+        if pos is None:
+            return self.df.iloc[0:0]
+        return self.df.iloc[pos]
+
+
+@METRICAS.cronometrar()
+def historico_5_meses(df_cards_bq, projeto, prestador, contrato, indice=None, *, ultimos_5):
+    # base com as 5 competências alvo no formato YYYY-MM (ver _lista_ultimos_5_meses)
+    base = pd.DataFrame({"COMPETENCIA": ultimos_5})
 
-    # normaliza competência
-    sub["COMPETENCIA"] = sub["COMPETENCIA"].astype(str).str[:7]
+    # 🔹 pega do df_cards as colunas que precisamos (via índice, se houver)
+    if indice is not None:
+        sub = indice.fatia(projeto, prestador, contrato)
+    else:
+        sub = df_cards_bq[
+            (df_cards_bq["PROJETO"] == projeto)
+            & (df_cards_bq["PRESTADOR"] == prestador)
+            & (df_cards_bq["CONTRATO"] == contrato)
+        ]
+    # normaliza competência (como chave do groupby: sem copiar a fatia para reescrever a coluna)
+    competencia = _competencia_ym(sub["COMPETENCIA"]).rename("COMPETENCIA")
 
     # como o SQL já entrega 1 linha por (projeto, prestador, contrato, competência),
     # este groupby é apenas por segurança (se houver duplicidade, somamos contagens e
     # pegamos o maior percentual atingido da competência)
-    sub = sub.groupby("COMPETENCIA", as_index=False).agg({
+    sub = sub.groupby(competencia, observed=True)[["total_pendencias", "total_criticos", "perc_atingido"]].agg({
         "total_pendencias": "sum",
         "total_criticos": "sum",
         "perc_atingido": "max"
-    })
+    }).reset_index()
+    sub["COMPETENCIA"] = sub["COMPETENCIA"].astype(str)
 
     # junta nas 5 competências (preenchendo faltas com zero)
     out = base.merge(sub, on="COMPETENCIA", how="left")
@@ -283,40 +982,227 @@ def historico_5_meses(df_cards_bq, projeto, prestador, contrato):
 # 🎨 BLOCO 3: FUNÇÕES AUXILIARES (gráficos, HTML e regras)
 # ============================================================
 
-def gerar_grafico(df_cards_hist5):
-    if df_cards_hist5.empty:
-        return None
-    sub = df_cards_hist5.sort_values("COMPETENCIA")
-    x = np.arange(len(sub))
-    y = sub["total_pendencias"].astype(float).values
-    competencias = sub["COMPETENCIA"].astype(str).values
-    plt.figure(figsize=(5.2, 2.2), dpi=160)
-    ax = plt.gca()
-    if len(x) >= 3 and len(np.unique(y)) > 1:
-        x_smooth = np.linspace(x.min(), x.max(), 150)
-        try:
-            y_smooth = make_interp_spline(x, y, k=2)(x_smooth)
-            plt.plot(x_smooth, y_smooth, color=COR_LINHA_FORTE, linewidth=1.8)
-            plt.fill_between(x_smooth, y_smooth, color=COR_LINHA_SUAVE, alpha=0.2)
-        except Exception:
-            plt.plot(x, y, color=COR_LINHA_FORTE, linewidth=1.8)
+FORMATO_GRAFICO = "png"   # "png" (padrão, aceito por todos os clientes) ou "svg"
+_SUBTIPO_GRAFICO = {"png": "png", "svg": "svg+xml"}
+
+
+class RenderizadorGrafico:
+    """
+    Gráfico de pendências sem pyplot: uma única Figure/FigureCanvasAgg é
+    reaproveitada entre chamadas (só limpa e redesenha) e o resultado é
+    memoizado pela série (competências + valores + formato), já que muitos
+    contratos compartilham o mesmo histórico (ex.: tudo zero).
+    """
+
+    def __init__(self, cache_max=1024, reutilizar_figura=True):
+        self.cache_max = cache_max
+        self.reutilizar_figura = reutilizar_figura
+        self._cache = OrderedDict()
+        self._fig = None
+        self._lock = threading.Lock()
+        self.acertos = self.falhas = 0
+
+    def apos_fork(self):
+        """No worker recém-criado: lock novo (o herdado pode ter vindo travado por outra thread)."""
+        self._lock = threading.Lock()
+
+    def _figura(self):
+        if self._fig is None or not self.reutilizar_figura:
+            # matplotlib só é importado quando o primeiro gráfico é desenhado
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self._fig = Figure(figsize=(5.2, 2.2), dpi=160)
+            FigureCanvasAgg(self._fig)
+        else:
+            self._fig.clf()
+        return self._fig
+
+    def _desenhar(self, competencias, y, formato):
+        fig = self._figura()
+        ax = fig.add_subplot()
+        x = np.arange(len(y))
+        if len(x) >= 3 and len(np.unique(y)) > 1:
+            x_smooth = np.linspace(x.min(), x.max(), 150)
+            try:
+                from scipy.interpolate import make_interp_spline
+                y_smooth = make_interp_spline(x, y, k=2)(x_smooth)
+                ax.plot(x_smooth, y_smooth, color=COR_LINHA_FORTE, linewidth=1.8, zorder=2)
+                ax.fill_between(x_smooth, y_smooth, color=COR_LINHA_SUAVE, alpha=0.2, zorder=1)
+            except Exception:
+                ax.plot(x, y, color=COR_LINHA_FORTE, linewidth=1.8, zorder=2)
+        else:
+            ax.plot(x, y, color=COR_LINHA_FORTE, linewidth=1.8, zorder=2)
+
+        ax.scatter(x, y, color=COR_PRINCIPAL, s=26, zorder=3)
+        y_min, y_max = y.min(), y.max()
+        margem = max(0.5, (y_max - y_min) * 0.3)
+        ax.set_ylim(y_min - 0.2, y_max + margem)
+        for xi, yi in zip(x, y):
+            ax.text(xi, yi + 0.1, f"{int(yi)}", ha="center", va="bottom",
+                    fontsize=7.5, color=COR_PRINCIPAL, fontweight="medium")
+        ax.set_xticks(x, competencias, fontsize=8.5, color="#374151")
+        ax.set_yticks([])
+        ax.spines["top"].set_visible(False)
+        ax.spines["right"].set_visible(False)
+        ax.spines["left"].set_visible(False)
+        ax.spines["bottom"].set_color("#D1D5DB")
+        ax.grid(axis="y", linestyle="--", alpha=0.25, linewidth=0.5)
+        ax.set_title("Pendências nas últimas competências", fontsize=9.5, color=COR_PRINCIPAL, pad=8)
+        fig.tight_layout()
+        buf = io.BytesIO()
+        fig.savefig(buf, format=formato, bbox_inches="tight", transparent=True)
+        return buf.getvalue()
+
+    def renderizar(self, competencias, valores, formato=None):
+        """Bytes do gráfico (png/svg) para a série informada (padrão: FORMATO_GRAFICO no momento da chamada)."""
+        formato = formato or FORMATO_GRAFICO
+        if formato not in _SUBTIPO_GRAFICO:
+            raise ValueError(f"Formato de gráfico não suportado: {formato}")
+        competencias = tuple(str(c) for c in competencias)
+        y = np.asarray(valores, dtype=float)
+        chave = (competencias, tuple(y.tolist()), formato)
+        with self._lock:
+            dados = self._cache.get(chave)
+            if dados is not None:
+                self._cache.move_to_end(chave)
+                self.acertos += 1
+                return dados
+            self.falhas += 1
+            dados = self._desenhar(competencias, y, formato)
+            self._cache[chave] = dados
+            if len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+        return dados
+
+
+GRAFICOS = RenderizadorGrafico()
+
+
+# ============================================================
+# 📐 BLOCO 3.0: REGRAS DE % ATINGIDO E LEGENDA (como dados)
+# ============================================================
+
+# 🔹 Status que contam como "conforme" por projeto (demais projetos: só "Conforme")
+STATUS_CONFORME_PADRAO = ["Conforme"]
+STATUS_CONFORME = {
+    "Reparação Bacia do Rio Doce": ["Conforme", "Em Análise"],
+    "Samarco - COA": ["Conforme", "Em Análise"],
+}
+
+# 🔹 Faixas de legenda por projeto: lista ORDENADA de (campo, operador, limite, legenda),
+#    vale a primeira que casar; se nenhuma casar, usa "senao".
+#    campo: "perc" (% atingido, 0–1) ou "critico" (nº de Não Conforme críticos).
+#    Para um cliente novo basta incluir uma entrada aqui.
+_REGRA_FLORESTAL = {
+    "faixas": [
+        ("perc", "<", 0.5, "Crítico"),
+        ("critico", ">=", 1, "Não Atende"),
+        ("perc", ">=", 0.8, "Atende"),
+        ("perc", ">=", 0.5, "Não Atende"),
+    ],
+    "senao": "Crítico",
+}
+REGRAS_LEGENDA = {
+    "Vallourec": {
+        "faixas": [
+            ("perc", "<=", 0.9, "Não Atende"),
+            ("critico", ">=", 1, "Não Atende"),
+            ("perc", ">", 0.99, "Atende"),
+            ("perc", ">=", 0.9, "Atende Parcial"),
+        ],
+        "senao": "Não Atende",
+    },
+    "MSFC FLORESTAL LTDA": _REGRA_FLORESTAL,
+    "BRACELL BAHIA FLORESTAL": _REGRA_FLORESTAL,
+    "BRACELL BAHIA SPECIALTY CELLULOSE": _REGRA_FLORESTAL,
+    "Projeto Sucuriú": {
+        "faixas": [
+            ("perc", "<=", 0.7, "Crítico"),
+            ("critico", ">=", 1, "Não Atende"),
+            ("perc", ">=", 0.93, "Atende"),
+            ("perc", ">=", 0.8, "Atende Parcial"),
+            ("perc", ">=", 0.7, "Baixa Performance"),
+        ],
+        "senao": "Não Atende",
+    },
+}
+REGRA_LEGENDA_PADRAO = {
+    "faixas": [
+        ("perc", ">=", 0.99, "Atende"),
+        ("perc", "<=", 0.9, "Crítico"),
+        ("perc", "<=", 0.96, "Não Atende"),
+    ],
+    "senao": "Atende Parcial",
+}
+
+_OPERADORES = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+CHAVE_KPI = ["PROJETO", "PRESTADOR", "CONTRATO", "COMPETENCIA"]
+
+
+def _como_bool(serie):
+    """Série booleana (possivelmente com NA) → ndarray bool, NA = False."""
+    return serie.fillna(False).to_numpy(dtype=bool)
+
+
+def _componentes_kpi(df, projetos):
+    """
+    Por linha: relevância que conta como conforme e flag de crítico pendente.
+    `projetos` pode ser um nome único (str) ou uma Série alinhada a `df`.
+    """
+    relevancia = pd.to_numeric(df["RELEVANCIA"], errors="coerce").fillna(0.0).to_numpy(dtype=float)
+    status = df["STATUS_GERAL_Regra"]
+
+    if isinstance(projetos, str):
+        conforme = status.isin(STATUS_CONFORME.get(projetos, STATUS_CONFORME_PADRAO)).to_numpy(dtype=bool)
     else:
-        plt.plot(x, y, color=COR_LINHA_FORTE, linewidth=1.8)
-    plt.scatter(x, y, color=COR_PRINCIPAL, s=26)
-    for xi, yi in zip(x, y):
-        plt.text(xi, yi + 0.1, f"{int(yi)}", ha="center", va="bottom", fontsize=7.5, color=COR_PRINCIPAL)
-    plt.xticks(x, competencias, fontsize=8.5, color="#374151")
-    plt.yticks([])
-    for side in ["top", "right", "left"]:
-        ax.spines[side].set_visible(False)
-    ax.spines["bottom"].set_color("#D1D5DB")
-    plt.grid(axis="y", linestyle="--", alpha=0.25)
-    plt.title("Pendências nas últimas competências", fontsize=9.5, color=COR_PRINCIPAL)
-    plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight", transparent=True)
-    plt.close()
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+        conforme = status.isin(STATUS_CONFORME_PADRAO).to_numpy(dtype=bool)
+        for projeto, lista in STATUS_CONFORME.items():
+            conforme = np.where(_como_bool(projetos == projeto),
+                                status.isin(lista).to_numpy(dtype=bool), conforme)
+
+    critico = _como_bool(status == "Não Conforme") & _como_bool(df["CRITICO"].astype(str) == "1")
+    return np.where(conforme, relevancia, 0.0), critico
+
+
+def legenda_vetorizada(projetos, perc, critico):
+    """
+    Aplica as faixas de REGRAS_LEGENDA a vetores alinhados (projeto, perc, critico)
+    de uma só vez com np.select. Retorna ndarray de legendas (object).
+    """
+    codigos, unicos = pd.factorize(pd.Series(projetos), use_na_sentinel=False)
+    valores = {"perc": np.asarray(perc, dtype=float), "critico": np.asarray(critico)}
+
+    condicoes, escolhas = [], []
+    for k, projeto in enumerate(unicos):
+        regra = REGRAS_LEGENDA.get(projeto, REGRA_LEGENDA_PADRAO)
+        do_projeto = codigos == k
+        for campo, op, limite, legenda in regra["faixas"]:
+            condicoes.append(do_projeto & _OPERADORES[op](valores[campo], limite))
+            escolhas.append(legenda)
+        condicoes.append(do_projeto)
+        escolhas.append(regra["senao"])
+
+    if not condicoes:
+        return np.array([], dtype=object)
+    return np.select(condicoes, escolhas, default="Sem dados").astype(object)
+
+
+def calcular_kpis_lote(df, chaves=CHAVE_KPI):
+    """
+    % atingido, nº de críticos e legenda de TODOS os (contrato, competência) numa
+    passada só: soma por groupby + faixas via np.select.
+    Retorna um DataFrame com `chaves` + perc, criticos, legenda.
+    """
+    chaves = list(chaves)
+    if df.empty:
+        return pd.DataFrame(columns=chaves + ["perc", "criticos", "legenda"])
+
+    relevancia_conforme, critico = _componentes_kpi(df, df["PROJETO"])
+    aux = pd.DataFrame({"perc": relevancia_conforme, "criticos": critico.astype(int)}, index=df.index)
+    kpis = aux.groupby([df[c] for c in chaves], sort=False, dropna=False, observed=True).sum().reset_index()
+    kpis["legenda"] = legenda_vetorizada(kpis["PROJETO"], kpis["perc"], kpis["criticos"])
+    return kpis
 
 
 def calcular_relevancia_e_legenda(df_mes_atual, projeto):
@@ -324,78 +1210,16 @@ def calcular_relevancia_e_legenda(df_mes_atual, projeto):
     Regras de negócio por projeto para % atingido e legenda.
     Entrada: df_mes_atual = registros da competência do envio.
     Campos usados: STATUS_GERAL_Regra, CRITICO, RELEVANCIA
+    (Atalho de um contrato só sobre o mesmo motor de calcular_kpis_lote.)
     """
     if df_mes_atual.empty:
         return 0.0, "Sem dados"
 
-    df = df_mes_atual.copy()
-    df["RELEVANCIA"] = pd.to_numeric(df["RELEVANCIA"], errors="coerce").fillna(0.0)
-    df["CRITICO"] = df["CRITICO"].astype(str)
-
-    # 🔹 Regra do que conta como "conforme"
-    if projeto in ["Reparação Bacia do Rio Doce", "Samarco - COA"]:
-        cond_conforme = df["STATUS_GERAL_Regra"].isin(["Conforme", "Em Análise"])
-    else:
-        cond_conforme = df["STATUS_GERAL_Regra"].eq("Conforme")
-
-    # 🔹 Soma direta das relevâncias conforme a regra (sem divisão)
-    relevancia_conforme = df.loc[cond_conforme, "RELEVANCIA"].sum()
-
-    # 🔹 O valor final já é o percentual (0–1)
-    perc = float(relevancia_conforme)
-
-    # 🔹 Conta de críticos
-    critico = ((df["STATUS_GERAL_Regra"] == "Não Conforme") & (df["CRITICO"] == "1")).sum()
-
-    # 🔹 Legenda (sem alteração)
-    if projeto == "Vallourec":
-        if perc <= 0.9:
-            legenda = "Não Atende"
-        elif critico >= 1:
-            legenda = "Não Atende"
-        elif perc > 0.99:
-            legenda = "Atende"
-        elif perc >= 0.9:
-            legenda = "Atende Parcial"
-        else:
-            legenda = "Não Atende"
-
-    elif projeto in ["MSFC FLORESTAL LTDA", "BRACELL BAHIA FLORESTAL", "BRACELL BAHIA SPECIALTY CELLULOSE"]:
-        if perc < 0.5:
-            legenda = "Crítico"
-        elif critico >= 1:
-            legenda = "Não Atende"
-        elif perc >= 0.8:
-            legenda = "Atende"
-        elif 0.5 <= perc < 0.8:
-            legenda = "Não Atende"
-        else:
-            legenda = "Crítico"
-
-    elif projeto == "Projeto Sucuriú":
-        if perc <= 0.7:
-            legenda = "Crítico"
-        elif critico >= 1:
-            legenda = "Não Atende"
-        elif perc >= 0.93:
-            legenda = "Atende"
-        elif 0.8 <= perc < 0.93:
-            legenda = "Atende Parcial"
-        elif 0.7 <= perc < 0.8:
-            legenda = "Baixa Performance"
-        else:
-            legenda = "Não Atende"
-
-    else:
-        if perc >= 0.99:
-            legenda = "Atende"
-        elif perc <= 0.9:
-            legenda = "Crítico"
-        elif perc <= 0.96:
-            legenda = "Não Atende"
-        else:
-            legenda = "Atende Parcial"
+    # 🔹 Soma direta das relevâncias conforme a regra (sem divisão) — já é o percentual (0–1)
+    relevancia_conforme, critico = _componentes_kpi(df_mes_atual, projeto)
+    perc = float(relevancia_conforme.sum())
 
+    legenda = legenda_vetorizada([projeto], [perc], [int(critico.sum())])[0]
     return perc, legenda
 
 
@@ -408,45 +1232,45 @@ def calcular_relevancia_e_legenda(df_mes_atual, projeto):
 # 🆕 BLOCO 3.1 (versão final): HISTÓRICO DAS ÚLTIMAS 5 COMPETÊNCIAS
 # ============================================================
 
-def gerar_tabela_historico(df_cards_hist5, projeto):
+_LINHA_HISTORICO = (
+    "<tr>"
+    "<td style='padding:6px 8px;font-size:12px;'>{}</td>"
+    "<td style='padding:6px 8px;font-size:12px;text-align:right;color:#374151;'>{}</td>"
+    "<td style='padding:6px 8px;font-size:12px;color:{};font-weight:bold;'>{}</td>"
+    "</tr>"
+)
+
+def _linhas_historico(df_cards_hist5, projeto):
+    """(competências, perc 0–1, legendas) das linhas do histórico, vetorizado."""
+    if df_cards_hist5 is None or df_cards_hist5.empty:
+        return [], [], []
+
+    comps = df_cards_hist5["COMPETENCIA"].to_numpy()
+
+    # 🔹 Percentual atingido real (0–1 → 0–100)
+    perc = pd.to_numeric(df_cards_hist5["perc_atingido"], errors="coerce").fillna(0.0).to_numpy(dtype=float)
+    total_criticos = df_cards_hist5["total_criticos"].fillna(0).to_numpy(dtype=int)
+
+    # 🔹 Mesma simulação de antes (uma linha "Conforme" se perc >= 0.99, senão
+    #    "Não Conforme" com CRITICO = total_criticos), agora vetorizada
+    conforme_sim = perc >= 0.99
+    legendas = legenda_vetorizada(
+        np.full(len(perc), projeto, dtype=object),
+        np.where(conforme_sim, perc, 0.0),
+        (~conforme_sim & (total_criticos == 1)).astype(int),
+    )
+    return comps, perc, legendas
+
+
+def gerar_tabela_historico(df_cards_hist5, projeto, linhas=None):
     if df_cards_hist5.empty:
         return ""
-    
-    linhas_html = ""
-    for _, row in df_cards_hist5.iterrows():
-        comp = row["COMPETENCIA"]
-        
-        # 🔹 Percentual atingido real (0–1 → 0–100)
-        perc = float(row.get("perc_atingido", 0) or 0)
-        perc_fmt = f"{perc*100:.1f}%"
-        total_criticos = int(row.get("total_criticos", 0) or 0)
-        
-        # 🔹 Simula um df realista para reutilizar a função principal
-        df_tmp = pd.DataFrame([{
-            "STATUS_GERAL_Regra": "Conforme" if perc >= 0.99 else "Não Conforme",
-            "CRITICO": str(total_criticos),
-            "RELEVANCIA": perc
-        }])
-        
-        _, legenda = calcular_relevancia_e_legenda(df_tmp, projeto)
-
-        # 🔹 Cores conforme legenda
-        cor = {
-            "Atende": "#16A34A",
-            "Atende Parcial": "#FACC15",
-            "Não Atende": "#DC2626",
-            "Crítico": "#7F1D1D",
-            "Baixa Performance": "#F97316",
-            "Sem dados": "#6B7280"
-        }.get(legenda, "#6B7280")
-
-        linhas_html += f"""
-        <tr>
-          <td style='padding:6px 8px;font-size:12px;'>{comp}</td>
-          <td style='padding:6px 8px;font-size:12px;text-align:right;color:#374151;'>{perc_fmt}</td>
-          <td style='padding:6px 8px;font-size:12px;color:{cor};font-weight:bold;'>{legenda}</td>
-        </tr>
-        """
+
+    comps, perc, legendas = linhas if linhas is not None else _linhas_historico(df_cards_hist5, projeto)
+    linhas_html = "".join(
+        _LINHA_HISTORICO.format(escape(str(comp)), f"{p*100:.1f}%", CORES_LEGENDA.get(legenda, "#6B7280"), legenda)
+        for comp, p, legenda in zip(comps, perc, legendas)
+    )
 
     # 🔹 Monta o HTML completo da tabela
     return f"""
@@ -467,144 +1291,101 @@ def gerar_tabela_historico(df_cards_hist5, projeto):
 # 🧩 FUNÇÃO AUXILIAR: CONVERTE DATAFRAME EM TABELA HTML
 # ============================================================
 
-def dataframe_to_html(df: pd.DataFrame) -> str:
+# 🔹 Templates pré-montados (linha/célula) — só os valores mudam por linha
+_CABECALHO_DOC = "<th style='padding:6px 8px;text-align:left;'>{}</th>"
+_CELULA_DOC = "<td style='padding:6px 8px;'>{}</td>"
+_COLUNAS_DOC = {
+    "DOCUMENTO": "Documento",
+    "DOCUMENTO_APROV_OBS2": "Observação",
+    "DOCUMENTO_APROV_REGULARIZA2": "Regularização",
+    "STATUS_GERAL_Regra": "Status",
+}
+_COLUNAS_TRUNCADAS = {"DOCUMENTO_APROV_OBS2", "DOCUMENTO_APROV_REGULARIZA2"}
+
+
+@lru_cache(maxsize=None)
+def _template_linha_doc(n_colunas):
+    return "<tr style='border-bottom:1px solid #E5E7EB;'>" + _CELULA_DOC * n_colunas + "</tr>"
+
+
+def _coluna_html(serie, limite=None):
+    """Coluna → lista de textos prontos para HTML (vazios viram "", com escape de <, & ...)."""
+    # (tolist + laço: em dezenas de linhas, cada operação .str do pandas custa mais que a coluna inteira)
+    return ["" if nulo else escape(str(v)[:limite]) for v, nulo in zip(serie.tolist(), serie.isna().tolist())]
+
+
+@METRICAS.cronometrar()
+def dataframe_to_html(df: "pd.DataFrame") -> str:
     """
     Converte o df de documentos em uma tabela HTML formatada.
     - Mostra apenas colunas relevantes.
     - Adiciona estilos consistentes com o layout Meta.X.
+    - Trabalha por coluna e junta as linhas com "".join (sem iterrows).
     """
     if df.empty:
         return "<p style='font-size:13px;color:#6b7280;'>Nenhum documento encontrado.</p>"
 
-    # 🔹 Seleciona e renomeia colunas principais (só as úteis)
-    colunas = [
-        "DOCUMENTO",
-        "DOCUMENTO_APROV_OBS2",
-        "DOCUMENTO_APROV_REGULARIZA2",
-        "STATUS_GERAL_Regra"
-    ]
-    df_exibir = df[[c for c in colunas if c in df.columns]].copy()
-    df_exibir.rename(columns={
-        "DOCUMENTO": "Documento",
-        "DOCUMENTO_APROV_OBS2": "Observação",
-        "DOCUMENTO_APROV_REGULARIZA2": "Regularização",
-        "STATUS_GERAL_Regra": "Status"
-    }, inplace=True)
-
-    # 🔹 Limita tamanho dos textos para evitar e-mails muito longos
-    df_exibir["Observação"] = df_exibir["Observação"].astype(str).str.slice(0, 200)
-    df_exibir["Regularização"] = df_exibir["Regularização"].astype(str).str.slice(0, 200)
+    # 🔹 Seleciona as colunas principais (só as úteis), limitando o tamanho dos
+    #    textos longos para evitar e-mails muito longos
+    campos = [c for c in _COLUNAS_DOC if c in df.columns]
+    colunas = [_coluna_html(df[c], 200 if c in _COLUNAS_TRUNCADAS else None) for c in campos]
 
     # 🔹 Monta a tabela HTML
-    html = "<table style='width:100%;border-collapse:collapse;font-family:Arial,sans-serif;font-size:12px;'>"
-    html += "<thead><tr style='background:#001847;color:white;'>"
-    for col in df_exibir.columns:
-        html += f"<th style='padding:6px 8px;text-align:left;'>{col}</th>"
-    html += "</tr></thead><tbody>"
-
-    for _, row in df_exibir.iterrows():
-        html += "<tr style='border-bottom:1px solid #E5E7EB;'>"
-        for col in df_exibir.columns:
-            valor = row[col] if pd.notna(row[col]) else ""
-            html += f"<td style='padding:6px 8px;'>{valor}</td>"
-        html += "</tr>"
+    cabecalho = "".join(_CABECALHO_DOC.format(_COLUNAS_DOC[c]) for c in campos)
+    template = _template_linha_doc(len(campos))
+    corpo = "".join(template.format(*valores) for valores in zip(*colunas))
+    return (
+        "<table style='width:100%;border-collapse:collapse;font-family:Arial,sans-serif;font-size:12px;'>"
+        f"<thead><tr style='background:#001847;color:white;'>{cabecalho}</tr></thead>"
+        f"<tbody>{corpo}</tbody></table>"
+    )
 
-    html += "</tbody></table>"
-    return html
 
 # ============================================================
 # ✉️ BLOCO 4: CONSTRUÇÃO DO HTML DO E-MAIL
 # ============================================================
 
 
-def montar_email(projeto, prestador, contrato, competencia_dt, df_cards_hist5, df_mes_atual, emails):
+class ModeloCompilado:
     """
-    Mantém o layout anterior (gráfico à esquerda e card à direita no desktop),
-    com fallback natural para empilhar no mobile via flex-wrap.
-    Imagens (logo e gráfico) seguem como CID inline para funcionar no Gmail.
-    Retorna: html, grafico_bytes, logo_bytes
+    Template dividido UMA vez em fragmentos fixos + slots `{{nome}}`.
+    Constantes (paleta etc.) são resolvidas na compilação; por mensagem só os
+    slots variáveis são preenchidos e tudo é unido com "".join.
     """
-    # --- gráfico como CID (Gmail/Outlook safe) ---
-    grafico_bytes = None
-    grafico_html = "<p style='color:#6b7280;font-size:12px;margin:0;'>Sem histórico recente.</p>"
-    if df_cards_hist5 is not None and not df_cards_hist5.empty:
-        # gera o mesmo gráfico leve que já está no projeto
-        buf = io.BytesIO()
-        sub = df_cards_hist5.sort_values("COMPETENCIA")
-        x = np.arange(len(sub))
-        y = sub["total_pendencias"].astype(float).values
-        competencias = sub["COMPETENCIA"].astype(str).values
 
-        plt.figure(figsize=(5.2, 2.2), dpi=160)
-        ax = plt.gca()
-        if len(x) >= 3 and len(np.unique(y)) > 1:
-            x_smooth = np.linspace(x.min(), x.max(), 150)
-            try:
-                y_smooth = make_interp_spline(x, y, k=2)(x_smooth)
-                plt.plot(x_smooth, y_smooth, color=COR_LINHA_FORTE, linewidth=1.8, zorder=2)
-                plt.fill_between(x_smooth, y_smooth, color=COR_LINHA_SUAVE, alpha=0.2, zorder=1)
-            except Exception:
-                plt.plot(x, y, color=COR_LINHA_FORTE, linewidth=1.8, zorder=2)
-        else:
-            plt.plot(x, y, color=COR_LINHA_FORTE, linewidth=1.8, zorder=2)
+    _SLOT = re.compile(r"\{\{(\w+)\}\}")
 
-        plt.scatter(x, y, color=COR_PRINCIPAL, s=26, zorder=3)
-        y_min, y_max = y.min(), y.max()
-        margem = max(0.5, (y_max - y_min) * 0.3)
-        plt.ylim(y_min - 0.2, y_max + margem)
-        for xi, yi in zip(x, y):
-            plt.text(xi, yi + 0.1, f"{int(yi)}", ha="center", va="bottom",
-                     fontsize=7.5, color=COR_PRINCIPAL, fontweight="medium")
-        plt.xticks(x, competencias, fontsize=8.5, color="#374151")
-        plt.yticks([])
-        ax.spines["top"].set_visible(False)
-        ax.spines["right"].set_visible(False)
-        ax.spines["left"].set_visible(False)
-        ax.spines["bottom"].set_color("#D1D5DB")
-        plt.grid(axis="y", linestyle="--", alpha=0.25, linewidth=0.5)
-        plt.title("Pendências nas últimas competências", fontsize=9.5, color=COR_PRINCIPAL, pad=8)
-        plt.tight_layout()
-        plt.savefig(buf, format="png", bbox_inches="tight", transparent=True)
-        plt.close()
-        grafico_bytes = buf.getvalue()
-        # usa a imagem pelo CID
-        grafico_html = "<img src='cid:grafico_pendencias' style='width:100%;max-width:100%;border-radius:8px;display:block;'>"
+    def __init__(self, texto, constantes=None):
+        for nome, valor in (constantes or {}).items():
+            texto = texto.replace("{{" + nome + "}}", str(valor))
+        partes = self._SLOT.split(texto)
+        self.fixos = partes[0::2]     # len(slots) + 1 fragmentos fixos
+        self.slots = partes[1::2]
 
-    # --- logo como CID ---
-    with open(LOGO_PATH, "rb") as f:
-        logo_bytes = f.read()
+    def render(self, **valores):
+        saida = [self.fixos[0]]
+        for slot, fixo in zip(self.slots, self.fixos[1:]):
+            saida.append(valores[slot])
+            saida.append(fixo)
+        return "".join(saida)
 
-    # --- mini-tabela de histórico (já criada no seu código) ---
-    tabela_hist_html = gerar_tabela_historico(df_cards_hist5, projeto)
 
-    # --- tabela principal e KPI ---
-    tabela_html = dataframe_to_html(df_mes_atual)
-    perc, legenda = calcular_relevancia_e_legenda(df_mes_atual, projeto)
-    perc_fmt = f"{perc*100:.1f}%"
-    cor_legenda = {
-        "Atende":"#16A34A","Atende Parcial":"#FACC15",
-        "Não Atende":"#DC2626","Crítico":"#7F1D1D",
-        "Baixa Performance":"#F97316","Sem dados":"#6B7280"
-    }.get(legenda,"#6B7280")
-
-    # --- info auxiliares ---
-    emails_listados = "<br>".join([f"• {e}" for e in emails])
-    data_geracao = datetime.now(TZ_BRA).strftime("%d/%m/%Y %H:%M")
-
-    # --- HTML mantendo o layout anterior (flex) + responsivo básico ---
-    html = f"""
-    <div style="font-family:Arial,sans-serif;color:{COR_TEXTO};background:{COR_FUNDO};padding:24px;">
+_PALETA = {"COR_PRINCIPAL": COR_PRINCIPAL, "COR_FUNDO": COR_FUNDO, "COR_TEXTO": COR_TEXTO}
+
+# --- HTML mantendo o layout anterior (flex) + responsivo básico ---
+MODELO_EMAIL_HTML = ModeloCompilado("""
+    <div style="font-family:Arial,sans-serif;color:{{COR_TEXTO}};background:{{COR_FUNDO}};padding:24px;">
       <div style="background:white;border-radius:12px;padding:28px;max-width:800px;margin:auto;">
         <!-- Cabeçalho -->
         <div style="display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap;">
           <div style="flex:1;min-width:260px;">
-            <h2 style="color:{COR_PRINCIPAL};margin:0;">Relatório de Pendências de Documentos</h2>
+            <h2 style="color:{{COR_PRINCIPAL}};margin:0;">Relatório de Pendências de Documentos</h2>
             <p style="font-size:13px;color:#4b5563;margin-top:6px;line-height:1.4;">
-              <b>Projeto:</b> {projeto}<br>
-              <b>Prestador:</b> {prestador}<br>
-              <b>Contrato:</b> {contrato}<br>
-              <b>Competência:</b> {competencia_dt.strftime('%Y-%m')}<br>
-              <b>Gerado em:</b> {data_geracao}
+              <b>Projeto:</b> {{projeto}}<br>
+              <b>Prestador:</b> {{prestador}}<br>
+              <b>Contrato:</b> {{contrato}}<br>
+              <b>Competência:</b> {{competencia}}<br>
+              <b>Gerado em:</b> {{data_geracao}}
             </p>
           </div>
           <div style="flex:0 0 auto;">
@@ -618,30 +1399,30 @@ def montar_email(projeto, prestador, contrato, competencia_dt, df_cards_hist5, d
         <div style="display:flex;gap:20px;align-items:flex-start;flex-wrap:wrap;">
           <!-- Gráfico -->
           <div style="flex:1;min-width:320px;">
-            {grafico_html}
+            {{grafico_html}}
           </div>
 
           <!-- Card KPI -->
           <div style="flex:0 0 220px;text-align:center;border:1px solid #E5E7EB;padding:14px 10px;border-radius:10px;background:#F9FAFB;box-shadow:0 1px 4px rgba(0,0,0,0.05);">
             <div style="font-size:12px;color:#4B5563;">% Atingido</div>
-            <div style="font-size:28px;color:{COR_PRINCIPAL};font-weight:900;">{perc_fmt}</div>
-            <div style="font-size:11px;color:{cor_legenda};font-weight:bold;margin-bottom:8px;">{legenda}</div>
+            <div style="font-size:28px;color:{{COR_PRINCIPAL}};font-weight:900;">{{perc_fmt}}</div>
+            <div style="font-size:11px;color:{{cor_legenda}};font-weight:bold;margin-bottom:8px;">{{legenda}}</div>
 
             <!-- Mini-tabela de histórico ABAIXO do card -->
             <div style="margin-top:6px;border-top:1px solid #E5E7EB;padding-top:6px;">
-              <div style="font-size:11px;color:{COR_PRINCIPAL};font-weight:bold;margin-bottom:4px;">
+              <div style="font-size:11px;color:{{COR_PRINCIPAL}};font-weight:bold;margin-bottom:4px;">
                 Últimas Competências
               </div>
               <div style="font-size:10px;line-height:1.35;color:#111827;max-height:none;overflow:visible;">
-                {tabela_hist_html}
+                {{tabela_hist_html}}
               </div>
             </div>
           </div>
         </div>
 
         <!-- Tabela principal -->
-        <h3 style="color:{COR_PRINCIPAL};margin-top:24px;">Lista de Documentos</h3>
-        {tabela_html}
+        <h3 style="color:{{COR_PRINCIPAL}};margin-top:24px;">Lista de Documentos</h3>
+        {{tabela_html}}
 
         <p style="margin-top:12px;font-size:12px;color:#6b7280;">
           * Listagem de situação atual
@@ -650,113 +1431,2258 @@ def montar_email(projeto, prestador, contrato, competencia_dt, df_cards_hist5, d
         <hr style="margin:20px 0;border:0;border-top:1px solid #e5e7eb;">
         <p style="font-size:11px;color:#9ca3af;">
           Enviado automaticamente pela Meta.X<br>
-          <b>Destinatários:</b><br>{emails_listados}
+          <b>Destinatários:</b><br>{{emails_listados}}
         </p>
       </div>
     </div>
-    """
+""", _PALETA)
 
-    # retorna também os bytes para anexar via CID no envio
-    return html, grafico_bytes, logo_bytes
+# --- mesma estrutura em texto puro (parte text/plain do multipart/alternative) ---
+MODELO_EMAIL_TEXTO = ModeloCompilado("""Relatório de Pendências de Documentos
 
-# ============================================================
-# 🚀 BLOCO 5: LOOP DE ENVIO (gráfico + logo inline)
-# ============================================================
+Projeto: {{projeto}}
+Prestador: {{prestador}}
+Contrato: {{contrato}}
+Competência: {{competencia}}
+Gerado em: {{data_geracao}}
 
-def enviar_html(to_list, subject, html, grafico_bytes=None, logo_bytes=None, csv_buffer=None):
-    msg = MIMEMultipart("related")
-    msg["From"], msg["To"], msg["Subject"] = SMTP_FROM, ", ".join(to_list), subject
+% Atingido: {{perc_fmt}} ({{legenda}})
 
-    msg_alt = MIMEMultipart("alternative")
-    msg.attach(msg_alt)
-    msg_alt.attach(MIMEText(html, "html", "utf-8"))
+Últimas Competências:
+{{historico_texto}}
 
-    # adiciona o gráfico inline
-    if grafico_bytes:
-        img = MIMEImage(grafico_bytes, "png")
-        img.add_header("Content-ID", "<grafico_pendencias>")
-        img.add_header("Content-Disposition", "inline", filename="grafico_pendencias.png")
-        msg.attach(img)
+Lista de Documentos:
+{{documentos_texto}}
 
-    # adiciona o logo inline
-    if logo_bytes:
-        logo = MIMEImage(logo_bytes, "png")
-        logo.add_header("Content-ID", "<logo_metax>")
-        logo.add_header("Content-Disposition", "inline", filename="logo_metax.png")
-        msg.attach(logo)
+* Listagem de situação atual
 
-    # 🔹 adiciona o CSV de pendências como anexo (se existir)
-    if csv_buffer:
-        from email.mime.application import MIMEApplication
+--
+Enviado automaticamente pela Meta.X
+Destinatários:
+{{emails_texto}}
+""")
 
-        # Garante extensão e nome limpo
-        safe_name = re.sub(r'[^a-zA-Z0-9_-]', '_', subject)
-        filename = f"pendencias_{safe_name}.csv"
 
-        # Cria anexo CSV corretamente identificado
-        part = MIMEApplication(csv_buffer.getvalue(), _subtype="csv")
-        part.add_header("Content-Disposition", "attachment", filename=filename)
-        msg.attach(part)
+def _documentos_texto(df):
+    """Lista de documentos em texto puro (uma linha por documento)."""
+    if df.empty:
+        return "Nenhum documento encontrado."
+    campos = [c for c in _COLUNAS_DOC if c in df.columns]
+    colunas = []
+    for c in campos:
+        valores = df[c].astype(object)
+        valores = valores.where(valores.notna(), "").astype(str)
+        if c in _COLUNAS_TRUNCADAS:
+            valores = valores.str.slice(0, 200)
+        colunas.append(valores.tolist())
+    return "\n".join("- " + " | ".join(v for v in linha if v) for linha in zip(*colunas))
 
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as s:
-        s.starttls()
-        s.login(SMTP_USER, SMTP_PASS)
-        s.send_message(msg)
 
-# ============================================================
-# 🔧 Normalização e envio
-# ============================================================
+def _img_grafico(cid):
+    return f"<img src='cid:{cid}' style='width:100%;max-width:100%;border-radius:8px;display:block;'>"
 
-df_base = df_base.copy()
-df_base["COMPETENCIA"] = df_base["COMPETENCIA"].astype(str).str[:7]
-df_envio = df_base[df_base["COMPETENCIA"] == COMPETENCIA_REF_STR].copy()
-grupos = df_envio.groupby(["PROJETO","PRESTADOR","CONTRATO","COMPETENCIA","email_envio"])
 
-print(f"📧 Enviando {len(grupos)} e-mails (competência {COMPETENCIA_REF_STR})...\n")
+def _partes_contrato(projeto, df_cards_hist5, df_mes_atual, cid="grafico_pendencias", kpi=None):
+    """
+    Blocos de um contrato comuns ao e-mail individual e ao digest: gráfico
+    (bytes + <img> pelo `cid`), mini-histórico (HTML/texto), tabela de
+    documentos e KPI. `kpi` = (perc, legenda) já calculado em lote por
+    preparar_tarefas; sem ele, é calculado aqui só para este contrato.
+    """
+    # --- gráfico como CID (Gmail/Outlook safe) ---
+    grafico_bytes = None
+    grafico_html = "<p style='color:#6b7280;font-size:12px;margin:0;'>Sem histórico recente.</p>"
+    if df_cards_hist5 is not None and not df_cards_hist5.empty:
+        # gera o mesmo gráfico leve (figura reaproveitada + memo por série)
+        sub = df_cards_hist5.sort_values("COMPETENCIA")
+        grafico_bytes = GRAFICOS.renderizar(
+            sub["COMPETENCIA"].astype(str).tolist(),
+            sub["total_pendencias"].astype(float).tolist(),
+        )
+        # usa a imagem pelo CID
+        grafico_html = _img_grafico(cid)
 
-for (projeto, prestador, contrato, competencia_str, email_raw), grupo in grupos:
-    if not email_raw or str(email_raw).strip() == "":
-        print(f"⚠️ Sem e-mail para {prestador} - {contrato}")
-        continue
+    # --- mini-tabela de histórico (HTML e texto a partir das mesmas linhas) ---
+    linhas_hist = _linhas_historico(df_cards_hist5, projeto)
+    tabela_hist_html = gerar_tabela_historico(df_cards_hist5, projeto, linhas_hist)
+    historico_texto = "\n".join(f"- {comp}: {p*100:.1f}% ({leg})" for comp, p, leg in zip(*linhas_hist)) \
+        or "Sem histórico recente."
 
-    emails = [e.strip() for e in re.split(r"[;,]", str(email_raw)) if e.strip()]
-    df_cards_hist5 = historico_5_meses(df_cards, projeto, prestador, contrato)
-    df_mes_atual = grupo.copy()
+    # --- tabela principal e KPI ---
+    perc, legenda = kpi if kpi is not None else calcular_relevancia_e_legenda(df_mes_atual, projeto)
+    return {
+        "grafico_bytes": grafico_bytes,
+        "grafico_html": grafico_html,
+        "tabela_hist_html": tabela_hist_html,
+        "historico_texto": historico_texto,
+        "tabela_html": dataframe_to_html(df_mes_atual),
+        "documentos_texto": _documentos_texto(df_mes_atual),
+        "perc": perc,
+        "legenda": legenda,
+    }
+
+
+@METRICAS.cronometrar()
+def montar_email(projeto, prestador, contrato, competencia_dt, df_cards_hist5, df_mes_atual, emails, kpi=None):
+    """
+    Mantém o layout anterior (gráfico à esquerda e card à direita no desktop),
+    com fallback natural para empilhar no mobile via flex-wrap.
+    Imagens (logo e gráfico) seguem como CID inline para funcionar no Gmail.
+    Corpo vem dos modelos pré-compilados: só os slots variáveis são montados aqui.
+    O logo não passa por aqui: é anexado no envio a partir de ATIVOS.
+    `kpi` = (perc, legenda) de calcular_kpis_lote, quando já calculado.
+    Retorna: html, grafico_bytes, texto, (perc, legenda)
+    """
+    partes = _partes_contrato(projeto, df_cards_hist5, df_mes_atual, kpi=kpi)
+    perc, legenda = partes["perc"], partes["legenda"]
+
+    valores = {
+        "projeto": escape(str(projeto)),
+        "prestador": escape(str(prestador)),
+        "contrato": escape(str(contrato)),
+        "competencia": competencia_dt.strftime("%Y-%m"),
+        "data_geracao": datetime.now(TZ_BRA).strftime("%d/%m/%Y %H:%M"),
+        "perc_fmt": f"{perc*100:.1f}%",
+        "legenda": legenda,
+    }
+    html = MODELO_EMAIL_HTML.render(
+        **valores,
+        grafico_html=partes["grafico_html"],
+        cor_legenda=CORES_LEGENDA.get(legenda, "#6B7280"),
+        tabela_hist_html=partes["tabela_hist_html"],
+        tabela_html=partes["tabela_html"],
+        emails_listados="<br>".join([f"• {escape(e)}" for e in emails]),
+    )
+    texto = MODELO_EMAIL_TEXTO.render(
+        **{**valores, "projeto": str(projeto), "prestador": str(prestador), "contrato": str(contrato)},
+        historico_texto=partes["historico_texto"],
+        documentos_texto=partes["documentos_texto"],
+        emails_texto="\n".join(f"- {e}" for e in emails),
+    )
 
-    # 🔹 Filtra pendências históricas (todas as competências) para o mesmo projeto/prestador/contrato
-    df_anexo = df_pendencias_hist[
-        (df_pendencias_hist["PROJETO"] == projeto)
-        & (df_pendencias_hist["PRESTADOR"] == prestador)
-        & (df_pendencias_hist["CONTRATO"] == contrato)
-    ].copy()
+    # retorna também os bytes para anexar via CID no envio
+    return html, partes["grafico_bytes"], texto, (perc, legenda)
 
-    # 🔹 Gera CSV em memória (ou None se vazio)
-    if df_anexo.empty:
-        csv_buffer = None
-        print(f"📎 Nenhuma pendência histórica para {prestador} - {contrato}")
-    else:
-        from io import BytesIO
-        csv_buffer = BytesIO()
-        df_anexo.to_csv(csv_buffer, index=False, sep=";", encoding="utf-8-sig")
-        csv_buffer.seek(0)
-        print(f"📎 {len(df_anexo)} pendências anexadas → {prestador} | {contrato}")
-
-    # 🔹 Monta HTML do e-mail
-    html, grafico_bytes, logo_bytes = montar_email(
-        projeto, prestador, contrato, pd.to_datetime(competencia_str + "-01"),
-        df_cards_hist5, df_mes_atual, emails
-    )
 
-    # 🔹 Envia com anexo
-    assunto = f"[Pendências Docs] {prestador} | Contrato {contrato} | {competencia_str}"
-    try:
-        enviar_html(emails, assunto, html, grafico_bytes, logo_bytes, csv_buffer)
-        print(f"✅ Enviado → {prestador} | {contrato} | {competencia_str} → {', '.join(emails)}")
-    except Exception as e:
-        print(f"❌ Erro ao enviar para {prestador} - {contrato}: {e}")
+# ============================================================
+# 📬 BLOCO 4.0: DIGEST POR DESTINATÁRIOS (uma mensagem, uma seção por contrato)
+# ============================================================
+
+MODO_DIGEST = False   # True = agrupa por conjunto de destinatários (--digest)
+
+MODELO_DIGEST_HTML = ModeloCompilado("""
+    <div style="font-family:Arial,sans-serif;color:{{COR_TEXTO}};background:{{COR_FUNDO}};padding:24px;">
+      <div style="background:white;border-radius:12px;padding:28px;max-width:800px;margin:auto;">
+        <!-- Cabeçalho -->
+        <div style="display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap;">
+          <div style="flex:1;min-width:260px;">
+            <h2 style="color:{{COR_PRINCIPAL}};margin:0;">Relatório de Pendências de Documentos</h2>
+            <p style="font-size:13px;color:#4b5563;margin-top:6px;line-height:1.4;">
+              <b>Prestador:</b> {{prestador}}<br>
+              <b>Contratos:</b> {{n_contratos}}<br>
+              <b>Competência:</b> {{competencia}}<br>
+              <b>Gerado em:</b> {{data_geracao}}
+            </p>
+          </div>
+          <div style="flex:0 0 auto;">
+            <img src="cid:logo_metax" alt="Meta.X" style="height:50px;max-width:150px;display:block;">
+          </div>
+        </div>
+        {{secoes_html}}
+        <p style="margin-top:12px;font-size:12px;color:#6b7280;">
+          * Listagem de situação atual
+        </p>
+
+        <hr style="margin:20px 0;border:0;border-top:1px solid #e5e7eb;">
+        <p style="font-size:11px;color:#9ca3af;">
+          Enviado automaticamente pela Meta.X<br>
+          <b>Destinatários:</b><br>{{emails_listados}}
+        </p>
+      </div>
+    </div>
+""", _PALETA)
+
+MODELO_SECAO_DIGEST_HTML = ModeloCompilado("""
+        <hr style="margin:18px 0;border:0;border-top:1px solid #e5e7eb;">
+        <h3 style="color:{{COR_PRINCIPAL}};margin:0 0 12px 0;">{{projeto}} · Contrato {{contrato}}</h3>
+        <div style="display:flex;gap:20px;align-items:flex-start;flex-wrap:wrap;">
+          <div style="flex:1;min-width:320px;">
+            {{grafico_html}}
+          </div>
+          <div style="flex:0 0 220px;text-align:center;border:1px solid #E5E7EB;padding:14px 10px;border-radius:10px;background:#F9FAFB;box-shadow:0 1px 4px rgba(0,0,0,0.05);">
+            <div style="font-size:12px;color:#4B5563;">% Atingido</div>
+            <div style="font-size:28px;color:{{COR_PRINCIPAL}};font-weight:900;">{{perc_fmt}}</div>
+            <div style="font-size:11px;color:{{cor_legenda}};font-weight:bold;margin-bottom:8px;">{{legenda}}</div>
+            <div style="margin-top:6px;border-top:1px solid #E5E7EB;padding-top:6px;">
+              <div style="font-size:11px;color:{{COR_PRINCIPAL}};font-weight:bold;margin-bottom:4px;">
+                Últimas Competências
+              </div>
+              <div style="font-size:10px;line-height:1.35;color:#111827;">
+                {{tabela_hist_html}}
+              </div>
+            </div>
+          </div>
+        </div>
+        <h4 style="color:{{COR_PRINCIPAL}};margin:18px 0 8px 0;">Lista de Documentos</h4>
+        {{tabela_html}}
+""", _PALETA)
+
+MODELO_DIGEST_TEXTO = ModeloCompilado("""Relatório de Pendências de Documentos
+
+Prestador: {{prestador}}
+Contratos: {{n_contratos}}
+Competência: {{competencia}}
+Gerado em: {{data_geracao}}
+{{secoes_texto}}
+* Listagem de situação atual
+
+--
+Enviado automaticamente pela Meta.X
+Destinatários:
+{{emails_texto}}
+""")
+
+MODELO_SECAO_DIGEST_TEXTO = ModeloCompilado("""
+== {{projeto}} · Contrato {{contrato}} ==
+% Atingido: {{perc_fmt}} ({{legenda}})
+
+Últimas Competências:
+{{historico_texto}}
+
+Lista de Documentos:
+{{documentos_texto}}
+""")
+
+
+def _nome_prestadores(prestadores):
+    unicos = list(dict.fromkeys(str(p) for p in prestadores))
+    return unicos[0] if len(unicos) == 1 else f"{len(unicos)} prestadores"
+
+
+@METRICAS.cronometrar()
+def montar_email_digest(competencia_dt, contratos, emails):
+    """
+    Uma mensagem para um conjunto de destinatários com uma seção por contrato
+    (mesmos blocos do e-mail individual). `contratos`: dicts com projeto,
+    prestador, contrato, df_cards_hist5, df_mes_atual e (opcional) kpi.
+    Gráficos iguais (séries iguais, ex.: tudo zero) viram UMA parte inline.
+    Retorna: html, graficos [(cid, bytes)], texto, [(perc, legenda) por contrato]
+    """
+    cids = {}
+    secoes_html, secoes_texto, kpis = [], [], []
+    for c in contratos:
+        partes = _partes_contrato(c["projeto"], c["df_cards_hist5"], c["df_mes_atual"], kpi=c.get("kpi"))
+        if partes["grafico_bytes"] is not None:
+            cid = cids.setdefault(partes["grafico_bytes"], f"grafico_{len(cids)}")
+            partes["grafico_html"] = _img_grafico(cid)
+        kpis.append((partes["perc"], partes["legenda"]))
+        valores = {
+            "projeto": str(c["projeto"]), "contrato": str(c["contrato"]),
+            "perc_fmt": f"{partes['perc']*100:.1f}%", "legenda": partes["legenda"],
+        }
+        secoes_html.append(MODELO_SECAO_DIGEST_HTML.render(
+            **{**valores, "projeto": escape(valores["projeto"]), "contrato": escape(valores["contrato"])},
+            grafico_html=partes["grafico_html"],
+            cor_legenda=CORES_LEGENDA.get(partes["legenda"], "#6B7280"),
+            tabela_hist_html=partes["tabela_hist_html"],
+            tabela_html=partes["tabela_html"],
+        ))
+        secoes_texto.append(MODELO_SECAO_DIGEST_TEXTO.render(
+            **valores,
+            historico_texto=partes["historico_texto"],
+            documentos_texto=partes["documentos_texto"],
+        ))
+
+    prestador = _nome_prestadores(c["prestador"] for c in contratos)
+    valores = {
+        "n_contratos": str(len(contratos)),
+        "competencia": competencia_dt.strftime("%Y-%m"),
+        "data_geracao": datetime.now(TZ_BRA).strftime("%d/%m/%Y %H:%M"),
+    }
+    html = MODELO_DIGEST_HTML.render(
+        **valores,
+        prestador=escape(prestador),
+        secoes_html="".join(secoes_html),
+        emails_listados="<br>".join([f"• {escape(e)}" for e in emails]),
+    )
+    texto = MODELO_DIGEST_TEXTO.render(
+        **valores,
+        prestador=prestador,
+        secoes_texto="".join(secoes_texto),
+        emails_texto="\n".join(f"- {e}" for e in emails),
+    )
+    return html, [(cid, dados) for dados, cid in cids.items()], texto, kpis
+
+# ============================================================
+# 📮 BLOCO 4.1: POOL DE CONEXÕES SMTP (sessões autenticadas reaproveitadas)
+# ============================================================
+
+class PoolSMTP:
+    """
+    Pool limitado de sessões SMTP já autenticadas (STARTTLS + login uma vez).
+    - Cada sessão envia várias mensagens; após `max_msgs_por_sessao` ela é
+      encerrada e reaberta na próxima retirada (rotação).
+    - Se o servidor derrubar a conexão (SMTPServerDisconnected), reconecta e
+      reenvia a mensagem uma única vez.
+    - `usar_tls=False` e `usuario=None` permitem testar contra um servidor
+      local (aiosmtpd / smtpd) sem TLS nem AUTH.
+    """
+
+    def __init__(self, servidor, porta, usuario=None, senha=None, tamanho=2,
+                 max_msgs_por_sessao=100, usar_tls=True, timeout=60):
+        self.servidor, self.porta = servidor, porta
+        self.usuario, self.senha = usuario, senha
+        self.max_msgs_por_sessao = max_msgs_por_sessao
+        self.usar_tls = usar_tls
+        self.timeout = timeout
+        # fila de "vagas": None = vaga sem sessão aberta ainda (abre sob demanda)
+        self._livres = queue.LifoQueue(maxsize=tamanho)
+        for _ in range(tamanho):
+            self._livres.put(None)
+        self._fechado = False
+        self._lock_fechar = threading.Lock()
+
+    def _conectar(self):
+        s = smtplib.SMTP(self.servidor, self.porta, timeout=self.timeout)
+        if self.usar_tls:
+            s.starttls()
+        if self.usuario:
+            s.login(self.usuario, self.senha)
+        return [s, 0]   # [sessão, mensagens enviadas nela]
+
+    @staticmethod
+    def _encerrar(sessao):
+        if sessao is None:
+            return
+        try:
+            sessao[0].quit()
+        except Exception:
+            try:
+                sessao[0].close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _transmitir(smtp, msg):
+        # MensagemBruta: bytes prontos (sendmail não reserializa); Message: send_message
+        if isinstance(msg, MensagemBruta):
+            smtp.sendmail(msg.remetente, list(msg.destinatarios), msg.dados, mail_options=list(msg.opcoes))
+        else:
+            smtp.send_message(msg)
+
+    def enviar(self, msg):
+        """Envia uma MensagemBruta (ou um `Message` já montado) usando uma sessão do pool."""
+        if self._fechado:
+            raise RuntimeError("PoolSMTP já foi fechado")
+        sessao = self._livres.get()
+        try:
+            if self._fechado:
+                raise RuntimeError("PoolSMTP já foi fechado")
+            if sessao is not None and sessao[1] >= self.max_msgs_por_sessao:
+                self._encerrar(sessao)
+                sessao = None
+            if sessao is None:
+                sessao = self._conectar()
+            try:
+                self._transmitir(sessao[0], msg)
+            except smtplib.SMTPServerDisconnected:
+                # conexão caiu (timeout ocioso, limite do servidor...): reabre e tenta de novo
+                self._encerrar(sessao)
+                sessao = None
+                sessao = self._conectar()
+                self._transmitir(sessao[0], msg)
+            sessao[1] += 1
+        except Exception:
+            # sessão em estado desconhecido: descarta para não contaminar os próximos envios
+            self._encerrar(sessao)
+            sessao = None
+            raise
+        finally:
+            with self._lock_fechar:
+                if self._fechado:
+                    # fechar() já drenou as vagas: a sessão que voltou agora é encerrada aqui
+                    self._encerrar(sessao)
+                    sessao = None
+                self._livres.put(sessao)
+
+    def fechar(self):
+        with self._lock_fechar:
+            self._fechado = True
+            while True:
+                try:
+                    self._encerrar(self._livres.get_nowait())
+                except queue.Empty:
+                    break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+
+
+# ============================================================
+# ⚡ BLOCO 4.1b: BACKEND ASSÍNCRONO (aiosmtplib, N sessões + fila limitada)
+# ============================================================
+
+def _erro_smtplib(erro):
+    """Exceções do aiosmtplib → equivalentes do smtplib (para classificar_erro_smtp/_eh_throttle)."""
+    import aiosmtplib
+    if isinstance(erro, aiosmtplib.SMTPRecipientsRefused):
+        return smtplib.SMTPRecipientsRefused({r.recipient: (r.code, r.message) for r in erro.recipients})
+    if isinstance(erro, aiosmtplib.SMTPServerDisconnected):
+        return smtplib.SMTPServerDisconnected(str(erro))
+    if isinstance(erro, aiosmtplib.SMTPResponseException):
+        return smtplib.SMTPResponseException(erro.code, erro.message)
+    return erro
+
+
+class EnvioAssincrono:
+    """
+    Backend de entrega assíncrono: um event loop em thread própria mantém
+    `sessoes` sessões aiosmtplib abertas (mesma rotação/reconexão do PoolSMTP),
+    consumindo uma fila limitada a `fila_max` mensagens prontas.
+    - submeter(msg, agendador) devolve um concurrent.futures.Future e BLOQUEIA
+      quem chama enquanto a fila estiver cheia (contrapressão sobre o render);
+    - enviar(msg) é a versão síncrona (mesma interface do PoolSMTP);
+    - a latência de cada mensagem (da submissão à aceitação pelo servidor) vai
+      para METRICAS como "latencia_envio".
+    """
+
+    def __init__(self, servidor, porta, usuario=None, senha=None, sessoes=4, fila_max=64,
+                 max_msgs_por_sessao=100, usar_tls=True, timeout=60):
+        self.servidor, self.porta = servidor, porta
+        self.usuario, self.senha = usuario, senha
+        self.sessoes = sessoes
+        self.fila_max = fila_max
+        self.max_msgs_por_sessao = max_msgs_por_sessao
+        self.usar_tls = usar_tls
+        self.timeout = timeout
+        self._loop = None
+        self._thread = None
+        self._fila = None
+        self._trabalhadores = []
+        self._lock = threading.Lock()
+        self._fechado = False
+
+    # ---- event loop em thread própria (criado no primeiro envio) ----
+    def _iniciar(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            pronto = threading.Event()
+
+            def _rodar():
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+                self._fila = asyncio.Queue(maxsize=self.fila_max)
+                self._trabalhadores = [self._loop.create_task(self._trabalhador()) for _ in range(self.sessoes)]
+                pronto.set()
+                self._loop.run_forever()
+
+            self._thread = threading.Thread(target=_rodar, name="envio-async", daemon=True)
+            self._thread.start()
+            pronto.wait()
+
+    async def _conectar(self):
+        import aiosmtplib
+        smtp = aiosmtplib.SMTP(hostname=self.servidor, port=self.porta, timeout=self.timeout, start_tls=False)
+        await smtp.connect()
+        if self.usar_tls:
+            await smtp.starttls()
+        if self.usuario:
+            await smtp.login(self.usuario, self.senha)
+        return [smtp, 0]
+
+    @staticmethod
+    async def _encerrar(sessao):
+        if sessao is None:
+            return
+        try:
+            await sessao[0].quit()
+        except Exception:
+            sessao[0].close()
+
+    @staticmethod
+    async def _transmitir(smtp, msg):
+        if isinstance(msg, MensagemBruta):
+            await smtp.sendmail(msg.remetente, list(msg.destinatarios), msg.dados, mail_options=list(msg.opcoes))
+        else:
+            await smtp.send_message(msg)
+
+    async def _trabalhador(self):
+        sessao = None
+        while True:
+            item = await self._fila.get()
+            if item is None:
+                await self._encerrar(sessao)
+                return
+            msg, agendador, futuro, t0 = item
+
+            async def _envio():
+                nonlocal sessao
+                import aiosmtplib
+                try:
+                    if sessao is not None and sessao[1] >= self.max_msgs_por_sessao:
+                        await self._encerrar(sessao)
+                        sessao = None
+                    if sessao is None:
+                        sessao = await self._conectar()
+                    try:
+                        await self._transmitir(sessao[0], msg)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # conexão caiu (timeout ocioso, limite do servidor...): reabre e tenta de novo
+                        sessao[0].close()
+                        sessao = None
+                        sessao = await self._conectar()
+                        await self._transmitir(sessao[0], msg)
+                    sessao[1] += 1
+                except Exception as e:
+                    # sessão em estado desconhecido: descarta (a próxima tentativa reconecta)
+                    if sessao is not None:
+                        sessao[0].close()
+                    sessao = None
+                    raise _erro_smtplib(e) from e
+
+            try:
+                tentativas = await (agendador.executar_async(_envio) if agendador else _envio())
+                latencia = time.perf_counter() - t0
+                if METRICAS.ativo:
+                    METRICAS.registrar("latencia_envio", latencia)
+                futuro.set_result({"tentativas": tentativas or 1, "latencia_s": latencia})
+            except Exception as e:
+                futuro.set_exception(e)
+
+    # ---- interface síncrona, chamada pelas threads do pipeline ----
+    def submeter(self, msg, agendador=None):
+        if self._fechado:
+            raise RuntimeError("EnvioAssincrono já foi fechado")
+        self._iniciar()
+        futuro = Future()
+        item = (msg, agendador, futuro, time.perf_counter())
+        # put() espera vaga na fila: a contrapressão chega a quem está produzindo mensagens
+        asyncio.run_coroutine_threadsafe(self._fila.put(item), self._loop).result()
+        return futuro
+
+    def enviar(self, msg):
+        self.submeter(msg).result()
+
+    def fechar(self):
+        if self._fechado:
+            return
+        self._fechado = True
+        if self._loop is None:
+            return
+
+        async def _parar():
+            for _ in self._trabalhadores:
+                await self._fila.put(None)
+            await asyncio.gather(*self._trabalhadores, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(_parar(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+
+
+# ============================================================
+# 📎 BLOCO 4.2: ANEXO CSV (direto em bytes + compactação acima do limite)
+# ============================================================
+
+ANEXO_COMPACTAR_ACIMA = 2 * 2**20   # bytes de CSV a partir dos quais o anexo é compactado (None = nunca)
+ANEXO_COMPACTACAO = "zip"           # "zip" (abre em qualquer cliente) ou "gzip" (.csv.gz)
+
+
+_CARACTERES_NOME = re.compile(r"[^a-zA-Z0-9_-]")
+
+
+def nome_anexo(assunto):
+    """Nome do CSV de pendências (extensão garantida e nome limpo, a partir do assunto)."""
+    return f"pendencias_{_CARACTERES_NOME.sub('_', assunto)}.csv"
+
+
+def csv_anexo(df):
+    """
+    CSV do anexo com o to_csv original (sep ';', UTF-8 com BOM, sem índice;
+    aspas só em campos com ';', aspas ou quebra de linha). Roda nos workers de
+    render; o anexo vindo do histórico em Arrow vira DataFrame antes (ver
+    _csv_contrato), porque o writer do pyarrow não reproduz esse formato byte a
+    byte (aspas em todo texto, floats sem ".0").
+    """
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, sep=";", encoding="utf-8-sig")
+    return buf.getvalue()
+
+
+def compactar_anexo(csv_bytes, nome_csv, limite=ANEXO_COMPACTAR_ACIMA, formato=ANEXO_COMPACTACAO):
+    """
+    (bytes, nome_arquivo, subtipo MIME) do anexo: o CSV como está até `limite`
+    bytes; acima disso, zip/gzip (menos base64 para codificar e a mensagem fica
+    abaixo do limite das caixas postais).
+    """
+    if limite is None or len(csv_bytes) <= limite:
+        return csv_bytes, nome_csv, "csv"
+    if formato == "gzip":
+        return gzip.compress(csv_bytes, compresslevel=6, mtime=0), nome_csv + ".gz", "gzip"
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as z:
+        z.writestr(nome_csv, csv_bytes)
+    return buf.getvalue(), nome_csv[:-len(".csv")] + ".zip", "zip"
+
+
+class MensagemBruta(namedtuple("MensagemBruta", "remetente destinatarios dados assunto opcoes")):
+    """
+    Mensagem já serializada (RFC 822 em bytes, CRLF) com o envelope: é o que
+    sai do worker de render e vai direto para sendmail, sem árvore MIME para
+    reserializar na thread de envio. `opcoes` = mail_options do MAIL FROM.
+    """
+    __slots__ = ()
+
+
+# fronteiras fixas por nível: todo corpo sai em base64, cujo alfabeto não tem "_", então
+# elas nunca colidem com o conteúdo (o gerador não precisa varrer o texto para sorteá-las)
+# e o Content-Type de cada nível fica igual em todas as mensagens (cacheado pela política)
+_FRONTEIRAS = {"mixed": "=_docvs_mixed", "alternative": "=_docvs_alternative", "related": "=_docvs_related"}
+
+
+class MontadorMensagem:
+    """
+    Monta a mensagem com email.message.EmailMessage (alternative → texto +
+    related[HTML, imagens inline], dentro de mixed quando há anexo) sob
+    `politica`, e a serializa uma única vez em bytes. O cabeçalho From é interpretado uma vez e reaproveitado
+    (o EmailMessage aceita o objeto de cabeçalho pronto); o logo vem do
+    RegistroAtivos já codificado.
+    """
+
+    def __init__(self, politica=POLITICA_EMAIL):
+        self.politica = politica
+        # o SMTP exige CRLF: a política de serialização garante, sem mexer na de montagem
+        self._politica_envio = politica if politica.linesep == "\r\n" else politica.clone(linesep="\r\n")
+        self._cabecalhos = {}
+
+    def _cabecalho(self, nome, valor):
+        cabecalho = self._cabecalhos.get((nome, valor))
+        if cabecalho is None:
+            cabecalho = self._cabecalhos[(nome, valor)] = self.politica.header_factory(nome, valor)
+        return cabecalho
+
+    def montar(self, to_list, subject, html, grafico_bytes=None, texto=None, anexo=None, graficos=None,
+               logo_bytes=None):
+        msg = EmailMessage(policy=self.politica)
+        if SMTP_FROM:
+            msg["From"] = self._cabecalho("From", SMTP_FROM)
+        msg["To"] = ", ".join(to_list)
+        msg["Subject"] = subject
+
+        # texto puro primeiro, HTML por último (a preferida pelo cliente)
+        if texto:
+            msg.set_content(texto, cte="base64")
+            msg.make_alternative(boundary=_FRONTEIRAS["alternative"])
+            msg.add_alternative(html, subtype="html", cte="base64")
+            corpo_html = msg.get_payload()[-1]
+        else:
+            msg.set_content(html, subtype="html", cte="base64")
+            corpo_html = msg
+        # (o logo sempre vai junto: o HTML vira related já com a fronteira fixa)
+        corpo_html.make_related(boundary=_FRONTEIRAS["related"])
+
+        # gráfico inline (digest: um por série distinta, cada um com o seu CID)
+        imagens = [("grafico_pendencias", grafico_bytes)] if grafico_bytes else []
+        for cid, dados in imagens + list(graficos or ()):
+            corpo_html.add_related(dados, "image", _SUBTIPO_GRAFICO[FORMATO_GRAFICO], cid=f"<{cid}>",
+                                   disposition="inline", filename=f"{cid}.{FORMATO_GRAFICO}")
+
+        # logo inline (parte pré-codificada compartilhada, salvo logo explícito)
+        if logo_bytes:
+            corpo_html.add_related(logo_bytes, "image", "png", cid="<logo_metax>",
+                                   disposition="inline", filename="logo_metax.png")
+        else:
+            corpo_html.attach(ATIVOS.parte("logo_metax"))
+
+        # 🔹 CSV de pendências como anexo (se existir): `anexo` já vem
+        #    pronto do worker (bytes, nome, subtipo), possivelmente compactado
+        if anexo is not None:
+            dados, filename, subtipo = anexo
+            msg.make_mixed(boundary=_FRONTEIRAS["mixed"])
+            msg.add_attachment(dados, "application", subtipo, filename=filename)
+
+        # as partes criadas por add_*/make_* são EmailMessage e o set_content de
+        # cada uma carimba MIME-Version: o cabeçalho só vale na raiz (RFC 2045 §4)
+        for parte in msg.walk():
+            if parte is not msg:
+                del parte["MIME-Version"]
+        return msg
+
+    def serializar(self, msg, to_list, subject):
+        buf = io.BytesIO()
+        BytesGenerator(buf, mangle_from_=False, policy=self._politica_envio).flatten(msg)
+        opcoes = ("SMTPUTF8",) if self.politica.utf8 else ()
+        return MensagemBruta(SMTP_FROM, tuple(to_list), buf.getvalue(), subject, opcoes)
+
+
+MONTADOR = MontadorMensagem()
+
+
+def montar_mensagem(to_list, subject, html, grafico_bytes=None, logo_bytes=None, csv_buffer=None,
+                    texto=None, anexo=None, graficos=None):
+    """EmailMessage completa (imagens inline + anexo), pronta para envio."""
+    if anexo is None and csv_buffer:
+        anexo = (csv_buffer.getvalue(), nome_anexo(subject), "csv")
+    return MONTADOR.montar(to_list, subject, html, grafico_bytes, texto=texto, anexo=anexo,
+                           graficos=graficos, logo_bytes=logo_bytes)
+
+
+def mensagem_bytes(to_list, subject, html, grafico_bytes=None, logo_bytes=None, csv_buffer=None,
+                   texto=None, anexo=None, graficos=None):
+    """Mesma mensagem de montar_mensagem, já serializada (MensagemBruta)."""
+    msg = montar_mensagem(to_list, subject, html, grafico_bytes, logo_bytes, csv_buffer,
+                          texto=texto, anexo=anexo, graficos=graficos)
+    return MONTADOR.serializar(msg, to_list, subject)
+
+
+def _contabilizar_envio(tamanho, real=True):
+    """Tamanho da mensagem; enviados só com entrega SMTP real (o dry-run conta como gravados)."""
+    METRICAS.observar("mensagem_bytes", tamanho)
+    if real:
+        METRICAS.contar("bytes_enviados_total", tamanho)
+        METRICAS.contar("mensagens_enviadas_total")
+    else:
+        METRICAS.contar("bytes_gravados_total", tamanho)
+        METRICAS.contar("mensagens_gravadas_total")
+
+
+@METRICAS.cronometrar()
+def enviar_mensagem(mensagem, pool=None):
+    """
+    Entrega uma MensagemBruta. Com pool: reaproveita uma sessão já autenticada
+    (só o DATA por mensagem); `pool` também pode ser uma saída em disco
+    (SaidaEml), que devolve o arquivo gravado.
+    """
+    resultado = None
+    if pool is not None:
+        resultado = pool.enviar(mensagem)
+    else:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as s:
+            s.starttls()
+            s.login(SMTP_USER, SMTP_PASS)
+            s.sendmail(mensagem.remetente, list(mensagem.destinatarios), mensagem.dados,
+                       mail_options=list(mensagem.opcoes))
+
+    _contabilizar_envio(len(mensagem.dados), real=getattr(pool, "entrega_real", True))
+    return resultado
+
+
+@METRICAS.cronometrar()
+def enviar_html(to_list, subject, html, grafico_bytes=None, logo_bytes=None, csv_buffer=None, pool=None,
+                texto=None, anexo=None, graficos=None):
+    mensagem = mensagem_bytes(to_list, subject, html, grafico_bytes, logo_bytes, csv_buffer,
+                              texto=texto, anexo=anexo, graficos=graficos)
+    return enviar_mensagem(mensagem, pool)
+
+# ============================================================
+# ⚙️ BLOCO 6: PIPELINE CONCORRENTE (render em processos, envio em threads)
+# ============================================================
+
+class LimitadorTaxa:
+    """
+    Token bucket simples e thread-safe: no máximo `msgs_por_segundo` liberações
+    por segundo (com rajada de até `rajada`). `msgs_por_segundo=None` desliga.
+    """
+
+    def __init__(self, msgs_por_segundo=None, rajada=1):
+        self.taxa = msgs_por_segundo
+        self.rajada = max(1, rajada)
+        self._tokens = float(self.rajada)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reservar(self):
+        """Tenta liberar sem bloquear: 0 se liberou, senão os segundos até a próxima vaga."""
+        if not self.taxa:
+            return 0.0
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(self.rajada, self._tokens + (agora - self._ultimo) * self.taxa)
+            self._ultimo = agora
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.taxa
+
+    def aguardar(self):
+        while True:
+            espera = self.reservar()
+            if not espera:
+                return
+            time.sleep(espera)
+
+    def ajustar(self, msgs_por_segundo):
+        with self._lock:
+            self.taxa = msgs_por_segundo
+
+
+# ============================================================
+# 🔁 BLOCO 6.1: RETENTATIVAS, BACKOFF E TAXA ADAPTATIVA (AIMD)
+# ============================================================
+
+# códigos 4xx típicos de throttling / indisponibilidade temporária
+_CODIGOS_THROTTLE = {421, 450, 451, 452}
+
+
+def classificar_erro_smtp(erro):
+    """
+    'transitorio' (vale tentar de novo: 4xx, queda de conexão, timeout de rede)
+    ou 'permanente' (5xx, autenticação, destinatário inválido, erro de montagem).
+    """
+    if isinstance(erro, smtplib.SMTPRecipientsRefused):
+        codigos = [c for c, _ in erro.recipients.values()]
+        return "transitorio" if codigos and all(400 <= c < 500 for c in codigos) else "permanente"
+    codigo = getattr(erro, "smtp_code", None)
+    if isinstance(codigo, int) and codigo > 0:
+        return "transitorio" if 400 <= codigo < 500 else "permanente"
+    if isinstance(erro, smtplib.SMTPServerDisconnected):
+        return "transitorio"
+    if isinstance(erro, smtplib.SMTPException):
+        return "permanente"
+    if isinstance(erro, OSError):   # ConnectionError, timeout, DNS...
+        return "transitorio"
+    return "permanente"
+
+
+def _eh_throttle(erro):
+    codigo = getattr(erro, "smtp_code", None)
+    return codigo in _CODIGOS_THROTTLE or isinstance(erro, smtplib.SMTPServerDisconnected)
+
+
+class TaxaAdaptativa:
+    """
+    Controle AIMD da taxa de envio de um servidor, sobre um LimitadorTaxa:
+    - aumento aditivo (+`incremento` msg/s) a cada `passo` envios bem-sucedidos;
+    - redução multiplicativa (× `fator`) quando a fração de 4xx/quedas na
+      janela recente passa de `limiar` (no máximo uma redução por `resfriamento_s`).
+    Sem taxa no limitador (None) o envio fica sem limite até a primeira
+    redução, que parte da vazão observada na janela (ou de `taxa_inicial`,
+    se ainda não houver amostras suficientes).
+    """
+
+    def __init__(self, limitador, taxa_inicial=5.0, taxa_min=0.2, taxa_max=None,
+                 incremento=0.5, passo=20, fator=0.5, limiar=0.05, janela=100, resfriamento_s=5.0):
+        self.limitador = limitador
+        self.taxa = limitador.taxa   # None = sem limite
+        self.taxa_inicial = taxa_inicial
+        self.taxa_min, self.taxa_max = taxa_min, taxa_max
+        self.incremento, self.passo, self.fator = incremento, passo, fator
+        self.limiar, self.resfriamento_s = limiar, resfriamento_s
+        self._janela = deque(maxlen=janela)
+        self._instantes = deque(maxlen=janela)
+        self._sucessos = 0
+        self._ultima_reducao = float("-inf")
+        self._lock = threading.Lock()
+
+    def _vazao_observada(self):
+        if len(self._instantes) < 2 or self._instantes[-1] <= self._instantes[0]:
+            return self.taxa_inicial
+        return (len(self._instantes) - 1) / (self._instantes[-1] - self._instantes[0])
+
+    def registrar(self, sucesso, throttle=False):
+        with self._lock:
+            agora = time.monotonic()
+            self._janela.append(1 if throttle else 0)
+            self._instantes.append(agora)
+            if throttle:
+                fracao = sum(self._janela) / len(self._janela)
+                if fracao > self.limiar and agora - self._ultima_reducao >= self.resfriamento_s:
+                    atual = self.taxa if self.taxa is not None else self._vazao_observada()
+                    self.taxa = max(self.taxa_min, atual * self.fator)
+                    self._ultima_reducao = agora
+                    self._sucessos = 0
+                    print(f"🐢 Throttling SMTP ({fracao:.0%} 4xx): taxa → {self.taxa:.2f} msg/s")
+            elif sucesso and self.taxa is not None:
+                self._sucessos += 1
+                if self._sucessos >= self.passo:
+                    self._sucessos = 0
+                    nova = self.taxa + self.incremento
+                    self.taxa = min(self.taxa_max, nova) if self.taxa_max else nova
+            self.limitador.ajustar(self.taxa)
+
+
+class AgendadorEntrega:
+    """
+    Executa uma entrega respeitando a taxa adaptativa; erros transitórios são
+    repetidos com backoff exponencial + jitter (full jitter), permanentes sobem
+    na hora. `executar` devolve o número de tentativas usadas.
+    """
+
+    def __init__(self, taxa, max_tentativas=5, base_s=2.0, teto_s=120.0):
+        self.taxa = taxa
+        self.max_tentativas = max_tentativas
+        self.base_s, self.teto_s = base_s, teto_s
+
+    def executar(self, entrega):
+        for tentativa in range(1, self.max_tentativas + 1):
+            self.taxa.limitador.aguardar()
+            try:
+                entrega()
+            except Exception as e:
+                transitorio = classificar_erro_smtp(e) == "transitorio"
+                self.taxa.registrar(False, throttle=transitorio and _eh_throttle(e))
+                if not transitorio or tentativa == self.max_tentativas:
+                    raise
+                time.sleep(random.uniform(0, min(self.teto_s, self.base_s * 2 ** (tentativa - 1))))
+            else:
+                self.taxa.registrar(True)
+                return tentativa
+
+    async def executar_async(self, entrega):
+        """Mesma política para o backend assíncrono: `entrega` é uma função que devolve um awaitable."""
+        for tentativa in range(1, self.max_tentativas + 1):
+            espera = self.taxa.limitador.reservar()
+            while espera:
+                await asyncio.sleep(espera)
+                espera = self.taxa.limitador.reservar()
+            try:
+                await entrega()
+            except Exception as e:
+                transitorio = classificar_erro_smtp(e) == "transitorio"
+                self.taxa.registrar(False, throttle=transitorio and _eh_throttle(e))
+                if not transitorio or tentativa == self.max_tentativas:
+                    raise
+                await asyncio.sleep(random.uniform(0, min(self.teto_s, self.base_s * 2 ** (tentativa - 1))))
+            else:
+                self.taxa.registrar(True)
+                return tentativa
+
+
+def criar_agendador(msgs_por_segundo=None):
+    """AgendadorEntrega + TaxaAdaptativa de um servidor SMTP (um por execução, não por lote)."""
+    return AgendadorEntrega(TaxaAdaptativa(LimitadorTaxa(msgs_por_segundo), taxa_max=msgs_por_segundo))
+
+
+def _csv_contrato(tarefa):
+    """(csv_bytes | None, n_linhas) do anexo de um contrato da tarefa."""
+    if "anexo_arrow" in tarefa:
+        # linhas do contrato lidas em streaming do histórico (Arrow IPC): o CSV nasce aqui
+        dados, n = tarefa["anexo_arrow"]
+        if not dados:
+            return None, 0
+        import pyarrow as pa
+        with METRICAS.etapa("to_csv"):
+            df_anexo = pa.ipc.open_stream(dados).read_all().to_pandas(types_mapper=_tipo_pandas)
+            return csv_anexo(df_anexo), n
+    df_anexo = tarefa["df_anexo"]
+    if df_anexo.empty:
+        return None, 0
+    with METRICAS.etapa("to_csv"):
+        return csv_anexo(df_anexo), len(df_anexo)
+
+
+def _juntar_csvs(csvs):
+    """Concatena CSVs do mesmo layout: BOM + cabeçalho só do primeiro."""
+    csvs = [c for c in csvs if c]
+    if len(csvs) <= 1:
+        return csvs[0] if csvs else None
+    return b"".join([csvs[0]] + [c[c.index(b"\n") + 1:] for c in csvs[1:]])
+
+
+def _kpi(contrato, perc, legenda):
+    return {"projeto": str(contrato["projeto"]), "prestador": str(contrato["prestador"]),
+            "contrato": str(contrato["contrato"]), "perc": float(perc), "legenda": legenda}
+
+
+def _renderizar_contrato(tarefa):
+    csv_bytes, n_anexo = _csv_contrato(tarefa)
+    html, grafico_bytes, texto, (perc, legenda) = montar_email(
+        tarefa["projeto"], tarefa["prestador"], tarefa["contrato"],
+        pd.to_datetime(tarefa["competencia"] + "-01"),
+        tarefa["df_cards_hist5"], tarefa["df_mes_atual"], tarefa["emails"], kpi=tarefa.get("kpi"),
+    )
+    return {
+        "assunto": f"[Pendências Docs] {tarefa['prestador']} | Contrato {tarefa['contrato']} | {tarefa['competencia']}",
+        "html": html, "texto": texto, "grafico_bytes": grafico_bytes, "graficos": None,
+        "csv_bytes": csv_bytes, "n_anexo": n_anexo, "kpis": [_kpi(tarefa, perc, legenda)],
+    }
+
+
+def _renderizar_digest(tarefa):
+    """Digest: uma mensagem com uma seção por contrato e um único CSV com todos."""
+    contratos = tarefa["contratos"]
+    csvs = [_csv_contrato(c) for c in contratos]
+    html, graficos, texto, kpis = montar_email_digest(
+        pd.to_datetime(tarefa["competencia"] + "-01"), contratos, tarefa["emails"]
+    )
+    return {
+        "assunto": f"[Pendências Docs] {tarefa['prestador']} | {_n_contratos(len(contratos))} | {tarefa['competencia']}",
+        "html": html, "texto": texto, "grafico_bytes": None, "graficos": graficos,
+        "csv_bytes": _juntar_csvs([b for b, _ in csvs]), "n_anexo": sum(n for _, n in csvs),
+        "kpis": [_kpi(c, perc, legenda) for c, (perc, legenda) in zip(contratos, kpis)],
+    }
+
+
+def _renderizar_grupo(tarefa):
+    """
+    Etapa CPU-bound (roda no pool de processos): CSV do anexo (+ compactação
+    acima de ANEXO_COMPACTAR_ACIMA) + gráfico + HTML + mensagem serializada.
+    Recebe DataFrames/str e devolve a MensagemBruta em render["mensagem"]
+    (mais assunto, n_anexo e kpis para o relatório).
+    Tarefas de digest (com "contratos") viram uma mensagem com uma seção por contrato.
+    """
+    render = _renderizar_digest(tarefa) if "contratos" in tarefa else _renderizar_contrato(tarefa)
+
+    csv_bytes, anexo = render.pop("csv_bytes"), None
+    if csv_bytes:
+        with METRICAS.etapa("compactar_anexo"):
+            anexo = compactar_anexo(csv_bytes, nome_anexo(render["assunto"]))
+        METRICAS.observar("anexo_bytes", len(anexo[0]))
+    # 🔹 a mensagem já sai daqui em bytes: só eles cruzam para o processo pai
+    with METRICAS.etapa("montar_mensagem"):
+        render["mensagem"] = mensagem_bytes(
+            tarefa["emails"], render["assunto"], render.pop("html"), render.pop("grafico_bytes"),
+            texto=render.pop("texto"), anexo=anexo, graficos=render.pop("graficos"),
+        )
+    render["metricas"] = METRICAS.drenar()   # amostras do worker, juntadas no processo pai
+    return render
+
+
+def _entregar(render, pool, agendador, diario=None, chave=None, liberar=False):
+    """
+    Etapa I/O-bound (roda no pool de threads): envia via agendador (taxa + retentativas).
+    Retorna o número de tentativas; o retorno da saída (ex.: arquivo gravado
+    pela SaidaEml) fica em render["entrega"]. Com `liberar`, os bytes da
+    mensagem são soltos logo após a última tentativa.
+    """
+    def _envio():
+        render["entrega"] = enviar_mensagem(render["mensagem"], pool)
+
+    try:
+        tentativas = agendador.executar(_envio)
+    except Exception as e:
+        if diario is not None:
+            diario.registrar(chave, "falhou", erro=str(e))
+        raise
+    finally:
+        if liberar:
+            _liberar(render=render)
+    if diario is not None:
+        diario.registrar(chave, "enviado")
+    return tentativas
+
+
+_PESADOS_TAREFA = ("df_cards_hist5", "df_mes_atual", "df_anexo", "anexo_arrow")
+_PESADOS_RENDER = ("mensagem",)
+
+
+def _liberar(tarefa=None, render=None):
+    """
+    Solta os DataFrames da tarefa (já foram para o worker) e/ou os bytes da
+    mensagem (já entregue); no relatório fica só o que o resumo e o índice usam.
+    """
+    if tarefa is not None:
+        for t in [tarefa] + tarefa.get("contratos", []):
+            for k in _PESADOS_TAREFA:
+                t.pop(k, None)
+    if render is not None:
+        for k in _PESADOS_RENDER:
+            render.pop(k, None)
+
+
+def pico_rss_mb(filhos=False):
+    """Pico de RSS (MB) deste processo ou, com `filhos`, do maior worker já encerrado."""
+    import resource
+    uso = resource.getrusage(resource.RUSAGE_CHILDREN if filhos else resource.RUSAGE_SELF).ru_maxrss
+    return uso / (2**20 if sys.platform == "darwin" else 2**10)   # macOS: bytes; Linux: KB
+
+
+def rss_atual_mb():
+    """RSS atual (MB) deste processo; fora do Linux, o pico."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return pico_rss_mb()
+
+
+def _submeter_assincrono(item, envio, agendador, liberar=False):
+    """
+    Backend assíncrono: a mensagem (já em bytes, do worker) vai para o
+    EnvioAssincrono (sem prender uma thread por mensagem em voo). Devolve o
+    Future dele, resolvido no event loop; diário e métricas ficam para
+    _concluir_assincrono, fora do loop.
+    """
+    render = item["render"]
+    msg = render["mensagem"]
+    if liberar:
+        _liberar(render=render)   # a fila guarda a mensagem (e as retentativas a reusam)
+    return envio.submeter(msg, agendador)
+
+
+def _concluir_assincrono(item, futuro, tamanho, diario=None):
+    """Na thread do pipeline: registra a entrega (diário com fsync, métricas) e devolve as tentativas."""
+    chave = item["tarefa"].get("chave")
+    try:
+        entrega = futuro.result()
+    except Exception as e:
+        if diario is not None and chave is not None:
+            diario.registrar(chave, "falhou", erro=str(e))
+        raise
+    _contabilizar_envio(tamanho)
+    item["render"]["entrega"] = entrega
+    if diario is not None and chave is not None:
+        diario.registrar(chave, "enviado")
+    return entrega["tentativas"]
+
+
+def _iniciar_worker_render():
+    """
+    Initializer dos workers: os locks herdados no fork (de METRICAS, GRAFICOS e
+    ATIVOS) podem ter sido copiados travados por outra thread do pai; cada
+    worker começa com locks novos.
+    """
+    for registro in (METRICAS, GRAFICOS, ATIVOS):
+        registro.apos_fork()
+
+
+def criar_pool_render(workers=None):
+    """
+    Pool de processos de render. 'fork' explícito: os workers herdam o estado
+    já carregado (dados, credenciais, logo e demais ATIVOS, lidos aqui antes do
+    fork) sem reexecutar o script. Todos os workers nascem aqui, de uma vez:
+    criado antes de qualquer thread (event loop do EnvioAssincrono, leitura do
+    histórico), nenhum fork copia um processo com threads rodando, e o mesmo
+    pool serve a todos os lotes e competências.
+    """
+    ATIVOS.precarregar()
+    pp = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                             initializer=_iniciar_worker_render)
+    pp.submit(int).result()   # com 'fork', o primeiro submit já cria todos os workers
+    return pp
+
+
+def executar_pipeline(tarefas, pool, workers_render=None, workers_envio=2, msgs_por_segundo=None,
+                      diario=None, enviar=True, janela=None, memoria_max_mb=None, liberar=False,
+                      pool_render=None, agendador=None):
+    """
+    Renderiza as tarefas em paralelo (processos) e entrega cada uma assim que fica
+    pronta. Com `enviar=False` (dry-run) só renderiza: `pool` pode ser None.
+    Retorna o relatório na MESMA ordem das tarefas: dicts com `tarefa`, `render`,
+    `status` ('enviado' | 'gravado' | 'renderizado' | 'erro_render' | 'erro_envio') e `erro`.
+    """
+    # 4xx/quedas são repetidos com backoff e a taxa se adapta (AIMD) a partir de
+    # `msgs_por_segundo` (também o teto; None = sem limite até o 1º throttling).
+    # Um `agendador` compartilhado entre lotes/meses guarda o que o AIMD aprendeu.
+    if agendador is None:
+        agendador = criar_agendador(msgs_por_segundo)
+    relatorio = [{"tarefa": t, "render": None, "status": None, "erro": None, "tentativas": 0}
+                 for t in tarefas]
+    # conclusões (render ou envio) chegam por callback numa fila única: o laço só
+    # acorda para o que terminou, sem reinstalar esperas nos futuros pendentes
+    concluidos = queue.Queue()
+    proxima = em_render = em_envio = 0
+    # backend assíncrono (EnvioAssincrono): a fila limitada dele substitui as threads
+    # de envio e a contrapressão segura o consumo dos renders. O event loop só
+    # resolve o Future; diário (fsync) e métricas de cada entrega são feitos aqui
+    assincrono = isinstance(pool, EnvioAssincrono)
+    tamanhos = {}
+    entregue = "enviado" if getattr(pool, "entrega_real", True) else "gravado"   # SaidaEml: gravado
+
+    # `pool_render` (de criar_pool_render) reaproveita workers já criados; sem ele,
+    # um pool próprio de `workers_render` processos é aberto e fechado aqui
+    render = nullcontext(pool_render) if pool_render is not None else criar_pool_render(workers_render)
+    with render as pp, ThreadPoolExecutor(max_workers=workers_envio) as tp:
+
+        def _avisar(etapa, i, futuro):
+            futuro.add_done_callback(lambda f: concluidos.put((etapa, i, f)))
+
+        def _alimentar():
+            # streaming: `janela` limita renders + entregas em aberto e, acima de
+            # `memoria_max_mb` de RSS, nada novo entra até algo em voo terminar;
+            # sem os dois, tudo é submetido de uma vez
+            nonlocal proxima, em_render
+            while proxima < len(tarefas):
+                em_voo = em_render + em_envio
+                if janela is not None and em_voo >= janela:
+                    return
+                if memoria_max_mb is not None and em_voo and rss_atual_mb() > memoria_max_mb:
+                    METRICAS.contar("pausas_memoria_total")
+                    return
+                _avisar("render", proxima, pp.submit(_renderizar_grupo, tarefas[proxima]))
+                proxima += 1
+                em_render += 1
+
+        # 🔹 cada render concluído já segue para envio (sem esperar os demais)
+        _alimentar()
+        while em_render or em_envio:
+            etapa, i, fut = concluidos.get()
+            item = relatorio[i]
+            if etapa == "envio":
+                em_envio -= 1
+                try:
+                    if assincrono:
+                        item["tentativas"] = _concluir_assincrono(item, fut, tamanhos.pop(i), diario)
+                    else:
+                        item["tentativas"] = fut.result()
+                    item["status"] = entregue
+                except Exception as e:
+                    item["status"], item["erro"] = "erro_envio", e
+                _alimentar()
+                continue
+
+            em_render -= 1
+            # `liberar`: DataFrames soltos após o render, bytes após a entrega
+            if liberar:
+                _liberar(tarefa=item["tarefa"])
+            # diário: cada transição vai pela `chave` da tarefa (sem chave, não registra)
+            chave = item["tarefa"].get("chave") if diario is not None else None
+            try:
+                item["render"] = fut.result()
+                METRICAS.mesclar(item["render"].pop("metricas"))
+            except Exception as e:
+                item["status"], item["erro"] = "erro_render", e
+                if chave is not None:
+                    diario.registrar(chave, "falhou", erro=str(e))
+            else:
+                if not enviar:
+                    item["status"] = "renderizado"
+                    if liberar:
+                        _liberar(render=item["render"])
+                else:
+                    if chave is not None:
+                        diario.registrar(chave, "renderizado")
+                    try:
+                        if assincrono:
+                            tamanhos[i] = len(item["render"]["mensagem"].dados)
+                            envio = _submeter_assincrono(item, pool, agendador, liberar)
+                        else:
+                            envio = tp.submit(_entregar, item["render"], pool, agendador,
+                                              diario, chave, liberar)
+                        _avisar("envio", i, envio)
+                        em_envio += 1
+                    except Exception as e:
+                        item["status"], item["erro"] = "erro_envio", e
+            _alimentar()
+
+    return relatorio
+
+
+class DiarioEnvio:
+    """
+    Diário durável da execução (JSONL append-only), uma linha por transição:
+        {"chave": ..., "estado": "renderizado" | "enviado" | "falhou", "erro": ..., "em": ...}
+    Ao reabrir, o último estado de cada chave é recuperado: uma execução retomada
+    pula o que já foi "enviado" e refaz só o resto (falhas e pendentes).
+    "enviado" e "falhou" são gravados (fsync) na hora: perdê-los numa queda
+    (SIGKILL, OOM, falta de energia) faria a execução retomada reenviar a
+    mensagem. Só "renderizado", que não evita reenvio, é acumulado e
+    descarregado em lote (a cada `lote` registros ou `intervalo_s` segundos).
+    """
+
+    DURAVEIS = frozenset({"enviado", "falhou"})
+
+    ESTADOS = ("renderizado", "enviado", "falhou")
+
+    def __init__(self, caminho, lote=100, intervalo_s=2.0):
+        self.caminho = caminho
+        self.lote = lote
+        self.intervalo_s = intervalo_s
+        self.estados = {}
+        self._pendentes = []
+        self._ultimo_flush = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+        self._carregar()
+        self._arquivo = open(caminho, "a", encoding="utf-8")
+
+    @staticmethod
+    def chave(projeto, prestador, contrato, competencia, emails):
+        """PROJETO|PRESTADOR|CONTRATO|COMPETENCIA|hash dos destinatários."""
+        dest = ",".join(sorted(e.strip().lower() for e in emails))
+        hash_dest = hashlib.sha1(dest.encode("utf-8")).hexdigest()[:12]
+        return f"{projeto}|{prestador}|{contrato}|{competencia}|{hash_dest}"
+
+    @staticmethod
+    def chave_digest(contratos, competencia, emails):
+        """DIGEST|nº de contratos|hash dos contratos|COMPETENCIA|hash dos destinatários."""
+        ids = "\n".join(sorted(f"{p}|{pr}|{c}" for p, pr, c in contratos))
+        hash_contratos = hashlib.sha1(ids.encode("utf-8")).hexdigest()[:12]
+        return DiarioEnvio.chave("DIGEST", len(contratos), hash_contratos, competencia, emails)
+
+    def _carregar(self):
+        if not os.path.exists(self.caminho):
+            return
+        with open(self.caminho, "r", encoding="utf-8") as f:
+            for linha in f:
+                try:
+                    reg = json.loads(linha)
+                except ValueError:
+                    continue   # última linha truncada por queda no meio da escrita
+                self.estados[reg["chave"]] = reg["estado"]
+
+    def estado(self, chave):
+        return self.estados.get(chave)
+
+    def concluido(self, chave):
+        return self.estados.get(chave) == "enviado"
+
+    def registrar(self, chave, estado, erro=None):
+        if estado not in self.ESTADOS:
+            raise ValueError(f"Estado inválido no diário: {estado}")
+        reg = {"chave": chave, "estado": estado, "em": datetime.now(TZ_BRA).isoformat()}
+        if erro:
+            reg["erro"] = erro
+        with self._lock:
+            self.estados[chave] = estado
+            self._pendentes.append(json.dumps(reg, ensure_ascii=False) + "\n")
+            if (estado in self.DURAVEIS
+                    or len(self._pendentes) >= self.lote
+                    or time.monotonic() - self._ultimo_flush >= self.intervalo_s):
+                self._descarregar()
+
+    def _descarregar(self):
+        if self._pendentes:
+            self._arquivo.write("".join(self._pendentes))
+            self._arquivo.flush()
+            os.fsync(self._arquivo.fileno())
+            self._pendentes.clear()
+        self._ultimo_flush = time.monotonic()
+
+    def fechar(self):
+        with self._lock:
+            self._descarregar()
+            self._arquivo.close()
+
+    def resumo(self):
+        contagem = {e: 0 for e in self.ESTADOS}
+        for estado in self.estados.values():
+            contagem[estado] += 1
+        return contagem
+
+
+# ============================================================
+# 🧪 BLOCO 6.2: DRY-RUN EM DISCO (.eml / mbox + index.html)
+# ============================================================
+
+_LINHA_INDICE = (
+    "<tr><td>{projeto}</td><td>{prestador}</td><td>{contrato}</td><td>{emails}</td>"
+    "<td style='text-align:right;'>{perc:.1f}%</td>"
+    "<td style='color:{cor};font-weight:bold;'>{legenda}</td>"
+    "<td style='text-align:right;'>{kb:.1f} KB</td><td><a href='{link}'>{arquivo}</a></td></tr>"
+)
+
+
+class SaidaEml:
+    """
+    Substitui o SMTP no dry-run: mesma interface do PoolSMTP (enviar/fechar,
+    context manager), mas cada mensagem RFC 822 vai para `diretorio`, um `.eml`
+    por mensagem ou um único `mensagens.mbox`. As mensagens chegam já
+    serializadas dos workers de render (MensagemBruta): aqui só são gravados os
+    bytes, com a escrita acumulada e feita em bloco (a cada `lote` mensagens ou
+    `lote_bytes`). escrever_indice() gera o index.html de conferência.
+    """
+
+    entrega_real = False   # métricas: mensagens_gravadas_total, não enviadas
+
+    def __init__(self, diretorio, formato="eml", lote=500, lote_bytes=32 * 2**20):
+        if formato not in ("eml", "mbox"):
+            raise ValueError(f"formato inválido: {formato!r} (use 'eml' ou 'mbox')")
+        self.diretorio = diretorio
+        self.formato = formato
+        self.lote = lote
+        self.lote_bytes = lote_bytes
+        self.mensagens = self.bytes_total = 0
+        self._pendentes = []
+        self._bytes_pendentes = 0
+        self._lock = threading.Lock()
+        os.makedirs(diretorio, exist_ok=True)
+        self._mbox = None
+        if formato == "mbox":
+            self._mbox = open(os.path.join(diretorio, "mensagens.mbox"), "wb", buffering=1 << 20)
+
+    _FROM_MBOX = re.compile(rb"(?m)^From ")
+
+    def enviar(self, msg):
+        if isinstance(msg, MensagemBruta):
+            dados, assunto = msg.dados, msg.assunto
+        else:
+            dados, assunto = msg.as_bytes(), str(msg["Subject"])
+        if self._mbox is not None:
+            # separador "From " do mbox (linhas em LF); linhas do corpo que começam com "From " são escapadas
+            dados = (b"From MAILER-DAEMON " + time.asctime().encode("ascii") + b"\n"
+                     + self._FROM_MBOX.sub(b">From ", dados.replace(b"\r\n", b"\n")).rstrip(b"\n") + b"\n\n")
+        with self._lock:
+            self.mensagens += 1
+            self.bytes_total += len(dados)
+            if self._mbox is not None:
+                arquivo = f"mensagens.mbox#{self.mensagens}"
+            else:
+                arquivo = f"{self.mensagens:06d}_{_CARACTERES_NOME.sub('_', assunto)[:80]}.eml"
+            self._pendentes.append((arquivo, dados))
+            self._bytes_pendentes += len(dados)
+            if len(self._pendentes) >= self.lote or self._bytes_pendentes >= self.lote_bytes:
+                self._descarregar()
+        return {"arquivo": arquivo, "bytes": len(dados)}
+
+    def _descarregar(self):
+        if self._mbox is not None:
+            self._mbox.write(b"".join(dados for _, dados in self._pendentes))
+        else:
+            for arquivo, dados in self._pendentes:
+                with open(os.path.join(self.diretorio, arquivo), "wb") as f:
+                    f.write(dados)
+        self._pendentes, self._bytes_pendentes = [], 0
+
+    def fechar(self):
+        with self._lock:
+            self._descarregar()
+            if self._mbox is not None:
+                self._mbox.close()
+                self._mbox = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+
+    def escrever_indice(self, relatorio, titulo="Dry-run"):
+        """index.html: uma linha por contrato (digest: uma por seção) com KPI, legenda e tamanho."""
+        linhas = []
+        for item in relatorio:
+            render = item["render"] or {}
+            entrega = render.get("entrega")
+            if entrega is None:
+                continue
+            link = entrega["arquivo"].split("#")[0]
+            emails = escape(", ".join(item["tarefa"]["emails"]))
+            for kpi in render["kpis"]:
+                linhas.append(_LINHA_INDICE.format(
+                    projeto=escape(kpi["projeto"]), prestador=escape(kpi["prestador"]),
+                    contrato=escape(kpi["contrato"]), emails=emails,
+                    perc=kpi["perc"] * 100, legenda=escape(kpi["legenda"]),
+                    cor=CORES_LEGENDA.get(kpi["legenda"], "#6B7280"),
+                    kb=entrega["bytes"] / 1024, link=escape(link), arquivo=escape(entrega["arquivo"]),
+                ))
+        caminho = os.path.join(self.diretorio, "index.html")
+        with open(caminho, "w", encoding="utf-8") as f:
+            f.write(
+                "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+                f"<title>{escape(titulo)}</title></head>"
+                f"<body style='font-family:Arial,sans-serif;font-size:12px;color:{COR_TEXTO};'>"
+                f"<h2 style='color:{COR_PRINCIPAL};'>{escape(titulo)}</h2>"
+                f"<p>{self.mensagens} mensagens · {self.bytes_total / 2**20:.1f} MB</p>"
+                "<table style='border-collapse:collapse;' border='1' cellpadding='4'>"
+                f"<thead><tr style='background:{COR_PRINCIPAL};color:white;'>"
+                "<th>Projeto</th><th>Prestador</th><th>Contrato</th><th>Destinatários</th>"
+                "<th>% Atingido</th><th>Legenda</th><th>Tamanho</th><th>Mensagem</th></tr></thead>"
+                f"<tbody>{''.join(linhas)}</tbody></table></body></html>"
+            )
+        return caminho
+
+
+# ============================================================
+# 🔁 BLOCO 6.3: DETECÇÃO DE MUDANÇAS (só envia contrato cujo conteúdo mudou)
+# ============================================================
+
+SOMENTE_ALTERADOS = False   # True = pula contratos iguais ao último envio (--somente-alterados)
+HASHES_PATH = os.path.join(CACHE_DIR, "hashes_envio.sqlite")
+COLUNAS_HASH_CONTEUDO = ["DOCUMENTO", "STATUS_GERAL_Regra", "DOCUMENTO_APROV_OBS2", "DOCUMENTO_APROV_REGULARIZA2"]
+CHAVE_GRUPO_ENVIO = ["PROJETO", "PRESTADOR", "CONTRATO", "COMPETENCIA", "email_envio"]
+
+
+def hashes_conteudo(df_envio, chaves=CHAVE_GRUPO_ENVIO, kpis=None):
+    """
+    Hash (uint64) do conteúdo de cada grupo de envio, calculado em bloco:
+    hash_pandas_object das COLUNAS_HASH_CONTEUDO de todas as linhas de uma vez,
+    soma por grupo (mod 2^64, não depende da ordem das linhas), combinada com o
+    hash do KPI (perc, críticos, legenda) de calcular_kpis_lote (`kpis`, se já
+    calculado sobre o mesmo df_envio/chaves), casado pelas chaves do grupo.
+    Retorna {chave do grupo: int}.
+    """
+    chaves = list(chaves)
+    if df_envio.empty:
+        return {}
+    linhas = pd.Series(pd.util.hash_pandas_object(df_envio[COLUNAS_HASH_CONTEUDO], index=False).to_numpy(),
+                       index=df_envio.index, name="soma")
+    soma = linhas.groupby([df_envio[c] for c in chaves], sort=False, dropna=False, observed=True).sum()
+
+    if kpis is None:
+        kpis = calcular_kpis_lote(df_envio, chaves)
+    grupos = soma.reset_index().merge(kpis[chaves + ["perc", "criticos", "legenda"]],
+                                      on=chaves, how="left", validate="one_to_one", indicator=True)
+    if (grupos["_merge"] != "both").any():
+        raise ValueError("hashes_conteudo: `kpis` não cobre todos os grupos de df_envio")
+    hash_kpi = pd.util.hash_pandas_object(
+        pd.DataFrame({"perc": grupos["perc"].round(6), "criticos": grupos["criticos"],
+                      "legenda": grupos["legenda"]}),
+        index=False,
+    ).to_numpy()
+    total = grupos["soma"].to_numpy(dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15) + hash_kpi
+    return dict(zip(map(tuple, grupos[chaves].itertuples(index=False)), map(int, total)))
+
+
+class HashesEnvio:
+    """
+    Último conteúdo enviado por contrato + destinatários, num SQLite local
+    (uma linha por chave: hash, competência, quando). Carregado inteiro na
+    abertura; os registros novos são gravados em lote com gravar()/fechar().
+    """
+
+    def __init__(self, caminho):
+        os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+        self.caminho = caminho
+        self._con = sqlite3.connect(caminho, check_same_thread=False)
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "chave TEXT PRIMARY KEY, hash INTEGER NOT NULL, competencia TEXT, enviado_em REAL)"
+        )
+        self._hashes = dict(self._con.execute("SELECT chave, hash FROM hashes"))
+        self._pendentes = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chave(projeto, prestador, contrato, emails):
+        """PROJETO|PRESTADOR|CONTRATO|hash dos destinatários (sem competência)."""
+        return DiarioEnvio.chave(projeto, prestador, contrato, "*", emails)
+
+    @staticmethod
+    def _int64(valor):
+        # SQLite guarda INTEGER com sinal
+        return valor - 2**64 if valor >= 2**63 else valor
+
+    def inalterado(self, chave, valor):
+        return self._hashes.get(chave) == self._int64(valor)
+
+    def registrar(self, chave, valor, competencia):
+        with self._lock:
+            self._hashes[chave] = self._int64(valor)
+            self._pendentes.append((chave, self._hashes[chave], competencia, time.time()))
+
+    def gravar(self):
+        with self._lock:
+            if self._pendentes:
+                self._con.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", self._pendentes)
+                self._con.commit()
+                self._pendentes = []
+
+    def fechar(self):
+        self.gravar()
+        self._con.close()
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+def registrar_enviados(hashes, relatorio):
+    """Guarda o hash de cada contrato efetivamente enviado (digest: de cada seção)."""
+    for item in relatorio:
+        if item["status"] != "enviado":
+            continue
+        t = item["tarefa"]
+        for c in t.get("contratos", [t]):
+            if "hash_conteudo" in c:
+                hashes.registrar(*c["hash_conteudo"], c["competencia"])
+    hashes.gravar()
+
+
+def chave_contrato_texto(projeto, prestador, contrato):
+    """Chave "PROJETO|PRESTADOR|CONTRATO" do filtro e da ordem de SQL_PENDENCIAS_HIST_CONTRATOS."""
+    return f"{projeto}|{prestador}|{contrato}"
+
+
+def consultar_historico_contratos(chaves):
+    """Histórico de pendências dos contratos `chaves`: record batches ordenados por chave_contrato_texto."""
+    return query_bq_lotes(
+        SQL_PENDENCIAS_HIST_CONTRATOS,
+        {"contratos": {"type": "STRING", "value": sorted(chave_contrato_texto(*k) for k in chaves)}},
+        arrow=True,
+    )
+
+
+def _historico_por_contrato(lotes):
+    """
+    Uma passada em streaming sobre o histórico (record batches ordenados por
+    contrato): junta as linhas de cada contrato, ainda em Arrow, e gera
+    (chave, ipc_bytes, n_linhas) assim que o contrato termina. Os bytes (Arrow
+    IPC só com as linhas do contrato) vão na tarefa; o CSV é escrito no worker
+    de render (_csv_contrato), não no processo principal.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    atual, partes = None, []
+
+    def _fechar():
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, partes[0].schema) as escritor:
+            for parte in partes:
+                escritor.write_batch(parte)
+        return atual, sink.getvalue().to_pybytes(), sum(parte.num_rows for parte in partes)
+
+    for lote in lotes:
+        if not lote.num_rows:
+            continue
+        # início de cada trecho de linhas com a mesma chave (o lote vem ordenado)
+        chave_txt = pc.binary_join_element_wise(
+            *(pc.cast(lote.column(c), pa.string()) for c in CHAVE_CONTRATO), "|")
+        inicios = [0] + (pc.indices_nonzero(pc.not_equal(chave_txt[1:], chave_txt[:-1])).to_numpy() + 1).tolist()
+        for inicio, fim in zip(inicios, inicios[1:] + [lote.num_rows]):
+            chave = tuple(lote.column(c)[inicio].as_py() for c in CHAVE_CONTRATO)
+            if chave != atual:
+                if partes:
+                    yield _fechar()
+                atual, partes = chave, []
+            # contrato que continua no lote seguinte: mais uma fatia (sem cópia) do mesmo anexo
+            partes.append(lote.slice(inicio, fim - inicio))
+    if partes:
+        yield _fechar()
+
+
+def anexos_por_contrato(lotes):
+    """
+    {(PROJETO, PRESTADOR, CONTRATO): (ipc_bytes, n_linhas)} a partir dos record
+    batches do histórico (ver _historico_por_contrato). Em memória ficam só as
+    linhas dos contratos do envio, em Arrow, nunca o histórico como DataFrame.
+    """
+    return {chave: (dados, n) for chave, dados, n in _historico_por_contrato(lotes)}
+
+
+class AnexosOrdenados:
+    """
+    Histórico de pendências de uma competência inteira, lido UMA vez e
+    repartido entre os lotes do --streaming: a consulta e os lotes seguem a
+    mesma ordem (chave_contrato_texto), então cada lote consome só o trecho do
+    fluxo até o seu último contrato. Em memória fica no máximo um lote de
+    anexos (e o record batch em leitura), nunca o histórico inteiro.
+    """
+
+    def __init__(self, lotes_hist):
+        self._fluxo = _historico_por_contrato(lotes_hist)
+        self._proximo = next(self._fluxo, None)
+
+    def ate(self, df_lote):
+        """Anexos {chave: (ipc_bytes, n_linhas)} dos contratos de `df_lote` ((None, 0) sem histórico)."""
+        chaves = [tuple(k) for k in df_lote[CHAVE_CONTRATO].drop_duplicates().itertuples(index=False)]
+        anexos = dict.fromkeys(chaves, (None, 0))
+        if not chaves:
+            return anexos
+        limite = max(chave_contrato_texto(*k) for k in chaves)
+        while self._proximo is not None and chave_contrato_texto(*self._proximo[0]) <= limite:
+            chave, dados, n = self._proximo
+            if chave in anexos:
+                anexos[chave] = (dados, n)
+            self._proximo = next(self._fluxo, None)
+        return anexos
+
+
+# ============================================================
+# 🔧 Normalização e envio
+# ============================================================
+
+def _n_contratos(n):
+    return f"{n} contrato" if n == 1 else f"{n} contratos"
+
+
+def agrupar_digest(tarefas):
+    """
+    Reagrupa tarefas por contrato em tarefas de digest, uma por conjunto
+    normalizado de destinatários (minúsculas, sem repetição, ordenado), na
+    ordem em que cada conjunto aparece. Cada digest leva os contratos em "contratos".
+    O minúsculo só agrupa: o envio vai para a grafia original de cada endereço
+    (a parte local pode diferenciar maiúsculas), a primeira vista no grupo.
+    """
+    grupos = {}
+    for t in tarefas:
+        grafias = {}
+        for e in t["emails"]:
+            grafias.setdefault(e.lower(), e)
+        originais, contratos = grupos.setdefault((t["competencia"], tuple(sorted(grafias))), ({}, []))
+        for chave, e in grafias.items():
+            originais.setdefault(chave, e)
+        contratos.append(t)
+
+    digests = []
+    for (competencia, destinatarios), (originais, contratos) in grupos.items():
+        chaves = [(c["projeto"], c["prestador"], c["contrato"]) for c in contratos]
+        digests.append({
+            "chave": DiarioEnvio.chave_digest(chaves, competencia, destinatarios),
+            "prestador": _nome_prestadores(c["prestador"] for c in contratos),
+            "contrato": _n_contratos(len(contratos)),
+            "competencia": competencia, "emails": [originais[d] for d in destinatarios],
+            "contratos": contratos,
+        })
+    return digests
+
+
+# ------------------------------------------------------------
+# 🌊 Streaming: lotes de contratos com memória limitada (--streaming)
+# ------------------------------------------------------------
+MODO_STREAMING = False              # True = processa a competência em lotes de contratos
+STREAMING_CONTRATOS_POR_LOTE = 2000
+MEMORIA_MAX_MB = float(os.environ["DOCVS_MEMORIA_MAX_MB"]) if os.environ.get("DOCVS_MEMORIA_MAX_MB") else None
+
+
+def _filtrar_envio(df_base, competencia, projetos=None):
+    """Linhas da competência (e projetos) de envio; sem cópia quando o filtro não tira nada."""
+    sel = (_competencia_ym(df_base["COMPETENCIA"]) == competencia).to_numpy(dtype=bool)
+    if projetos:
+        sel &= df_base["PROJETO"].isin(projetos).to_numpy(dtype=bool)
+    return df_base if sel.all() else df_base[sel]
+
+
+_SEPARADOR_EMAILS = re.compile(r"[;,]")
+
+
+def _destinatarios(email_raw):
+    """Conjunto normalizado de destinatários (como em agrupar_digest), em texto."""
+    return ";".join(sorted({e.strip().lower() for e in _SEPARADOR_EMAILS.split(str(email_raw)) if e.strip()}))
+
+
+def lotes_envio(df_base, competencia, projetos=None, contratos_por_lote=STREAMING_CONTRATOS_POR_LOTE,
+                digest=MODO_DIGEST):
+    """
+    Gera fatias da competência de envio ordenadas pela chave do contrato, com
+    até `contratos_por_lote` contratos cada, sem partir um contrato entre lotes.
+    No digest a chave é o conjunto de destinatários (um digest inteiro por lote).
+    Fora dele, a ordem é a de chave_contrato_texto, a mesma do histórico lido
+    por AnexosOrdenados. Cada fatia vai a preparar_tarefas como `df_base`: só
+    ela vira tarefas, anexos e mensagens ao mesmo tempo.
+    """
+    df_envio = _filtrar_envio(df_base, competencia, projetos)
+    if df_envio.empty:
+        return
+    if digest:
+        chaves = [df_envio["email_envio"].map(_destinatarios)]
+    else:
+        p, pr, c = (df_envio[col].astype(str) for col in CHAVE_CONTRATO)
+        chaves = [p + "|" + pr + "|" + c]
+    # ngroup com sort=True numera as chaves na ordem de classificação
+    grupo = df_envio.groupby(chaves, sort=True, dropna=False, observed=True).ngroup().to_numpy()
+    ordem = np.argsort(grupo, kind="stable")
+    lote = grupo[ordem] // contratos_por_lote
+    for pos in np.split(ordem, np.flatnonzero(np.diff(lote)) + 1):
+        yield df_envio.iloc[pos]
+
+
+def preparar_tarefas(df_base, df_cards, df_pendencias_hist, competencia, diario=None, projetos=None,
+                     digest=MODO_DIGEST, indice_cards=None, anexos_hist=None, hashes=None):
+    """
+    Agrupa a competência de envio por (PROJETO, PRESTADOR, CONTRATO, COMPETENCIA,
+    email_envio) e monta uma tarefa por grupo; com `diario`, pula o que já foi
+    enviado. Retorna (tarefas, ja_enviados).
+    """
+    # (com as colunas categóricas, o filtro e o groupby comparam códigos inteiros)
+    # `projetos` restringe a alguns projetos (--only)
+    df_envio = _filtrar_envio(df_base, competencia, projetos)
+    grupos = df_envio.groupby(CHAVE_GRUPO_ENVIO, observed=True)
+    # KPI (perc, legenda) de todos os grupos numa passada; vai pronto na tarefa
+    kpis = calcular_kpis_lote(df_envio, CHAVE_GRUPO_ENVIO)
+    # com `hashes` (HashesEnvio), contratos iguais ao último envio são pulados antes do render
+    conteudo = hashes_conteudo(df_envio, kpis=kpis) if hashes is not None else {}
+    kpi_grupo = dict(zip(map(tuple, kpis[CHAVE_GRUPO_ENVIO].itertuples(index=False)),
+                         zip(kpis["perc"].astype(float), kpis["legenda"])))
+
+    print(f"📧 Preparando {len(grupos)} e-mails (competência {competencia})...\n")
+
+    # 🔹 índices por contrato (montados uma única vez para todos os grupos); no
+    #    backfill, `indice_cards` e `anexos_hist` vêm de fora e são reaproveitados
+    #    entre os meses: só contratos ainda não vistos vão ao BigQuery
+    if indice_cards is None:
+        indice_cards = IndiceContratos(df_cards)
+    ultimos_5 = _lista_ultimos_5_meses(competencia)
+    if HIST_FILTRADO_POR_CONTRATO:
+        # 🔹 histórico só dos contratos presentes no envio (e ainda não lidos),
+        #    separado por contrato em Arrow (o CSV é escrito no worker de render)
+        if anexos_hist is None:
+            anexos_hist = {}
+        novos = [tuple(k) for k in df_envio[CHAVE_CONTRATO].drop_duplicates().itertuples(index=False)
+                 if tuple(k) not in anexos_hist]
+        if novos:
+            anexos_hist.update(anexos_por_contrato(consultar_historico_contratos(novos)))
+            for k in novos:
+                anexos_hist.setdefault(k, (None, 0))   # sem histórico: não consulta de novo
+        print(f"📚 Pendências históricas: {sum(n for _, n in anexos_hist.values())} registros "
+              f"em {sum(1 for b, _ in anexos_hist.values() if b)} contratos\n")
+    else:
+        indice_pendencias = IndiceContratos(df_pendencias_hist)
+
+    ja_enviados = inalterados = 0
+    tarefas = []
+    for (projeto, prestador, contrato, competencia_str, email_raw), grupo in grupos:
+        if not email_raw or str(email_raw).strip() == "":
+            print(f"⚠️ Sem e-mail para {prestador} - {contrato}")
+            continue
+
+        emails = [e.strip() for e in _SEPARADOR_EMAILS.split(str(email_raw)) if e.strip()]
+
+        chave = DiarioEnvio.chave(projeto, prestador, contrato, competencia_str, emails)
+        if not digest and diario is not None and diario.concluido(chave):
+            ja_enviados += 1
+            continue
+
+        chave_grupo = (projeto, prestador, contrato, competencia_str, email_raw)
+        hash_conteudo = None
+        if hashes is not None:
+            chave_hash = HashesEnvio.chave(projeto, prestador, contrato, emails)
+            valor = conteudo[chave_grupo]
+            if hashes.inalterado(chave_hash, valor):
+                inalterados += 1
+                continue
+            hash_conteudo = (chave_hash, valor)
+
+        tarefa = {
+            "chave": chave,
+            "projeto": projeto, "prestador": prestador, "contrato": contrato,
+            "competencia": competencia_str, "emails": emails,
+            "df_cards_hist5": historico_5_meses(df_cards, projeto, prestador, contrato, indice_cards,
+                                                ultimos_5=ultimos_5),
+            "df_mes_atual": _sem_categorias(grupo),
+            "kpi": kpi_grupo[chave_grupo],
+        }
+        if hash_conteudo is not None:
+            tarefa["hash_conteudo"] = hash_conteudo
+        # 🔹 Pendências históricas (todas as competências) do mesmo projeto/prestador/contrato
+        if HIST_FILTRADO_POR_CONTRATO:
+            tarefa["anexo_arrow"] = anexos_hist.get((projeto, prestador, contrato), (None, 0))
+        else:
+            tarefa["df_anexo"] = _sem_categorias(indice_pendencias.fatia(projeto, prestador, contrato))
+        tarefas.append(tarefa)
+
+    if inalterados:
+        METRICAS.contar("contratos_inalterados_total", inalterados)
+        print(f"🟰 {inalterados} contratos sem mudança desde o último envio (pulados)\n")
+
+    # `digest`: as tarefas são reagrupadas por destinatários
+    if digest:
+        tarefas = agrupar_digest(tarefas)
+        print(f"📬 Digest: {len(tarefas)} mensagens por conjunto de destinatários\n")
+        if diario is not None:
+            pendentes = [t for t in tarefas if not diario.concluido(t["chave"])]
+            ja_enviados, tarefas = len(tarefas) - len(pendentes), pendentes
+
+    return tarefas, ja_enviados
+
+
+def imprimir_relatorio(relatorio):
+    """Relatório da execução (mesma ordem dos grupos)."""
+    for item in relatorio:
+        t, r = item["tarefa"], item["render"]
+        if r is not None:
+            if r["n_anexo"]:
+                print(f"📎 {r['n_anexo']} pendências anexadas → {t['prestador']} | {t['contrato']}")
+            else:
+                print(f"📎 Nenhuma pendência histórica para {t['prestador']} - {t['contrato']}")
+        if item["status"] == "gravado":
+            print(f"💾 Gravado → {t['prestador']} | {t['contrato']} | {t['competencia']} → {r['entrega']['arquivo']}")
+        elif item["status"] == "enviado":
+            extra = f" ({item['tentativas']} tentativas)" if item["tentativas"] > 1 else ""
+            print(f"✅ Enviado → {t['prestador']} | {t['contrato']} | {t['competencia']} → {', '.join(t['emails'])}{extra}")
+        elif item["status"] == "renderizado":
+            print(f"🧪 Renderizado (dry-run) → {t['prestador']} | {t['contrato']} | {t['competencia']} "
+                  f"→ {', '.join(t['emails'])}")
+        elif item["status"] == "erro_render":
+            print(f"❌ Erro ao montar e-mail para {t['prestador']} - {t['contrato']}: {item['erro']}")
+        else:
+            print(f"❌ Erro ao enviar para {t['prestador']} - {t['contrato']} "
+                  f"({classificar_erro_smtp(item['erro'])}): {item['erro']}")
+
+
+def _argumentos(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Disparo mensal dos e-mails de pendências documentais por contrato.",
+    )
+    parser.add_argument("--competencia", default=None, metavar="YYYY-MM",
+                        help="competência de envio (padrão: mês anterior); início do backfill com --ate")
+    parser.add_argument("--ate", default=None, metavar="YYYY-MM",
+                        help="backfill: envia de --competencia até esta competência (inclusive), "
+                             "com uma única carga de dados")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="só consulta e renderiza: não lê credenciais SMTP, não envia nem grava diário")
+    parser.add_argument("--saida", default=None, metavar="DIR",
+                        help="dry-run completo: grava as mensagens em DIR (.eml) com um index.html")
+    parser.add_argument("--mbox", action="store_true",
+                        help="com --saida, grava um único mensagens.mbox em vez de um .eml por mensagem")
+    parser.add_argument("--only", action="append", default=None, metavar="PROJETO",
+                        help="restringe o envio a um projeto (pode repetir)")
+    parser.add_argument("--backend", choices=("sync", "async"), default=BACKEND_ENVIO,
+                        help="entrega por smtplib (threads) ou aiosmtplib (event loop, N sessões)")
+    parser.add_argument("--digest", action="store_true", default=MODO_DIGEST,
+                        help="uma mensagem por conjunto de destinatários, com uma seção por contrato")
+    parser.add_argument("--somente-alterados", action="store_true", default=SOMENTE_ALTERADOS,
+                        help="só envia contratos cujo conteúdo (documentos, status, obs., KPI) "
+                             "mudou desde o último envio")
+    parser.add_argument("--streaming", action="store_true", default=MODO_STREAMING,
+                        help="processa cada competência em lotes de contratos (ordenados pela chave), "
+                             "soltando cada mensagem logo após a entrega")
+    parser.add_argument("--lote-contratos", type=int, default=STREAMING_CONTRATOS_POR_LOTE, metavar="N",
+                        help="com --streaming, contratos por lote")
+    parser.add_argument("--memoria-max-mb", type=float, default=MEMORIA_MAX_MB, metavar="MB",
+                        help="teto de RSS: acima dele, novas tarefas esperam o que está em voo terminar")
+    parser.add_argument("--invalidar-cache", action="store_true", default=INVALIDAR_CACHE,
+                        help="ignora o cache em disco e rebusca tudo no BigQuery")
+    parser.add_argument("--cubo", default=None, metavar="ARQUIVO",
+                        help="com --dry-run/--saida: lê o Cubo_Documentos exportado (.parquet ou CSV ';') "
+                             "em vez do BigQuery; não precisa de credenciais")
+    parser.add_argument("--cache-listar", action="store_true",
+                        help="lista as partições do cache em disco (nome, competência, linhas, tamanho, "
+                             "idade) e sai, sem consultar o BigQuery")
+    parser.add_argument("--cache-podar", default=None, metavar="YYYY-MM",
+                        help="apaga do cache as partições de competências anteriores a YYYY-MM e sai")
+    args = parser.parse_args(argv)
+    if args.mbox and not args.saida:
+        parser.error("--mbox requer --saida DIR")
+    args.dry_run = args.dry_run or args.saida is not None
+    if args.cubo and not args.dry_run:
+        parser.error("--cubo só vale com --dry-run ou --saida (nada é enviado a partir de um cubo local)")
+    if args.ate and not args.competencia:
+        parser.error("--ate requer --competencia (início do backfill)")
+    competencia = args.competencia or competencia_padrao()
+    try:
+        args.competencia = str(pd.Period(competencia, freq="M"))
+        args.ate = str(pd.Period(args.ate, freq="M")) if args.ate else None
+    except ValueError:
+        parser.error(f"competência inválida: {competencia!r} / {args.ate!r} (use YYYY-MM)")
+    if args.ate and args.ate < args.competencia:
+        parser.error("--ate deve ser igual ou posterior a --competencia")
+    if args.cache_podar:
+        try:
+            args.cache_podar = str(pd.Period(args.cache_podar, freq="M"))
+        except ValueError:
+            parser.error(f"competência inválida em --cache-podar: {args.cache_podar!r} (use YYYY-MM)")
+    return args
+
+
+def manter_cache(cache, podar=None, listar=False):
+    """
+    Manutenção do cache em disco pela linha de comando (--cache-podar / --cache-listar):
+    poda as competências anteriores a `podar` e/ou imprime as partições restantes.
+    """
+    if podar:
+        antes = len(cache.inspecionar())
+        cache.podar(podar)
+        print(f"🗄️ Cache {cache.raiz}: {antes - len(cache.inspecionar())} partição(ões) anteriores a {podar} removida(s)")
+    if listar:
+        partes = cache.inspecionar()
+        if partes.empty:
+            print(f"🗄️ Cache {cache.raiz}: vazio")
+        else:
+            print(partes.to_string(index=False))
+            print(f"🗄️ {len(partes)} partição(ões), {partes['bytes'].sum() / 1e6:.1f} MB em {cache.raiz}")
+    return 0
+
+
+# ------------------------------------------------------------
+# 🧪 Cubo local: as consultas do BigQuery respondidas de um Cubo_Documentos exportado
+# ------------------------------------------------------------
+# mesmos termos do SQL_CARDS: projetos que também contam "Em Análise" como conforme
+_SQL_CARDS_PROJETOS_EM_ANALISE = ("Reparação Bacia do Rio Doce", "Samarco - COA")
+_STATUS_PENDENTES = ("Não Conforme", "Não Enviado")
+
+
+def _safe_cast_float(serie):
+    """SAFE_CAST(x AS FLOAT64): o que não converte vira NULL (NaN)."""
+    return pd.to_numeric(serie, errors="coerce").astype(float)
+
+
+def _safe_cast_int(serie):
+    """SAFE_CAST(x AS INT64): texto só converte se for inteiro ('1.0', 'x', '' → NULL)."""
+    if pd.api.types.is_numeric_dtype(serie.dtype):
+        return pd.to_numeric(serie, errors="coerce")
+    texto = serie.astype("string").str.strip()
+    return pd.to_numeric(texto.where(texto.str.fullmatch(r"[+-]?\d+").fillna(False)), errors="coerce")
+
+
+def agregar_cards_cubo(cubo):
+    """
+    O SELECT de `base` do SQL_CARDS sobre as linhas já filtradas da janela:
+    por (PROJETO, PRESTADOR, CONTRATO, COMPETENCIA), com SAFE_CAST e as mesmas
+    regras de conformidade, ordenado por COMPETENCIA.
+    """
+    status = cubo["STATUS_GERAL_Regra"].astype(object)
+    em_analise = cubo["PROJETO"].isin(_SQL_CARDS_PROJETOS_EM_ANALISE).to_numpy(dtype=bool)
+    conforme = np.where(em_analise, status.isin(["Conforme", "Em Análise"]), status == "Conforme")
+    conforme &= cubo["PROJETO"].notna().to_numpy(dtype=bool)   # PROJETO NULL: nem IN nem NOT IN
+    pendente = (status == "Não Conforme").to_numpy(dtype=bool)
+    aux = pd.DataFrame({
+        # CASE WHEN ... THEN SAFE_CAST(RELEVANCIA AS FLOAT64) ELSE 0 END
+        "perc_atingido": np.where(conforme, _safe_cast_float(cubo["RELEVANCIA"]).to_numpy(), 0.0),
+        "total_pendencias": pendente.astype(int),
+        "total_criticos": (pendente & (_safe_cast_int(cubo["CRITICO"]) == 1).fillna(False)
+                           .to_numpy(dtype=bool)).astype(int),
+    }, index=cubo.index)
+    chaves = [cubo[c] for c in CHAVE_KPI]
+    grupos = aux.groupby(chaves, sort=False, dropna=False, observed=True)
+    cards = grupos[["total_pendencias", "total_criticos"]].sum()
+    cards["perc_atingido"] = grupos["perc_atingido"].sum(min_count=1)   # SUM só de NULL = NULL
+    return cards.reset_index().sort_values("COMPETENCIA", kind="stable", ignore_index=True)
+
+
+class _ResultadoCubo:
+    def __init__(self, tabela, tamanho_lote):
+        self.tabela, self.tamanho_lote = tabela, tamanho_lote
+
+    def result(self):
+        return self
+
+    def to_arrow(self, bqstorage_client=None):
+        return self.tabela
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        yield from self.tabela.to_batches(max_chunksize=self.tamanho_lote)
+
+
+class ClienteCuboLocal:
+    """
+    Cliente no lugar do bigquery.Client (o `bq_client` global) que responde às
+    consultas deste módulo a partir de um Cubo_Documentos em memória, com a
+    mesma interface usada por query_bq/query_bq_lotes
+    (.query(sql, job_config).result().to_arrow...). Cada SQL conhecido é
+    reproduzido em pandas; outro SQL levanta ValueError. `consultas` conta as chamadas.
+    """
+
+    def __init__(self, cubo, tamanho_lote=50_000):
+        self.cubo = cubo
+        self.tamanho_lote = tamanho_lote
+        self.consultas = 0
+
+    @staticmethod
+    def _parametros(job_config):
+        params = {}
+        for p in getattr(job_config, "query_parameters", None) or []:
+            params[p.name] = p.values if hasattr(p, "values") else p.value
+        return params
+
+    def _cards(self, competencias):
+        c = self.cubo
+        return agregar_cards_cubo(c[c["COMPETENCIA"].astype(str).isin(competencias)])
+
+    def _janela_cards(self, competencia):
+        # referencia / ultimas_5 do SQL_CARDS: Competencia_Data entre a de referência - 4 meses e ela
+        c = self.cubo
+        datas = pd.to_datetime(c["Competencia_Data"].astype(str), errors="coerce")
+        ref = datas[(c["COMPETENCIA"].astype(str) == competencia).to_numpy(dtype=bool)]
+        if ref.empty:
+            return []
+        ref = ref.iloc[0]
+        dentro = ((datas >= ref - pd.DateOffset(months=4)) & (datas <= ref)).to_numpy(dtype=bool)
+        return c["COMPETENCIA"][dentro].astype(str).unique().tolist()
+
+    def _executar(self, sql, params):
+        c = self.cubo
+        if sql.strip() == "SELECT 1":
+            return pd.DataFrame({"f0_": [1]})
+        if sql == SQL_COMPETENCIA:
+            return c[c["COMPETENCIA"] == params["competencia"]]
+        if sql == SQL_COMPETENCIA_MESES:
+            return c[c["COMPETENCIA"].isin(params["competencias"])]
+        if sql == SQL_CARDS:
+            return self._cards(self._janela_cards(params["competencia"]))
+        if sql == SQL_CARDS_MESES:
+            return self._cards(params["competencias"])
+
+        pendentes = c[c["STATUS_GERAL_Regra"].isin(_STATUS_PENDENTES)]
+        if sql == SQL_COMPETENCIAS_PENDENCIAS:
+            return pd.DataFrame({"COMPETENCIA": sorted(pendentes["COMPETENCIA"].astype(str).unique())})
+        if sql == SQL_PENDENCIAS_HIST:
+            return pendentes
+        if sql == SQL_PENDENCIAS_HIST_MESES:
+            return pendentes[pendentes["COMPETENCIA"].isin(params["competencias"])]
+        if sql == SQL_PENDENCIAS_HIST_CONTRATOS:
+            # filtro e ORDER BY pela mesma chave de texto (SQL_CHAVE_CONTRATO)
+            chave = (pendentes["PROJETO"].astype(str) + "|" + pendentes["PRESTADOR"].astype(str) + "|"
+                     + pendentes["CONTRATO"].astype(str))
+            sel = chave.isin(params["contratos"]).to_numpy(dtype=bool)
+            return pendentes[sel].iloc[np.argsort(chave[sel].to_numpy(), kind="stable")]
+        raise ValueError(f"Consulta não suportada pelo cubo local:\n{sql[:200]}")
+
+    def query(self, sql, job_config=None):
+        import pyarrow as pa
+        self.consultas += 1
+        df = self._executar(sql, self._parametros(job_config))
+        return _ResultadoCubo(pa.Table.from_pandas(df, preserve_index=False), self.tamanho_lote)
+
+
+def usar_cubo_local(caminho):
+    """
+    Dry-run sem BigQuery nem credenciais: as consultas passam a ser respondidas
+    a partir de um Cubo_Documentos exportado (Parquet, ou CSV com ';') por um
+    ClienteCuboLocal no `bq_client` global. Retorna o cliente.
+    """
+    global bq_client
+    if caminho.endswith(".parquet"):
+        cubo = pd.read_parquet(caminho)
+    else:
+        cubo = pd.read_csv(caminho, sep=";", dtype=str, keep_default_na=False)
+    bq_client = ClienteCuboLocal(cubo)
+    print(f"🧪 Cubo local {caminho}: {len(cubo)} linhas (sem BigQuery)")
+    return bq_client
+
+
+def _aliviar(relatorio):
+    """Depois de um mês do backfill: mantém no relatório só o que o resumo/índice usam."""
+    for item in relatorio:
+        t = item["tarefa"]
+        item["tarefa"] = {k: t[k] for k in ("chave", "prestador", "contrato", "competencia", "emails")}
+        if item["render"] is not None:
+            item["render"] = {k: item["render"].get(k) for k in ("assunto", "n_anexo", "kpis", "entrega")}
+    return relatorio
+
+
+def main(argv=None):
+    args = _argumentos(argv)
+    competencias = intervalo_competencias(args.competencia, args.ate)
+
+    # 🔹 só manutenção do cache: nada de BigQuery nem envio
+    if args.cache_listar or args.cache_podar:
+        return manter_cache(CacheCompetencias(CACHE_DIR, ttl_horas=CACHE_TTL_HORAS),
+                            podar=args.cache_podar, listar=args.cache_listar)
+    if args.cubo:
+        usar_cubo_local(args.cubo)
+    if not testar_conexao_bq():
+        return 2
+    # 🔹 uma carga só para todos os meses (backfill: janela que cobre todos);
+    #    com --cubo, num cache descartável (não mistura com o dos dados reais)
+    with tempfile.TemporaryDirectory(prefix="docvs_cubo_") if args.cubo else nullcontext(CACHE_DIR) as cache_dir:
+        cache = CacheCompetencias(cache_dir, ttl_horas=CACHE_TTL_HORAS)
+        df_base, df_cards, df_pendencias_hist = carregar_dados(competencias, cache, forcar=args.invalidar_cache)
+    indice_cards = IndiceContratos(df_cards)
+    anexos_hist = {}
+    hashes = HashesEnvio(HASHES_PATH) if args.somente_alterados else None
+
+    # 🔹 destino: SMTP real, disco (--saida: pipeline completo, sem rede) ou nada (--dry-run)
+    pool_smtp = None
+    if args.saida:
+        configurar_smtp({"smtp_server": None, "smtp_port": None, "smtp_from": "dry-run@localhost"})
+        pool_smtp = SaidaEml(args.saida, formato="mbox" if args.mbox else "eml")
+    elif not args.dry_run:
+        carregar_credenciais_smtp()
+        if args.backend == "async":
+            pool_smtp = EnvioAssincrono(
+                SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASS,
+                sessoes=SMTP_POOL_TAMANHO, fila_max=SMTP_FILA_MAX, max_msgs_por_sessao=SMTP_MSGS_POR_SESSAO,
+            )
+        else:
+            pool_smtp = PoolSMTP(
+                SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASS,
+                tamanho=SMTP_POOL_TAMANHO, max_msgs_por_sessao=SMTP_MSGS_POR_SESSAO,
+            )
+    enviar = pool_smtp is not None
+    # 🔹 workers de render criados uma vez, antes do event loop do envio e da
+    #    leitura do histórico (fork sem threads rodando)
+    pool_render = criar_pool_render(RENDER_WORKERS)
+    # 🔹 taxa adaptativa do servidor: uma para a execução inteira (todos os lotes e meses)
+    agendador = criar_agendador(SMTP_TAXA_MAX)
+
+    # 🔹 um lote de envio por competência, em ordem (cada mês com o seu diário)
+    relatorio, ja_enviados = [], 0
+    try:
+        for competencia in competencias:
+            if len(competencias) > 1:
+                print(f"\n🗓️ Competência {competencia}")
+            # diário da execução: retomar após queda/throttling sem reenviar o que já foi
+            diario_path = os.path.join(CACHE_DIR, "diarios", f"envio_{competencia}.jsonl")
+            diario = None if args.dry_run else DiarioEnvio(diario_path)
+            # 🔹 streaming: lotes de contratos, cada um com os seus anexos (não acumulados);
+            #    o histórico da competência é consultado uma vez e lido junto com os lotes
+            #    (no digest os lotes não seguem a ordem dos contratos: uma consulta por lote)
+            historico = None
+            if args.streaming:
+                lotes = lotes_envio(df_base, competencia, args.only, args.lote_contratos, args.digest)
+                contratos = _filtrar_envio(df_base, competencia, args.only)[CHAVE_CONTRATO].drop_duplicates()
+                if HIST_FILTRADO_POR_CONTRATO and not args.digest and not contratos.empty:
+                    historico = AnexosOrdenados(consultar_historico_contratos(
+                        tuple(k) for k in contratos.itertuples(index=False)))
+            else:
+                lotes = [df_base]
+            try:
+                for df_lote in lotes:
+                    if historico is not None:
+                        anexos_lote = historico.ate(df_lote)
+                    else:
+                        anexos_lote = {} if args.streaming else anexos_hist
+                    tarefas, ja_lote = preparar_tarefas(
+                        df_lote, df_cards, df_pendencias_hist, competencia,
+                        diario=diario, projetos=args.only, digest=args.digest,
+                        indice_cards=indice_cards, anexos_hist=anexos_lote, hashes=hashes,
+                    )
+                    del df_lote
+                    relatorio_lote = executar_pipeline(
+                        tarefas, pool_smtp,
+                        workers_envio=SMTP_POOL_TAMANHO,
+                        agendador=agendador,
+                        diario=diario,
+                        enviar=enviar,
+                        janela=2 * ((RENDER_WORKERS or 1) + SMTP_POOL_TAMANHO) if args.streaming else None,
+                        memoria_max_mb=args.memoria_max_mb,
+                        liberar=args.streaming,
+                        pool_render=pool_render,
+                    )
+                    del tarefas
+                    # 🔹 só envio real atualiza o "último conteúdo enviado"
+                    if hashes is not None and enviar and not args.dry_run:
+                        registrar_enviados(hashes, relatorio_lote)
+
+                    if ja_lote:
+                        print(f"⏭️ {ja_lote} e-mails já enviados em execução anterior (diário {diario_path})")
+                    imprimir_relatorio(relatorio_lote)
+                    aliviar = args.streaming or len(competencias) > 1
+                    relatorio.extend(_aliviar(relatorio_lote) if aliviar else relatorio_lote)
+                    ja_enviados += ja_lote
+            finally:
+                if diario is not None:
+                    diario.fechar()
+    finally:
+        pool_render.shutdown()
+        if pool_smtp is not None:
+            pool_smtp.fechar()
+        if hashes is not None:
+            hashes.fechar()
+
+    if args.saida:
+        indice = pool_smtp.escrever_indice(relatorio, titulo=f"Dry-run {', '.join(competencias)}")
+        print(f"🧪 {pool_smtp.mensagens} mensagens gravadas em {args.saida} (índice: {indice})")
+
+    # 🔹 Resumo da execução por etapa (JSON sempre; Prometheus se configurado)
+    status = [item["status"] for item in relatorio]
+    ok = "renderizado" if not enviar else "gravado" if args.saida else "enviado"
+    if METRICAS.ativo:
+        METRICAS.imprimir()
+        rotulo = competencias[0] if len(competencias) == 1 else f"{competencias[0]}_{competencias[-1]}"
+        METRICAS.salvar_json(
+            os.path.join(CACHE_DIR, "execucoes", f"resumo_{rotulo}.json"),
+            extra={
+                "competencia": rotulo,
+                "competencias": competencias,
+                "dry_run": args.dry_run,
+                "saida": args.saida,
+                "digest": args.digest,
+                "backend": args.backend,
+                "streaming": args.streaming,
+                "memoria_max_mb": args.memoria_max_mb,
+                "pico_rss_mb": round(pico_rss_mb(), 1),
+                "pico_rss_workers_mb": round(pico_rss_mb(filhos=True), 1),
+                "somente_alterados": args.somente_alterados,
+                "projetos": args.only,
+                "grupos": len(relatorio),
+                "enviados": status.count("enviado"),
+                "gravados": status.count("gravado"),
+                "falhas": len(status) - status.count(ok),
+                "ja_enviados": ja_enviados,
+            },
+        )
+        if METRICAS_PROM_TEXTFILE:
+            METRICAS.salvar_prometheus(METRICAS_PROM_TEXTFILE)
+
+    print("\n🏁 Processo concluído.")
+    return 0 if status.count(ok) == len(status) else 1
 
 
-print("\n🏁 Processo concluído.")
+if __name__ == "__main__":
+    sys.exit(main())
 
 
 # In[ ]:
@@ -0,0 +1,111 @@
+import io
+import zipfile
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pa = pytest.importorskip("pyarrow")
+
+import teste_docvs as td
+
+
+def _frame():
+    return pd.DataFrame({
+        "PROJETO": ["Florestal", "Obra, Norte", 'Diz "oi"'],
+        "COMPETENCIA": ["2025-09", "2025-08", None],
+        "DOCUMENTO": ["Contrato social", "Certidão; negativa", "linha1\nlinha2"],
+        "CONTRATO": ["123", "456", "789"],
+        "RELEVANCIA": [0.5, 1.0, float("nan")],
+        "DOCUMENTO_APROV_OBS2": ["Ação pendente", None, "São Paulo, ok"],
+    })
+
+
+def _original(df):
+    # como o anexo era gerado antes (BytesIO + utf-8-sig)
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, sep=";", encoding="utf-8-sig")
+    return buf.getvalue()
+
+
+def test_csv_anexo_identico_ao_to_csv_original():
+    df = _frame()
+    assert td.csv_anexo(df) == _original(df)
+
+
+def test_csv_anexo_identico_com_dtypes_arrow_e_categorias():
+    df = _frame()
+    convertido = df.astype({
+        "PROJETO": "category",
+        "DOCUMENTO": pd.ArrowDtype(pa.string()),
+        "RELEVANCIA": pd.ArrowDtype(pa.float64()),
+    })
+    assert td.csv_anexo(convertido) == _original(df)
+
+
+def _batches(*dfs):
+    return [pa.RecordBatch.from_pandas(df, preserve_index=False) for df in dfs]
+
+
+def _csv_no_worker(anexo):
+    # o que _renderizar_grupo faz com o anexo que veio do histórico
+    return td._csv_contrato({"anexo_arrow": anexo})
+
+
+def test_anexos_por_contrato_viram_o_csv_original_no_worker():
+    df = _frame().assign(PRESTADOR="P")
+    df["PROJETO"] = "X"
+    anexos = td.anexos_por_contrato(_batches(df.iloc[:2], df.iloc[2:]))   # três contratos em dois lotes
+    assert len(anexos) == 3
+    for (_, _, contrato), anexo in anexos.items():
+        assert _csv_no_worker(anexo) == (_original(df[df["CONTRATO"] == contrato]), 1)
+
+    # um contrato só, partido entre dois lotes (cada um com o seu dicionário): um cabeçalho e um BOM
+    continua = df.assign(CONTRATO="123")
+    anexos = td.anexos_por_contrato(_batches(*(
+        parte.astype({"DOCUMENTO": "category"}) for parte in (continua.iloc[:2], continua.iloc[2:]))))
+    assert _csv_no_worker(anexos[("X", "P", "123")]) == (_original(continua), 3)
+    assert _csv_no_worker((None, 0)) == (None, 0)
+
+
+def test_compactar_anexo_acima_do_limite():
+    dados = _original(_frame())
+    assert td.compactar_anexo(dados, "a.csv", limite=None) == (dados, "a.csv", "csv")
+    zipado, nome, subtipo = td.compactar_anexo(dados, "a.csv", limite=10, formato="zip")
+    assert (nome, subtipo) == ("a.zip", "zip")
+    with zipfile.ZipFile(io.BytesIO(zipado)) as z:
+        assert z.read("a.csv") == dados
+
+
+def test_historico_lido_uma_vez_junto_com_os_lotes_do_streaming():
+    # ordem de texto != ordem das tuplas: "AB|" < "A|" e "A|P|10" < "A|P|9"
+    contratos = [("A", "P", 9), ("A", "P", 10), ("AB", "P", 1), ("A", "Q", 3), ("B", "P", 7)]
+    base = pd.DataFrame(contratos * 2, columns=td.CHAVE_CONTRATO).assign(
+        COMPETENCIA="2025-09", email_envio="x@y.com")
+    base = base.astype({"PROJETO": "category", "PRESTADOR": "category"})
+    hist = pd.DataFrame(
+        [(p, pr, c, f"doc {i}") for i, (p, pr, c) in enumerate(contratos * 3) if c != 3],
+        columns=td.CHAVE_CONTRATO + ["DOCUMENTO"],
+    )
+    # como a consulta devolve: ORDER BY a chave de texto, em record batches pequenos
+    hist = hist.iloc[sorted(range(len(hist)), key=lambda i: td.chave_contrato_texto(*hist.iloc[i, :3]))]
+    batches = _batches(*(hist.iloc[i:i + 2] for i in range(0, len(hist), 2)))
+    lidos = []
+
+    def _fluxo():
+        for b in batches:
+            lidos.append(b.num_rows)
+            yield b
+
+    historico = td.AnexosOrdenados(_fluxo())
+    vistos = {}
+    for lote in td.lotes_envio(base, "2025-09", contratos_por_lote=2, digest=False):
+        anexos = historico.ate(lote)
+        assert set(anexos) == {tuple(k) for k in lote[td.CHAVE_CONTRATO].itertuples(index=False)}
+        vistos.update(anexos)
+
+    assert len(vistos) == len(contratos)
+    for chave in contratos:
+        linhas = hist[[tuple(k) == chave for k in hist[td.CHAVE_CONTRATO].itertuples(index=False)]]
+        esperado = (_original(linhas), len(linhas)) if len(linhas) else (None, 0)
+        assert _csv_no_worker(vistos[chave]) == esperado
+    assert sum(lidos) == len(hist)   # cada linha do histórico lida uma única vez
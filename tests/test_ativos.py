@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+import teste_docvs as td
+
+
+def _logo_no_worker(_):
+    # roda no worker: a parte tem de vir pronta do pai (o arquivo já não existe)
+    return bytes(td.ATIVOS.parte("logo_metax").get_content())
+
+
+def _locks_livres(_):
+    # roda no worker: nenhum lock herdado pode estar travado
+    locks = (td.ATIVOS._lock, td.GRAFICOS._lock, td.METRICAS._lock)
+    livres = [lock.acquire(timeout=1) for lock in locks]
+    for lock, livre in zip(locks, livres):
+        if livre:
+            lock.release()
+    return livres
+
+
+@pytest.fixture
+def ativos(monkeypatch, tmp_path):
+    logo = tmp_path / "logo.png"
+    logo.write_bytes(b"\x89PNG logo")
+    monkeypatch.setattr(td, "ATIVOS", td.RegistroAtivos())
+    td.ATIVOS.registrar("logo_metax", str(logo), "png", "logo_metax.png")
+    return logo
+
+
+def test_logo_lido_no_pai_antes_do_fork(ativos):
+    pool = td.criar_pool_render(2)
+    try:
+        os.remove(ativos)
+        assert list(pool.map(_logo_no_worker, range(4))) == [b"\x89PNG logo"] * 4
+    finally:
+        pool.shutdown()
+
+
+def test_workers_comecam_com_locks_novos(ativos):
+    td.ATIVOS.precarregar()   # já em cache: criar_pool_render não precisa do lock
+    # locks travados por "outra thread" do pai no momento do fork
+    travados = (td.ATIVOS._lock, td.GRAFICOS._lock, td.METRICAS._lock)
+    for lock in travados:
+        lock.acquire()
+    try:
+        pool = td.criar_pool_render(2)
+    finally:
+        for lock in travados:
+            lock.release()
+    try:
+        assert list(pool.map(_locks_livres, range(2))) == [[True] * 3] * 2
+    finally:
+        pool.shutdown()
+
+
+def test_ativo_ausente_so_avisa_no_precarregar(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(td, "ATIVOS", td.RegistroAtivos())
+    td.ATIVOS.registrar("logo_metax", str(tmp_path / "nao_existe.png"))
+    td.ATIVOS.precarregar()
+    assert "logo_metax" in capsys.readouterr().out
+    with pytest.raises(OSError):
+        td.ATIVOS.parte("logo_metax")
@@ -0,0 +1,81 @@
+import functools
+import json
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+pytest.importorskip("aiosmtpd")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+MESES = ["2025-07", "2025-08", "2025-09"]
+
+
+@pytest.fixture
+def ambiente(tmp_path, monkeypatch):
+    """main() de ponta a ponta: cubo local no lugar do BigQuery e SMTP local (sem TLS nem AUTH)."""
+    cubo = bench.gerar_cubo(4, docs_por_contrato=3, meses=8)
+    cubo = cubo[cubo["COMPETENCIA"] != "2025-08"].reset_index(drop=True)   # mês sem dados no meio
+    cliente = td.ClienteCuboLocal(cubo)
+    controller, contador, porta = bench.iniciar_smtp_local()
+
+    monkeypatch.setattr(td, "bq_client", cliente)
+    monkeypatch.setattr(td, "testar_conexao_bq", lambda: True)
+    monkeypatch.setattr(td, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(td, "RENDER_WORKERS", 2)
+    monkeypatch.setattr(td, "ATIVOS", td.RegistroAtivos())
+    td.ATIVOS.registrar("logo_metax", bench.LOGO_BENCHMARK, "png", "logo_metax.png")
+    monkeypatch.setattr(td, "carregar_credenciais_smtp", lambda: td.configurar_smtp(
+        {"smtp_server": "127.0.0.1", "smtp_port": porta, "smtp_from": "backfill@localhost"}))
+    monkeypatch.setattr(td, "PoolSMTP", functools.partial(td.PoolSMTP, usar_tls=False))
+
+    consultas, agendadores, lotes = [], [], []
+    query_bq, criar_agendador, executar_pipeline = td.query_bq, td.criar_agendador, td.executar_pipeline
+
+    def _query_bq(sql, *a, **kw):
+        consultas.append(sql)
+        return query_bq(sql, *a, **kw)
+
+    def _criar_agendador(*a, **kw):
+        agendadores.append(criar_agendador(*a, **kw))
+        return agendadores[-1]
+
+    def _executar_pipeline(tarefas, pool, **kw):
+        lotes.append((sorted({t["competencia"] for t in tarefas}), kw["agendador"]))
+        return executar_pipeline(tarefas, pool, **kw)
+
+    monkeypatch.setattr(td, "query_bq", _query_bq)
+    monkeypatch.setattr(td, "criar_agendador", _criar_agendador)
+    monkeypatch.setattr(td, "executar_pipeline", _executar_pipeline)
+    yield tmp_path, contador, consultas, agendadores, lotes
+    controller.stop()
+
+
+def _diario(raiz, competencia):
+    with open(raiz / "diarios" / f"envio_{competencia}.jsonl", encoding="utf-8") as f:
+        return [json.loads(linha) for linha in f]
+
+
+def test_backfill_uma_carga_um_agendador_e_um_diario_por_mes(ambiente):
+    raiz, contador, consultas, agendadores, lotes = ambiente
+    assert td.main(["--competencia", MESES[0], "--ate", MESES[-1]]) == 0
+
+    # uma consulta da janela de envio para os três meses, nenhuma por mês
+    assert consultas.count(td.SQL_COMPETENCIA_MESES) == 1 and td.SQL_COMPETENCIA not in consultas
+    # a mesma taxa adaptativa atravessa os meses; o mês sem dados não gera tarefas
+    assert len(agendadores) == 1
+    assert [competencias for competencias, _ in lotes] == [["2025-07"], [], ["2025-09"]]
+    assert all(agendador is agendadores[0] for _, agendador in lotes)
+
+    assert contador.mensagens == 8
+    for competencia in ("2025-07", "2025-09"):
+        registros = _diario(raiz, competencia)
+        assert sum(r["estado"] == "enviado" for r in registros) == 4
+        assert all(competencia in r["chave"] for r in registros)
+    assert _diario(raiz, "2025-08") == []
+
+    # retomada: os diários de cada mês evitam qualquer reenvio
+    assert td.main(["--competencia", MESES[0], "--ate", MESES[-1]]) == 0
+    assert contador.mensagens == 8
@@ -0,0 +1,137 @@
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pa = pytest.importorskip("pyarrow")
+
+import teste_docvs as td
+
+
+class _ResultadoArrow:
+    def __init__(self, tabela, tamanho_lote):
+        self.tabela, self.tamanho_lote = tabela, tamanho_lote
+
+    def to_arrow(self, bqstorage_client=None):
+        return self.tabela
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        yield from self.tabela.to_batches(max_chunksize=self.tamanho_lote)
+
+
+class ClienteArrowFalso:
+    """Só o que query_bq/query_bq_lotes usam: .query(sql, job_config).result().to_arrow..."""
+
+    def __init__(self, tabela, tamanho_lote=2):
+        self.tabela, self.tamanho_lote = tabela, tamanho_lote
+        self.consultas = []
+
+    def query(self, sql, job_config=None):
+        params = {p.name: getattr(p, "values", getattr(p, "value", None)) for p in job_config.query_parameters}
+        self.consultas.append((sql, params))
+        return self
+
+    def result(self):
+        return _ResultadoArrow(self.tabela, self.tamanho_lote)
+
+
+def _tabela():
+    return pa.table({
+        "PROJETO": pa.array(["X", "X", "Y", "Y", "Z"]).dictionary_encode(),
+        "CONTRATO": pa.array(["1", "2", "3", "4", "5"]),
+        "RELEVANCIA": pa.array([1.0, None, 0.5, 2.0, 3.0]),
+    })
+
+
+def test_query_bq_com_cliente_falso():
+    cliente = ClienteArrowFalso(_tabela())
+    df = td.query_bq("SELECT ...", {"competencia": {"type": "STRING", "value": "2025-09"},
+                                    "contratos": {"type": "STRING", "value": ("a", "b")}}, client=cliente)
+    assert cliente.consultas == [("SELECT ...", {"competencia": "2025-09", "contratos": ["a", "b"]})]
+    assert len(df) == 5
+    assert isinstance(df["PROJETO"].dtype, pd.CategoricalDtype)
+    assert df["CONTRATO"].dtype == pd.ArrowDtype(pa.string())
+    assert df["RELEVANCIA"].dtype == pd.ArrowDtype(pa.float64())
+    assert df["RELEVANCIA"].isna().tolist() == [False, True, False, False, False]
+
+
+def test_query_bq_lotes_um_dataframe_por_record_batch():
+    lotes = list(td.query_bq_lotes("SELECT ...", client=ClienteArrowFalso(_tabela(), tamanho_lote=2)))
+    assert [len(l) for l in lotes] == [2, 2, 1]
+    assert pd.concat(lotes)["CONTRATO"].tolist() == ["1", "2", "3", "4", "5"]
+    assert all(l["CONTRATO"].dtype == pd.ArrowDtype(pa.string()) for l in lotes)
+
+
+def _rodar_isolado(codigo):
+    # processo novo: o que este teste (ou outro) já importou não mascara o resultado
+    saida = subprocess.run([sys.executable, "-c", textwrap.dedent(codigo)], capture_output=True, text=True,
+                           cwd=td.os.path.dirname(td.os.path.abspath(td.__file__)))
+    assert saida.returncode == 0, saida.stderr
+    return saida.stdout
+
+
+def test_cliente_falso_nao_importa_google_cloud():
+    _rodar_isolado("""
+        import sys
+        sys.path.insert(0, "tests")
+        from test_bq import ClienteArrowFalso, _tabela
+        import teste_docvs as td
+        td.query_bq("SELECT 1", {"n": {"type": "INT64", "value": 1}}, client=ClienteArrowFalso(_tabela()))
+        list(td.query_bq_lotes("SELECT 1", client=ClienteArrowFalso(_tabela())))
+        assert not any(m.startswith("google.cloud") for m in sys.modules), sorted(sys.modules)
+    """)
+
+
+def test_importar_modulo_nao_cria_cliente_nem_usa_rede():
+    _rodar_isolado("""
+        import socket, sys
+
+        def _sem_rede(*a, **kw):
+            raise AssertionError("acesso à rede ao importar")
+
+        socket.socket.connect = socket.socket.connect_ex = socket.socket.sendto = _sem_rede
+        socket.create_connection = socket.getaddrinfo = _sem_rede
+        import teste_docvs as td
+        assert td.bq_client is None and td._BQSTORAGE_CLIENT is None
+        assert not any(m.startswith("google.cloud") for m in sys.modules)
+    """)
+
+
+def _cubo_cards():
+    linhas = [
+        # (PROJETO, COMPETENCIA, data, STATUS, CRITICO, RELEVANCIA)
+        ("P", "2025-09", "2025-09-01", "Conforme", "0", "0.5"),
+        ("P", "2025-09", "2025-09-01", "Não Conforme", "1", "0.3"),
+        ("P", "2025-09", "2025-09-01", "Não Conforme", "1.0", "0.1"),     # SAFE_CAST('1.0' AS INT64) = NULL
+        ("P", "2025-09", "2025-09-01", "Conforme", "x", "abc"),           # relevância NULL: soma ignora
+        ("Samarco - COA", "2025-09", "2025-09-01", "Em Análise", "0", "0.4"),
+        ("Q", "2025-08", "2025-08-01", "Conforme", "0", ""),              # só NULL: perc NULL
+        ("P", "2025-05", "2025-05-01", "Conforme", "0", "1"),             # 4 meses antes: na janela
+        ("P", "2025-04", "2025-04-01", "Conforme", "0", "1"),             # fora da janela
+    ]
+    colunas = ["PROJETO", "COMPETENCIA", "Competencia_Data", "STATUS_GERAL_Regra", "CRITICO", "RELEVANCIA"]
+    cubo = pd.DataFrame(linhas, columns=colunas)
+    cubo["PRESTADOR"], cubo["CONTRATO"] = "pr", "1"
+    return cubo
+
+
+def test_cubo_local_agrega_cards_como_o_sql():
+    cliente = td.ClienteCuboLocal(_cubo_cards())
+    cards = td.query_bq(td.SQL_CARDS, {"competencia": {"type": "STRING", "value": "2025-09"}}, client=cliente)
+    por = {(r.PROJETO, r.COMPETENCIA): r for r in cards.itertuples(index=False)}
+    assert sorted(por) == [("P", "2025-05"), ("P", "2025-09"), ("Q", "2025-08"), ("Samarco - COA", "2025-09")]
+    assert cards["COMPETENCIA"].tolist() == sorted(cards["COMPETENCIA"].tolist())
+    p = por[("P", "2025-09")]
+    assert (p.total_pendencias, p.total_criticos, p.perc_atingido) == (2, 1, pytest.approx(0.5))
+    assert por[("Samarco - COA", "2025-09")].perc_atingido == pytest.approx(0.4)
+    assert pd.isna(por[("Q", "2025-08")].perc_atingido)
+
+
+def test_sem_bigquery_storage_cai_para_a_api_rest(monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, "google.cloud.bigquery_storage", None)   # import → ImportError
+    monkeypatch.setattr(td, "_BQSTORAGE_CLIENT", None)
+    assert td._bqstorage_client() is None
+    assert td._bqstorage_client() is None
+    assert capsys.readouterr().out.count("API REST") == 1   # avisa uma vez só
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import teste_docvs as td
+
+MESES = ["2025-07", "2025-08", "2025-09"]
+
+
+class Buscas:
+    """`buscar` do CacheCompetencias que registra o que foi ao BigQuery."""
+
+    def __init__(self):
+        self.chamadas = []
+
+    def __call__(self, meses):
+        self.chamadas.append(list(meses))
+        return pd.DataFrame({"COMPETENCIA": meses, "N": range(len(meses))})
+
+
+def _carregar(raiz, buscas, **kw):
+    cache = td.CacheCompetencias(str(raiz), ttl_horas=12)
+    df = cache.carregar("cards", MESES, buscas, abertas=["2025-09"], **kw)
+    return cache, df
+
+
+def test_fechadas_vem_do_disco_e_aberta_so_ate_expirar(tmp_path, monkeypatch):
+    buscas = Buscas()
+    _, df = _carregar(tmp_path, buscas)
+    assert buscas.chamadas == [MESES]
+    assert df["COMPETENCIA"].astype(str).tolist() == MESES
+
+    _, df = _carregar(tmp_path, buscas)
+    assert buscas.chamadas == [MESES]   # dentro do TTL: nada vai ao BigQuery
+    assert df["COMPETENCIA"].astype(str).tolist() == MESES
+
+    agora = td.time.time()
+    monkeypatch.setattr(td.time, "time", lambda: agora + 13 * 3600)
+    _carregar(tmp_path, buscas)
+    assert buscas.chamadas == [MESES, ["2025-09"]]   # só a aberta expirou
+
+
+def test_forcar_e_invalidar_rebuscam(tmp_path):
+    buscas = Buscas()
+    cache, _ = _carregar(tmp_path, buscas)
+    _carregar(tmp_path, buscas, forcar=True)
+    assert buscas.chamadas[-1] == MESES
+
+    cache = td.CacheCompetencias(str(tmp_path))
+    cache.invalidar("cards", ["2025-07"])
+    assert not (tmp_path / "cards" / "COMPETENCIA=2025-07.parquet").exists()
+    _carregar(tmp_path, buscas)
+    assert buscas.chamadas[-1] == ["2025-07"]
+
+    td.CacheCompetencias(str(tmp_path)).podar("2025-09")
+    _carregar(tmp_path, buscas)
+    assert buscas.chamadas[-1] == ["2025-07", "2025-08"]
+
+
+def test_manifest_corrompido_ou_sem_entrada_volta_ao_bigquery(tmp_path):
+    buscas = Buscas()
+    _carregar(tmp_path, buscas)
+    manifest = tmp_path / "manifest.json"
+
+    dados = json.loads(manifest.read_text())
+    del dados["cards"]["2025-07"]
+    dados["cards"]["2025-08"] = {"linhas": 1}   # entrada incompleta
+    manifest.write_text(json.dumps(dados))
+    _carregar(tmp_path, buscas)
+    assert buscas.chamadas[-1] == ["2025-07", "2025-08"]
+
+    manifest.write_text('{"cards": {"2025-07": ')   # gravação interrompida
+    _, df = _carregar(tmp_path, buscas)
+    assert buscas.chamadas[-1] == MESES
+    assert df["COMPETENCIA"].astype(str).tolist() == MESES
+    assert sorted(json.loads(manifest.read_text())["cards"]) == MESES   # regravado
@@ -0,0 +1,50 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+MESES = ["2025-07", "2025-08", "2025-09"]
+
+
+@pytest.fixture
+def cubo_local(monkeypatch):
+    cubo = bench.gerar_cubo(6, docs_por_contrato=3, meses=8, seed=7)
+    monkeypatch.setattr(td, "bq_client", td.ClienteCuboLocal(cubo))
+    return cubo
+
+
+def _categoricas(df):
+    return {c: df[c].dtype for c in td.COLUNAS_CATEGORICAS
+            if c in df.columns and isinstance(df[c].dtype, pd.CategoricalDtype)}
+
+
+def test_categorias_compartilhadas_sobrevivem_ao_cache_e_ao_backfill(cubo_local, tmp_path):
+    cache = td.CacheCompetencias(str(tmp_path))
+    frio = td.carregar_dados(MESES, cache, verbose=False)[:2]
+    quente = td.carregar_dados(MESES, td.CacheCompetencias(str(tmp_path)), verbose=False)[:2]
+
+    for df_frio, df_quente in zip(frio, quente):
+        # as partições do disco (uma por mês) voltam categóricas, com o mesmo dicionário
+        assert set(_categoricas(df_quente)) == set(_categoricas(df_frio)) >= {"PROJETO", "PRESTADOR", "CONTRATO"}
+        pd.testing.assert_frame_equal(df_quente, df_frio)
+
+    df_base, df_cards = quente
+    assert set(df_base["COMPETENCIA"].astype(str)) == set(MESES)
+    for col in set(_categoricas(df_base)) & set(_categoricas(df_cards)):
+        assert df_base[col].dtype == df_cards[col].dtype   # mesmo código para a mesma chave
+
+    # concatenar meses ou frames categorizados juntos não cai para object
+    por_mes = [g for _, g in df_base.groupby("COMPETENCIA", observed=True)]
+    junto = pd.concat(por_mes, ignore_index=True)
+    assert _categoricas(junto) == _categoricas(df_base)
+    assert isinstance(pd.concat([df_base["CONTRATO"], df_cards["CONTRATO"]]).dtype, pd.CategoricalDtype)
+
+
+def test_categorizar_nao_altera_valores(cubo_local):
+    df = cubo_local[cubo_local["COMPETENCIA"] == "2025-09"]
+    (categorizado,) = td.categorizar_compartilhado(df)
+    assert set(_categoricas(categorizado)) == set(td.COLUNAS_CATEGORICAS)
+    pd.testing.assert_frame_equal(td._sem_categorias(categorizado), df, check_dtype=False)
@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+RAIZ = os.path.dirname(os.path.abspath(td.__file__))
+
+
+def test_dry_run_com_cubo_local_sem_bigquery_nem_credenciais(tmp_path):
+    cubo = bench.gerar_cubo(6, docs_por_contrato=3, meses=6)
+    cubo.to_parquet(tmp_path / "cubo.parquet")
+    env = dict(os.environ, DOCVS_CACHE_DIR=str(tmp_path / "cache"), DOCVS_LOGO=bench.LOGO_BENCHMARK,
+               GOOGLE_APPLICATION_CREDENTIALS=str(tmp_path / "nao_existe.json"))
+    saida = subprocess.run(
+        [sys.executable, os.path.join(RAIZ, "teste_docvs.py"), "--competencia", "2025-09",
+         "--saida", str(tmp_path / "eml"), "--cubo", str(tmp_path / "cubo.parquet")],
+        capture_output=True, text=True, env=env, cwd=tmp_path,
+    )
+    assert saida.returncode == 0, saida.stdout + saida.stderr
+    assert len(list((tmp_path / "eml").glob("*.eml"))) == 6
+    # gravado em disco não conta como enviado no resumo
+    resumo = json.loads((tmp_path / "cache" / "execucoes" / "resumo_2025-09.json").read_text())
+    assert (resumo["gravados"], resumo["enviados"], resumo["falhas"]) == (6, 0, 0)
+    assert "💾 Gravado" in saida.stdout and "✅ Enviado" not in saida.stdout
+    # o cache dos dados reais não recebe nada vindo do cubo local
+    assert not (tmp_path / "cache" / "cards").exists()
+
+
+def test_cubo_exige_dry_run():
+    with pytest.raises(SystemExit):
+        td._argumentos(["--competencia", "2025-09", "--cubo", "cubo.parquet"])
+
+
+def test_importar_nao_carrega_bibliotecas_pesadas():
+    codigo = ("import sys, teste_docvs; "
+              "print(sorted(m for m in ('google.cloud', 'matplotlib', 'scipy', 'aiosmtplib') if m in sys.modules))")
+    saida = subprocess.run([sys.executable, "-c", codigo], capture_output=True, text=True, cwd=RAIZ)
+    assert saida.stdout.strip() == "[]", saida.stderr
+
+
+def _cache_com(raiz, competencias):
+    cache = td.CacheCompetencias(str(raiz))
+    cache.carregar("cards", competencias,
+                   lambda faltando: td.pd.DataFrame({"COMPETENCIA": faltando, "N": range(len(faltando))}))
+    return cache
+
+
+def test_cache_listar_e_podar_sem_bigquery(tmp_path, monkeypatch, capsys):
+    _cache_com(tmp_path, ["2025-06", "2025-07", "2025-08", "2025-09"])
+    monkeypatch.setattr(td, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(td, "testar_conexao_bq", lambda: pytest.fail("consultou o BigQuery"))
+
+    assert td.main(["--cache-podar", "2025-08", "--cache-listar"]) == 0
+    saida = capsys.readouterr().out
+    assert "2 partição(ões) anteriores a 2025-08 removida(s)" in saida
+    assert "2025-08" in saida and "2025-09" in saida and "2025-07" not in saida
+    assert sorted(p.name for p in (tmp_path / "cards").iterdir()) == [
+        "COMPETENCIA=2025-08.parquet", "COMPETENCIA=2025-09.parquet"]
+    assert sorted(td.CacheCompetencias(str(tmp_path)).manifest["cards"]) == ["2025-08", "2025-09"]
+
+
+def test_cache_podar_valida_competencia():
+    with pytest.raises(SystemExit):
+        td._argumentos(["--cache-podar", "agosto"])
+
+
+def test_cubo_local_nao_importa_o_benchmark(tmp_path):
+    bench.gerar_cubo(3, docs_por_contrato=2, meses=2).to_parquet(tmp_path / "cubo.parquet")
+    codigo = (f"import sys, teste_docvs as td; td.usar_cubo_local({str(tmp_path / 'cubo.parquet')!r}); "
+              "print('benchmark_docvs' in sys.modules)")
+    saida = subprocess.run([sys.executable, "-c", codigo], capture_output=True, text=True, cwd=RAIZ)
+    assert saida.stdout.strip().splitlines()[-1] == "False", saida.stderr
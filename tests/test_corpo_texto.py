@@ -0,0 +1,62 @@
+import email
+from email import policy
+from html import escape
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("matplotlib")
+
+import teste_docvs as td
+
+
+@pytest.fixture(autouse=True)
+def ambiente(monkeypatch, tmp_path):
+    monkeypatch.setattr(td, "SMTP_FROM", "docvs@x")
+    logo = tmp_path / "logo.png"
+    logo.write_bytes(b"\x89PNG logo")
+    monkeypatch.setattr(td, "ATIVOS", td.RegistroAtivos())
+    td.ATIVOS.registrar("logo_metax", str(logo), "png", "logo_metax.png")
+
+
+def _docs():
+    return pd.DataFrame({
+        "PROJETO": ["Vallourec"] * 3,
+        "DOCUMENTO": ["Contrato social", "Certidão <federal>", "Folha & ponto"],
+        "DOCUMENTO_APROV_OBS2": ["", "Valor < mínimo exigido", None],
+        "DOCUMENTO_APROV_REGULARIZA2": ["", "Regularizar até o dia 10", ""],
+        "STATUS_GERAL_Regra": ["Conforme", "Não Conforme", "Não Enviado"],
+        "CRITICO": ["0", "1", "0"],
+        "RELEVANCIA": ["0.5", "0.25", "0.25"],
+    })
+
+
+def _hist5():
+    return pd.DataFrame({"COMPETENCIA": td._lista_ultimos_5_meses("2025-09"),
+                         "total_pendencias": [3, 1, 4, 1, 2], "total_criticos": [0, 0, 1, 0, 1],
+                         "perc_atingido": [0.5, 0.6, 0.7, 0.8, 0.5]})
+
+
+def test_parte_texto_presente_e_com_o_mesmo_conteudo_do_html():
+    emails = ["a@x.com", "b@x.com"]
+    html, grafico, texto, (perc, legenda) = td.montar_email(
+        "Vallourec", "Prestador & Filhos", "CT-1", pd.Timestamp("2025-09-01"), _hist5(), _docs(), emails)
+    msg = email.message_from_bytes(
+        td.mensagem_bytes(emails, "Assunto", html, grafico, texto=texto).dados, policy=policy.default)
+
+    alternativa = next(p for p in msg.walk() if p.get_content_type() == "multipart/alternative")
+    plano, relacionada = alternativa.get_payload()   # texto primeiro: o cliente prefere a última
+    assert plano.get_content_type() == "text/plain"
+    assert relacionada.get_content_type() == "multipart/related"
+    rico = next(p for p in relacionada.walk() if p.get_content_type() == "text/html")
+    plano, rico = plano.get_content(), rico.get_content()
+
+    comuns = ["Vallourec", "Prestador & Filhos", "CT-1", "2025-09", f"{perc * 100:.1f}%", legenda,
+              "Certidão <federal>", "Valor < mínimo exigido", "Regularizar até o dia 10", *emails]
+    comuns += [f"{p * 100:.1f}%" for p in _hist5()["perc_atingido"]]
+    for valor in comuns:
+        assert valor in plano
+        assert escape(valor) in rico
+    # texto puro: sem marcação nem entidades
+    assert "<td" not in plano and "&amp;" not in plano and "&lt;" not in plano
+    assert plano.count("\n- ") >= len(_docs()) + len(emails)
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+pytest.importorskip("pandas")
+
+import teste_docvs as td
+
+
+def _chave(i):
+    return td.DiarioEnvio.chave("Florestal", "P", i, "2025-09", ["a@x.com"])
+
+
+def test_enviados_sobrevivem_sem_fechar(tmp_path):
+    caminho = str(tmp_path / "envio.jsonl")
+    diario = td.DiarioEnvio(caminho, lote=100, intervalo_s=3600)
+    for i in range(5):
+        diario.registrar(_chave(i), "renderizado")
+    diario.registrar(_chave(0), "enviado")
+    diario.registrar(_chave(1), "falhou", erro="550 caixa inexistente")
+    diario.registrar(_chave(2), "enviado")
+    # queda sem fechar(): nada além do que já foi gravado chega ao disco
+    del diario
+
+    retomado = td.DiarioEnvio(caminho)
+    assert retomado.concluido(_chave(0)) and retomado.concluido(_chave(2))
+    assert retomado.estado(_chave(1)) == "falhou"
+    assert not any(retomado.concluido(_chave(i)) for i in (1, 3, 4))
+    retomado.fechar()
+
+
+def test_renderizado_fica_em_lote_ate_fechar(tmp_path):
+    caminho = tmp_path / "envio.jsonl"
+    diario = td.DiarioEnvio(str(caminho), lote=100, intervalo_s=3600)
+    diario.registrar(_chave(0), "renderizado")
+    assert caminho.read_text(encoding="utf-8") == ""
+    diario.fechar()
+    linhas = [json.loads(l) for l in caminho.read_text(encoding="utf-8").splitlines()]
+    assert [(l["chave"], l["estado"]) for l in linhas] == [(_chave(0), "renderizado")]
+
+
+def test_linha_truncada_e_ignorada_ao_reabrir(tmp_path):
+    caminho = tmp_path / "envio.jsonl"
+    diario = td.DiarioEnvio(str(caminho))
+    diario.registrar(_chave(0), "enviado")
+    diario.fechar()
+    with open(caminho, "a", encoding="utf-8") as f:
+        f.write('{"chave": "corta')
+    retomado = td.DiarioEnvio(str(caminho))
+    assert retomado.resumo() == {"renderizado": 0, "enviado": 1, "falhou": 0}
+    retomado.fechar()
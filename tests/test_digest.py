@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip("pandas")
+
+import teste_docvs as td
+
+
+def _tarefa(contrato, emails, competencia="2025-09"):
+    return {"projeto": "P", "prestador": "Prestador", "contrato": contrato, "competencia": competencia,
+            "emails": emails}
+
+
+def test_digest_agrupa_sem_diferenciar_maiusculas_mas_envia_a_grafia_original():
+    digests = td.agrupar_digest([
+        _tarefa("1", ["Joao.Silva@Empresa.com", "b@x"]),
+        _tarefa("2", ["joao.silva@empresa.com", "B@X"]),
+        _tarefa("3", ["outro@x"]),
+    ])
+    assert len(digests) == 2
+    assert digests[0]["emails"] == ["b@x", "Joao.Silva@Empresa.com"]
+    assert [c["contrato"] for c in digests[0]["contratos"]] == ["1", "2"]
+    # a chave do diário continua a do conjunto normalizado
+    assert digests[0]["chave"] == td.DiarioEnvio.chave_digest(
+        [("P", "Prestador", "1"), ("P", "Prestador", "2")], "2025-09", ["b@x", "joao.silva@empresa.com"])
+
+
+def test_digest_de_um_contrato_no_singular(monkeypatch):
+    monkeypatch.setattr(td, "montar_email_digest", lambda competencia_dt, contratos, emails: ("", [], "", [(1.0, "")]))
+    monkeypatch.setattr(td, "_csv_contrato", lambda c: (None, 0))
+    um, dois = td.agrupar_digest([_tarefa("1", ["a@x"]), _tarefa("2", ["b@x"]), _tarefa("3", ["b@x"])])
+    assert (um["contrato"], dois["contrato"]) == ("1 contrato", "2 contratos")
+    assert td._renderizar_digest(um)["assunto"] == "[Pendências Docs] Prestador | 1 contrato | 2025-09"
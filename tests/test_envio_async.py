@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("aiosmtplib")
+pytest.importorskip("aiosmtpd")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+from test_pipeline import _tarefas
+
+
+class ContadorPorMensagem(bench._ContadorSMTP):
+    # o contador do benchmark, guardando também quantas vezes cada mensagem chegou
+    def __init__(self, atraso_s=0.0):
+        super().__init__(atraso_s)
+        self.recebidas = Counter()
+
+    async def handle_DATA(self, server, session, envelope):
+        resposta = await super().handle_DATA(server, session, envelope)
+        self.recebidas[envelope.content.split(b"\r\n", 1)[0]] += 1
+        return resposta
+
+
+@pytest.fixture
+def smtp_local():
+    from aiosmtpd.controller import Controller
+
+    def _iniciar(atraso_s=0.0):
+        contador = ContadorPorMensagem(atraso_s)
+        controller = Controller(contador, hostname="127.0.0.1", port=bench._porta_livre())
+        controller.start()
+        abertos.append(controller)
+        return contador, controller.port
+
+    abertos = []
+    yield _iniciar
+    for controller in abertos:
+        controller.stop()
+
+
+def _mensagem(i):
+    return td.MensagemBruta("de@x", ("para@x",), f"Subject: m{i}\r\n\r\ncorpo {i}\r\n".encode(), f"m{i}", ())
+
+
+def _envio(porta, **kw):
+    return td.EnvioAssincrono("127.0.0.1", porta, usar_tls=False, **kw)
+
+
+def test_envio_assincrono_entrega_cada_mensagem_uma_vez(smtp_local):
+    contador, porta = smtp_local()
+    n = 60
+    with _envio(porta, sessoes=4, fila_max=8, max_msgs_por_sessao=7) as envio:
+        futuros = [envio.submeter(_mensagem(i)) for i in range(n)]
+        resultados = [f.result(timeout=30) for f in futuros]
+    assert contador.mensagens == n
+    assert contador.recebidas == Counter({f"Subject: m{i}".encode(): 1 for i in range(n)})
+    assert all(r["tentativas"] == 1 and r["latencia_s"] > 0 for r in resultados)
+
+
+def test_envio_assincrono_fila_cheia_segura_quem_submete(smtp_local):
+    atraso, sessoes, fila_max, n = 0.05, 1, 2, 10
+    contador, porta = smtp_local(atraso)
+    adiantadas = []
+    with _envio(porta, sessoes=sessoes, fila_max=fila_max) as envio:
+        t0 = time.perf_counter()
+        futuros = []
+        for i in range(n):
+            futuros.append(envio.submeter(_mensagem(i)))
+            adiantadas.append(len(futuros) - contador.mensagens)
+        submissao = time.perf_counter() - t0
+        for f in futuros:
+            f.result(timeout=30)
+    # nunca mais que a fila + uma mensagem em voo por sessão à frente do servidor
+    assert max(adiantadas) <= fila_max + sessoes
+    # o produtor esperou o servidor: sem contrapressão, submeter seria instantâneo
+    assert submissao >= (n - fila_max - sessoes) * atraso * 0.8
+    assert contador.mensagens == n
+
+
+def test_envio_assincrono_registra_latencia_por_mensagem(smtp_local, monkeypatch):
+    contador, porta = smtp_local(0.01)
+    monkeypatch.setattr(td.METRICAS, "ativo", True)
+    td.METRICAS.drenar()
+    with _envio(porta, sessoes=2) as envio:
+        for f in [envio.submeter(_mensagem(i)) for i in range(12)]:
+            f.result(timeout=30)
+    latencias = td.METRICAS.drenar()[0]["latencia_envio"]
+    assert len(latencias) == 12
+    assert min(latencias) >= 0.01
+
+
+def _render_pid(tarefa):
+    return {"assunto": tarefa["chave"], "n_anexo": 0, "kpis": [], "metricas": td.METRICAS.drenar(),
+            "pid": os.getpid(), "mensagem": _mensagem(tarefa["chave"][1:])}
+
+
+def test_pipeline_com_envio_assincrono_reaproveita_workers_criados_antes_do_loop(smtp_local, monkeypatch):
+    contador, porta = smtp_local()
+    monkeypatch.setattr(td, "_renderizar_grupo", _render_pid)
+    pool_render = td.criar_pool_render(2)
+    workers = set(pool_render._processes)
+    try:
+        with _envio(porta, sessoes=2, fila_max=4) as envio:
+            # dois lotes (ou meses) seguidos: o segundo já roda com o event loop no ar
+            relatorios = [td.executar_pipeline(_tarefas(30), envio, pool_render=pool_render) for _ in range(2)]
+            assert any(t.name == "envio-async" for t in threading.enumerate())
+    finally:
+        pool_render.shutdown()
+    itens = [item for relatorio in relatorios for item in relatorio]
+    assert {item["status"] for item in itens} == {"enviado"}
+    assert {item["render"]["pid"] for item in itens} <= workers   # nenhum fork depois do loop
+    assert contador.mensagens == 60
+
+
+def test_envio_assincrono_vazao_cresce_com_as_sessoes(smtp_local):
+    # servidor com latência por mensagem: com N sessões em paralelo, N aceitações se sobrepõem
+    atraso, n = 0.05, 24
+
+    def _duracao(sessoes):
+        contador, porta = smtp_local(atraso)
+        with _envio(porta, sessoes=sessoes, fila_max=n) as envio:
+            t0 = time.perf_counter()
+            for f in [envio.submeter(_mensagem(i)) for i in range(n)]:
+                f.result(timeout=30)
+            duracao = time.perf_counter() - t0
+        assert contador.mensagens == n
+        return duracao
+
+    uma, quatro = _duracao(1), _duracao(4)
+    assert uma >= n * atraso
+    assert quatro < uma / 2
+
+
+class DiarioComThreads(td.DiarioEnvio):
+    # registra em que thread cada transição foi gravada
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.threads = []
+
+    def registrar(self, chave, estado, erro=None):
+        self.threads.append((estado, threading.current_thread().name))
+        super().registrar(chave, estado, erro)
+
+
+def test_pipeline_assincrono_grava_diario_fora_do_event_loop(smtp_local, monkeypatch, tmp_path):
+    contador, porta = smtp_local()
+    monkeypatch.setattr(td, "_renderizar_grupo", _render_pid)
+    diario = DiarioComThreads(str(tmp_path / "envio.jsonl"))
+    with _envio(porta, sessoes=2, fila_max=4) as envio:
+        relatorio = td.executar_pipeline(_tarefas(20), envio, workers_render=2, diario=diario)
+    diario.fechar()
+    assert {item["status"] for item in relatorio} == {"enviado"}
+    assert all(item["render"]["entrega"]["tentativas"] == 1 for item in relatorio)
+    enviados = [nome for estado, nome in diario.threads if estado == "enviado"]
+    assert len(enviados) == 20
+    assert "envio-async" not in {nome for _, nome in diario.threads}
+    assert td.DiarioEnvio(str(tmp_path / "envio.jsonl")).resumo()["enviado"] == 20
+
+
+def test_envio_assincrono_reconecta_quando_o_servidor_derruba_a_conexao():
+    from aiosmtpd.controller import Controller
+    from test_pool_smtp import ContadorSessoes
+    contador = ContadorSessoes(derrubar=True)
+    controller = Controller(contador, hostname="127.0.0.1", port=bench._porta_livre())
+    controller.start()
+    try:
+        with _envio(controller.port, sessoes=1, max_msgs_por_sessao=100) as envio:
+            for i in range(4):
+                envio.enviar(_mensagem(i))   # sem agendador: a sessão guardada já caiu, reabre e reenvia
+    finally:
+        controller.stop()
+    assert contador.mensagens == 4
+    assert len(contador.sessoes) == 4
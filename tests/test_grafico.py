@@ -0,0 +1,41 @@
+import email
+from email import policy
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("matplotlib")
+
+import teste_docvs as td
+
+
+def _hist5():
+    return pd.DataFrame({"COMPETENCIA": td._lista_ultimos_5_meses("2025-09"),
+                         "total_pendencias": [3, 1, 4, 1, 5], "total_criticos": [0, 0, 1, 0, 1],
+                         "perc_atingido": [0.5, 0.6, 0.7, 0.8, 0.9]})
+
+
+@pytest.mark.parametrize("formato, assinatura", [("png", b"\x89PNG"), ("svg", b"<?xml")])
+def test_formato_do_grafico_lido_na_chamada(monkeypatch, formato, assinatura):
+    monkeypatch.setattr(td, "FORMATO_GRAFICO", formato)
+    dados = td.GRAFICOS.renderizar(["2025-05", "2025-06"], [1.0, 2.0])
+    assert dados.startswith(assinatura)
+
+
+def test_mensagem_com_grafico_svg_tem_bytes_e_rotulo_svg(monkeypatch, tmp_path):
+    monkeypatch.setattr(td, "FORMATO_GRAFICO", "svg")
+    logo = tmp_path / "logo.png"
+    logo.write_bytes(b"\x89PNG logo")
+    monkeypatch.setattr(td, "ATIVOS", td.RegistroAtivos())
+    td.ATIVOS.registrar("logo_metax", str(logo), "png", "logo_metax.png")
+
+    html, grafico_bytes, texto, _ = td.montar_email(
+        "Projeto", "Prestador", "1", pd.Timestamp("2025-09-01"), _hist5(),
+        pd.DataFrame(columns=["STATUS_GERAL_Regra", "CRITICO", "RELEVANCIA", "DOCUMENTO"]), ["a@x"],
+    )
+    msg = email.message_from_bytes(td.mensagem_bytes(["a@x"], "Assunto", html, grafico_bytes, texto=texto).dados,
+                                   policy=policy.default)
+    grafico = next(p for p in msg.walk() if p["Content-ID"] == "<grafico_pendencias>")
+    assert grafico.get_content_type() == "image/svg+xml"
+    assert grafico.get_filename() == "grafico_pendencias.svg"
+    assert grafico.get_content().lstrip().startswith(b"<?xml")
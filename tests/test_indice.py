@@ -0,0 +1,42 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+
+def _mascara(df, projeto, prestador, contrato):
+    # o filtro por contrato de antes do índice
+    return df[(df["PROJETO"] == projeto) & (df["PRESTADOR"] == prestador) & (df["CONTRATO"] == contrato)]
+
+
+@pytest.mark.parametrize("categorizar", [False, True])
+def test_fatia_do_indice_igual_ao_filtro_por_mascara(categorizar):
+    cubo = bench.gerar_cubo(15, docs_por_contrato=3, meses=4, seed=11)
+    cards = td.agregar_cards_cubo(cubo)
+    if categorizar:
+        cubo, cards = td.categorizar_compartilhado(cubo, cards)
+    chaves = [tuple(k) for k in cubo[td.CHAVE_CONTRATO].drop_duplicates().itertuples(index=False)]
+    for df in (cubo, cards):
+        indice = td.IndiceContratos(df)
+        assert len(indice) == 15
+        for chave in chaves:
+            assert chave in indice
+            pd.testing.assert_frame_equal(indice.fatia(*chave), _mascara(df, *chave))
+
+    ausente = ("Vallourec", "Prestador 99999", "CT-999999")
+    assert ausente not in indice
+    vazio = indice.fatia(*ausente)
+    assert vazio.empty and list(vazio.columns) == list(cards.columns)
+
+
+def test_historico_5_meses_igual_com_e_sem_indice():
+    cubo = bench.gerar_cubo(8, docs_por_contrato=3, meses=6, seed=2)
+    cards = td.agregar_cards_cubo(cubo)
+    indice = td.IndiceContratos(cards)
+    ultimos_5 = td._lista_ultimos_5_meses("2025-09")
+    for chave in cubo[td.CHAVE_CONTRATO].drop_duplicates().itertuples(index=False):
+        pd.testing.assert_frame_equal(td.historico_5_meses(cards, *chave, indice, ultimos_5=ultimos_5),
+                                      td.historico_5_meses(cards, *chave, ultimos_5=ultimos_5))
@@ -0,0 +1,52 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+COMPETENCIA = "2025-09"
+
+
+@pytest.fixture(scope="module")
+def envio():
+    cubo = bench.gerar_cubo(40, docs_por_contrato=6, meses=2, seed=3)
+    return cubo, cubo[cubo["COMPETENCIA"] == COMPETENCIA]
+
+
+def test_kpis_em_lote_iguais_ao_calculo_por_contrato(envio):
+    _, df = envio
+    kpis = td.calcular_kpis_lote(df, td.CHAVE_GRUPO_ENVIO)
+    grupos = dict(list(df.groupby(td.CHAVE_GRUPO_ENVIO, observed=True)))
+    assert len(kpis) == len(grupos) == 40
+    assert kpis["PROJETO"].nunique() == len(bench.PROJETOS)   # todas as regras de legenda passam aqui
+    for linha in kpis.itertuples(index=False):
+        chave = tuple(getattr(linha, c) for c in td.CHAVE_GRUPO_ENVIO)
+        perc, legenda = td.calcular_relevancia_e_legenda(grupos[chave], linha.PROJETO)
+        assert linha.perc == pytest.approx(perc)
+        assert linha.legenda == legenda
+
+
+def test_tarefa_leva_o_kpi_e_o_render_nao_recalcula(envio, monkeypatch):
+    cubo, df = envio
+    anexos = {tuple(k): (None, 0) for k in df[td.CHAVE_CONTRATO].drop_duplicates().itertuples(index=False)}
+    tarefas, _ = td.preparar_tarefas(cubo, td.agregar_cards_cubo(cubo), None, COMPETENCIA, anexos_hist=anexos)
+    assert len(tarefas) == 40
+
+    esperado = {}
+    for t in tarefas:
+        esperado[t["chave"]] = td.calcular_relevancia_e_legenda(t["df_mes_atual"], t["projeto"])
+        assert t["kpi"][0] == pytest.approx(esperado[t["chave"]][0])
+        assert t["kpi"][1] == esperado[t["chave"]][1]
+
+    def _nao_chamar(*a, **kw):
+        raise AssertionError("KPI recalculado por contrato no render")
+
+    monkeypatch.setattr(td, "calcular_relevancia_e_legenda", _nao_chamar)
+    t = tarefas[0]
+    _, _, _, kpi = td.montar_email(t["projeto"], t["prestador"], t["contrato"], pd.Timestamp(COMPETENCIA + "-01"),
+                                   t["df_cards_hist5"], t["df_mes_atual"], t["emails"], kpi=t["kpi"])
+    assert kpi == t["kpi"]
+    html, _, _, kpis = td.montar_email_digest(pd.Timestamp(COMPETENCIA + "-01"), tarefas[:3], ["a@x"])
+    assert kpis == [t["kpi"] for t in tarefas[:3]]
@@ -0,0 +1,27 @@
+import email
+from email import policy
+
+import pytest
+
+import teste_docvs as td
+
+
+@pytest.fixture(autouse=True)
+def remetente(monkeypatch):
+    monkeypatch.setattr(td, "SMTP_FROM", "docvs@x")
+
+
+@pytest.mark.parametrize("texto, anexo", [
+    (None, None),
+    ("pendências", None),
+    ("pendências", (b"CONTRATO;DOC\r\n1;RG\r\n", "pendencias.csv", "csv")),
+])
+def test_mime_version_so_na_raiz(texto, anexo):
+    bruta = td.mensagem_bytes(["para@x"], "Pendências 2025-09", "<p>oi</p>", grafico_bytes=b"\x89PNG g",
+                              logo_bytes=b"\x89PNG l", texto=texto, anexo=anexo)
+    msg = email.message_from_bytes(bruta.dados, policy=policy.default)
+    partes = list(msg.walk())
+    assert len(partes) > 1
+    assert msg["MIME-Version"] == "1.0"
+    assert [p for p in partes[1:] if "MIME-Version" in p] == []
+    assert bruta.dados.count(b"MIME-Version:") == 1
@@ -0,0 +1,54 @@
+import statistics
+
+import teste_docvs as td
+
+
+def test_percentis_interpolados_sem_depender_da_ordem():
+    m = td.Metricas()
+    valores = list(range(100, 0, -1))   # fora de ordem
+    for v in valores:
+        m.observar("x", v)
+    d = m.resumo()["tamanhos"]["x"]
+    assert (d["n"], d["total"], d["max"]) == (100, 5050, 100)
+    assert d["p50"] == statistics.median(valores) == 50.5
+    assert abs(d["p95"] - 95.05) < 1e-9   # = numpy.percentile(valores, 95)
+
+    m.observar("um", 7)
+    assert m.resumo()["tamanhos"]["um"] == {"n": 1, "total": 7, "p50": 7, "p95": 7, "max": 7}
+
+
+def test_prometheus_exporta_tamanhos_como_histograma(tmp_path):
+    m = td.Metricas()
+    for tamanho in (500, 2000, 2000, 5_000_000):
+        m.observar("mensagem_bytes", tamanho)
+    m.registrar("montar_email", 0.25)
+    m.contar("bytes_enviados_total", 123_456_789)
+    caminho = str(tmp_path / "docvs.prom")
+    m.salvar_prometheus(caminho)
+    linhas = open(caminho).read().splitlines()
+
+    def valor(prefixo):
+        return next(l.rsplit(" ", 1)[1] for l in linhas if l.startswith(prefixo))
+
+    assert "# TYPE docvs_tamanho_bytes histogram" in linhas
+    assert valor('docvs_tamanho_bytes_bucket{medida="mensagem_bytes",le="1024"}') == "1"
+    assert valor('docvs_tamanho_bytes_bucket{medida="mensagem_bytes",le="4096"}') == "3"
+    assert valor('docvs_tamanho_bytes_bucket{medida="mensagem_bytes",le="4194304"}') == "3"
+    assert valor('docvs_tamanho_bytes_bucket{medida="mensagem_bytes",le="+Inf"}') == "4"
+    assert valor('docvs_tamanho_bytes_sum{medida="mensagem_bytes"}') == "5004500"
+    assert valor('docvs_tamanho_bytes_count{medida="mensagem_bytes"}') == "4"
+    assert valor('docvs_etapa_segundos{etapa="montar_email",quantile="0.5"}') == "0.250000"
+    assert valor("docvs_bytes_enviados_total") == "123456789"
+
+
+def test_dry_run_em_disco_nao_conta_como_enviado(monkeypatch, tmp_path):
+    m = td.Metricas()
+    monkeypatch.setattr(td, "METRICAS", m)
+    msg = td.MensagemBruta("de@x", ("a@x",), b"Subject: teste\r\n\r\nok\r\n", "teste", ())
+    with td.SaidaEml(str(tmp_path)) as saida:
+        td.enviar_mensagem(msg, saida)
+    contadores = m.resumo()["contadores"]
+    assert "mensagens_enviadas_total" not in contadores and "bytes_enviados_total" not in contadores
+    assert contadores["mensagens_gravadas_total"] == 1
+    assert contadores["bytes_gravados_total"] == len(msg.dados)
+    assert m.resumo()["tamanhos"]["mensagem_bytes"]["n"] == 1
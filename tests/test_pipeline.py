@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+pytest.importorskip("pandas")
+
+import teste_docvs as td
+
+
+def _render_falso(tarefa):
+    # substitui _renderizar_grupo (precisa ser importável para ir ao worker)
+    if tarefa.get("quebra"):
+        raise ValueError("render quebrou")
+    return {"assunto": tarefa["chave"], "n_anexo": 0, "kpis": [], "metricas": td.METRICAS.drenar(),
+            "mensagem": td.MensagemBruta("de@x", tuple(tarefa["emails"]), b"x" * 10, tarefa["chave"], ())}
+
+
+class SaidaFalsa:
+    def __init__(self, falhar=()):
+        self.enviadas = []
+        self.falhar = set(falhar)
+        self._lock = threading.Lock()
+
+    def enviar(self, msg):
+        if msg.assunto in self.falhar:
+            raise ValueError("recusada")
+        with self._lock:
+            self.enviadas.append(msg.assunto)
+
+
+@pytest.fixture
+def render_falso(monkeypatch):
+    monkeypatch.setattr(td, "_renderizar_grupo", _render_falso)
+
+
+def _tarefas(n, **extra):
+    return [dict({"chave": f"k{i}", "emails": ["a@x"]}, **extra) for i in range(n)]
+
+
+@pytest.mark.parametrize("opcoes", [{}, {"janela": 3, "liberar": True}, {"memoria_max_mb": 0.001}])
+def test_pipeline_entrega_tudo_na_ordem(render_falso, opcoes):
+    tarefas = _tarefas(300)
+    saida = SaidaFalsa()
+    relatorio = td.executar_pipeline(tarefas, saida, workers_render=2, workers_envio=3, **opcoes)
+    assert [item["tarefa"]["chave"] for item in relatorio] == [t["chave"] for t in tarefas]
+    assert {item["status"] for item in relatorio} == {"enviado"}
+    assert sorted(saida.enviadas) == sorted(t["chave"] for t in tarefas)
+    assert len(saida.enviadas) == len(set(saida.enviadas))
+
+
+def test_pipeline_falhas_de_render_e_envio(render_falso):
+    tarefas = _tarefas(20)
+    tarefas[3]["quebra"] = True
+    relatorio = td.executar_pipeline(tarefas, SaidaFalsa(falhar={"k5"}), workers_render=2, janela=2)
+    status = [item["status"] for item in relatorio]
+    assert status[3] == "erro_render"
+    assert status[5] == "erro_envio"
+    assert status.count("enviado") == 18
+
+
+def test_pipeline_dry_run_nao_entrega(render_falso):
+    relatorio = td.executar_pipeline(_tarefas(10), None, workers_render=2, enviar=False)
+    assert {item["status"] for item in relatorio} == {"renderizado"}
+
+
+def test_pipeline_sem_chave_nao_registra_no_diario(render_falso, tmp_path):
+    diario = td.DiarioEnvio(str(tmp_path / "envio.jsonl"))
+    tarefas = [{"emails": ["a@x"], "quebra": True}, {"chave": "k1", "emails": ["a@x"], "quebra": True}]
+    relatorio = td.executar_pipeline(tarefas, SaidaFalsa(), workers_render=2, diario=diario)
+    diario.fechar()
+    assert [item["status"] for item in relatorio] == ["erro_render", "erro_render"]
+    assert td.DiarioEnvio(str(tmp_path / "envio.jsonl")).estados == {"k1": "falhou"}
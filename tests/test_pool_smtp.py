@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("aiosmtpd")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+from test_envio_async import _mensagem
+
+
+class ContadorSessoes(bench._ContadorSMTP):
+    """Conta as conexões que entregaram algo; com `derrubar`, fecha a conexão após cada mensagem."""
+
+    def __init__(self, derrubar=False):
+        super().__init__()
+        self.derrubar = derrubar
+        self.sessoes = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        resposta = await super().handle_DATA(server, session, envelope)
+        self.sessoes.add(session)   # guarda o objeto: id() de sessões já coletadas se repete
+        if self.derrubar:
+            # o 250 sai antes (o transporte esvazia o buffer ao fechar)
+            asyncio.get_running_loop().call_soon(server.transport.close)
+        return resposta
+
+
+@pytest.fixture
+def servidor():
+    from aiosmtpd.controller import Controller
+    abertos = []
+
+    def _iniciar(**kw):
+        contador = ContadorSessoes(**kw)
+        controller = Controller(contador, hostname="127.0.0.1", port=bench._porta_livre())
+        controller.start()
+        abertos.append(controller)
+        return contador, controller.port
+
+    yield _iniciar
+    for controller in abertos:
+        controller.stop()
+
+
+def test_pool_rotaciona_a_sessao_apos_max_msgs(servidor):
+    contador, porta = servidor()
+    with td.PoolSMTP("127.0.0.1", porta, tamanho=1, max_msgs_por_sessao=3, usar_tls=False) as pool:
+        for i in range(7):
+            pool.enviar(_mensagem(i))
+    assert contador.mensagens == 7
+    assert len(contador.sessoes) == 3   # 3 + 3 + 1
+
+
+def test_pool_reconecta_quando_o_servidor_derruba_a_conexao(servidor):
+    contador, porta = servidor(derrubar=True)
+    with td.PoolSMTP("127.0.0.1", porta, tamanho=1, max_msgs_por_sessao=100, usar_tls=False) as pool:
+        for i in range(4):
+            pool.enviar(_mensagem(i))   # a sessão guardada já caiu: reabre e reenvia
+    assert contador.mensagens == 4
+    assert len(contador.sessoes) == 4
+
+
+def test_fechar_encerra_a_sessao_que_estava_em_uso():
+    controller, contador, porta = bench.iniciar_smtp_local(atraso_s=0.3)
+    try:
+        pool = td.PoolSMTP("127.0.0.1", porta, tamanho=1, usar_tls=False)
+        abertas = []
+        conectar = pool._conectar
+        pool._conectar = lambda: abertas.append(conectar()) or abertas[-1]
+        envio = threading.Thread(target=pool.enviar, args=(_mensagem(0),))
+        envio.start()
+        while not abertas:
+            time.sleep(0.005)
+        pool.fechar()   # a sessão ainda está no DATA
+        envio.join()
+        assert contador.mensagens == 1
+        assert abertas[0][0].sock is None   # QUIT/close depois de voltar ao pool
+        with pytest.raises(RuntimeError):
+            pool.enviar(_mensagem(1))
+    finally:
+        controller.stop()
@@ -0,0 +1,77 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+COMPETENCIA = "2025-09"
+
+
+@pytest.fixture
+def cubo():
+    return bench.gerar_cubo(12, docs_por_contrato=4, meses=2, seed=5)
+
+
+def _preparar(cubo, hashes):
+    df = cubo[cubo["COMPETENCIA"] == COMPETENCIA]
+    anexos = {tuple(k): (None, 0) for k in df[td.CHAVE_CONTRATO].drop_duplicates().itertuples(index=False)}
+    tarefas, _ = td.preparar_tarefas(cubo, td.agregar_cards_cubo(cubo), None, COMPETENCIA,
+                                     anexos_hist=anexos, hashes=hashes)
+    return tarefas
+
+
+def _enviar(hashes, tarefas, falhar=()):
+    relatorio = [{"tarefa": t, "status": "erro_envio" if t["contrato"] in falhar else "enviado"}
+                 for t in tarefas]
+    td.registrar_enviados(hashes, relatorio)
+
+
+def _linhas_do(cubo, contrato):
+    return (cubo["CONTRATO"] == contrato) & (cubo["COMPETENCIA"] == COMPETENCIA)
+
+
+def test_hash_casa_os_kpis_pela_chave_e_nao_pela_ordem(cubo):
+    df = cubo[cubo["COMPETENCIA"] == COMPETENCIA]
+    kpis = td.calcular_kpis_lote(df, td.CHAVE_GRUPO_ENVIO)
+    esperado = td.hashes_conteudo(df, kpis=kpis)
+    assert len(esperado) == 12
+    assert td.hashes_conteudo(df.iloc[::-1]) == esperado                       # ordem das linhas
+    assert td.hashes_conteudo(df, kpis=kpis.iloc[::-1].reset_index(drop=True)) == esperado
+    with pytest.raises(ValueError):
+        td.hashes_conteudo(df, kpis=kpis.iloc[1:])
+
+
+def test_so_reenvia_o_que_mudou_ou_falhou(cubo, tmp_path):
+    caminho = str(tmp_path / "hashes.sqlite")
+    hashes = td.HashesEnvio(caminho)
+    tarefas = _preparar(cubo, hashes)
+    assert len(tarefas) == 12
+    _enviar(hashes, tarefas, falhar={"CT-000003"})
+    hashes.fechar()
+
+    hashes = td.HashesEnvio(caminho)
+    assert len(hashes) == 11
+    # a falha não gravou hash: é a única que volta
+    assert [t["contrato"] for t in _preparar(cubo, hashes)] == ["CT-000003"]
+
+    alterado = cubo.copy()
+    alterado.loc[_linhas_do(alterado, "CT-000001"), "DOCUMENTO_APROV_OBS2"] = "Nova observação"
+    alterado.loc[_linhas_do(alterado, "CT-000005"), "DOCUMENTO_APROV_REGULARIZA2"] = "Regularizar até o dia 20"
+    # só o KPI muda (relevância não entra nas colunas de conteúdo)
+    alterado.loc[_linhas_do(alterado, "CT-000007"), "RELEVANCIA"] = "0.000001"
+    reenviar = sorted(t["contrato"] for t in _preparar(alterado, hashes))
+    assert reenviar == ["CT-000001", "CT-000003", "CT-000005", "CT-000007"]
+    hashes.fechar()
+
+
+def test_mudanca_so_no_kpi_muda_o_hash(cubo):
+    df = cubo[cubo["COMPETENCIA"] == COMPETENCIA].copy()
+    antes = td.hashes_conteudo(df)
+    linhas = df["CONTRATO"] == "CT-000002"
+    df.loc[linhas, "CRITICO"] = "1"
+    df.loc[linhas, "RELEVANCIA"] = "0.000001"
+    depois = td.hashes_conteudo(df)
+    diferentes = [k for k in antes if antes[k] != depois[k]]
+    assert [k[2] for k in diferentes] == ["CT-000002"]
@@ -0,0 +1,28 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+import benchmark_docvs as bench
+import teste_docvs as td
+
+
+def _docs(obs):
+    n = len(obs)
+    return pd.DataFrame({
+        "PROJETO": ["P"] * n,
+        "DOCUMENTO": [f"Doc {i}" for i in range(n)],
+        "DOCUMENTO_APROV_OBS2": obs,
+        "DOCUMENTO_APROV_REGULARIZA2": ["Regularizar " + "x" * 300] * n,
+        "STATUS_GERAL_Regra": ["Não Conforme"] * n,
+    })
+
+
+def test_tabela_igual_a_original_em_texto_simples():
+    df = _docs(["Assinatura ausente", "", "Enviar versão atualizada"])
+    assert td.dataframe_to_html(df) == bench._dataframe_to_html_original(df)
+
+
+def test_tabela_escapa_e_deixa_vazios_em_branco():
+    html = td.dataframe_to_html(_docs(["Valor < mínimo & data", None]))
+    assert "<td style='padding:6px 8px;'>Valor &lt; mínimo &amp; data</td>" in html
+    assert "<td style='padding:6px 8px;'></td>" in html and "None" not in html
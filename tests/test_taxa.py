@@ -0,0 +1,83 @@
+import smtplib
+
+import pytest
+
+pytest.importorskip("pandas")
+
+import teste_docvs as td
+
+
+def _throttle():
+    return smtplib.SMTPResponseException(451, b"tente mais tarde")
+
+
+def test_sem_taxa_fica_sem_limite_ate_o_primeiro_throttle():
+    taxa = td.TaxaAdaptativa(td.LimitadorTaxa(None))
+    for _ in range(200):
+        assert taxa.limitador.reservar() == 0.0
+        taxa.registrar(True)
+    assert taxa.taxa is None and taxa.limitador.taxa is None
+
+
+def test_primeira_reducao_parte_da_vazao_observada(monkeypatch):
+    relogio = iter(range(10_000))
+    monkeypatch.setattr(td.time, "monotonic", lambda: next(relogio) / 100)   # 100 envios/s
+    taxa = td.TaxaAdaptativa(td.LimitadorTaxa(None), fator=0.5, limiar=0.05)
+    for _ in range(50):
+        taxa.registrar(True)
+    for _ in range(3):
+        taxa.registrar(False, throttle=True)
+    assert taxa.taxa == pytest.approx(50.0)
+    assert taxa.limitador.taxa == taxa.taxa
+
+
+def test_taxa_configurada_e_o_ponto_de_partida_e_o_teto():
+    taxa = td.TaxaAdaptativa(td.LimitadorTaxa(10), taxa_max=10, passo=1)
+    for _ in range(5):
+        taxa.registrar(True)
+    assert taxa.taxa == 10
+
+
+def test_agendador_repete_transitorio_e_desiste_de_permanente(monkeypatch):
+    monkeypatch.setattr(td.time, "sleep", lambda s: None)
+    agendador = td.AgendadorEntrega(td.TaxaAdaptativa(td.LimitadorTaxa(None)), max_tentativas=4)
+    falhas = [_throttle(), _throttle()]
+
+    def entrega():
+        if falhas:
+            raise falhas.pop()
+    assert agendador.executar(entrega) == 3
+
+    def recusada():
+        raise smtplib.SMTPResponseException(550, b"caixa inexistente")
+    with pytest.raises(smtplib.SMTPResponseException):
+        agendador.executar(recusada)
+
+
+def test_taxa_aprendida_vale_para_a_proxima_chamada_do_pipeline(monkeypatch):
+    from test_pipeline import SaidaFalsa, _render_falso, _tarefas
+    monkeypatch.setattr(td, "_renderizar_grupo", _render_falso)
+    agendador = td.AgendadorEntrega(td.TaxaAdaptativa(td.LimitadorTaxa(None), taxa_inicial=40.0), base_s=0.001)
+
+    class SaidaComTaxa(SaidaFalsa):
+        # anota o limite em vigor a cada entrega; a primeira recebe um 451
+        def __init__(self, throttle=0):
+            super().__init__()
+            self.throttle, self.limites = throttle, []
+
+        def enviar(self, msg):
+            self.limites.append(agendador.taxa.limitador.taxa)
+            if self.throttle:
+                self.throttle -= 1
+                raise _throttle()
+            super().enviar(msg)
+
+    primeiro = SaidaComTaxa(throttle=1)
+    td.executar_pipeline(_tarefas(5), primeiro, workers_render=1, workers_envio=1, agendador=agendador)
+    assert primeiro.limites[0] is None and agendador.taxa.taxa == pytest.approx(20.0)
+
+    # lote seguinte (ou próximo mês): já começa na taxa reduzida, não sem limite
+    segundo = SaidaComTaxa()
+    td.executar_pipeline(_tarefas(5), segundo, workers_render=1, workers_envio=1, agendador=agendador)
+    assert segundo.limites == [pytest.approx(20.0)] * 5
+    assert len(segundo.enviadas) == 5